@@ -1,4 +1,25 @@
 """" Analytics functions """
+from collections import namedtuple
+from itertools import groupby
+
+from sqlalchemy import bindparam, text
+
+# Streak figures of a single habit, the longest streak, the current
+# (latest) streak and the number of streaks
+Streaks = namedtuple("Streaks", ["longest", "current", "count"])
+
+# Streak figures of a habit without any event
+NO_STREAKS = Streaks(0, 0, 0)
+
+# Completion rate and average quota of the events inside a bucket,
+# change is the difference of the rate to the previous bucket
+Trend = namedtuple("Trend",
+                   ["bucket", "events", "completion", "average", "change"])
+
+# Figures of a single habit, its Streaks, the average quota, the share
+# of done events and the done events per weekday, Monday first
+Statistics = namedtuple("Statistics",
+                        ["streaks", "average", "completion", "weekdays"])
 
 
 def get_habits(habits):
@@ -28,34 +49,157 @@ def get_lstreaks_single(streak):
     )
 
 
+def get_streaks_grouped(events):
+    """ get longest streak, current streak and number of streaks for
+    all habits in one single pass.
+
+    events can be any iterable, e.g. ORM objects or rows streamed from
+    a cursor, with a habit_id and a status. They need to be ordered
+    by habit id and solved date, pending and failed events break a streak.
+
+    Returns a dictionary with the habit id as key and Streaks as value
+    """
+    streaks = {}
+    habit_id = None
+    longest = current = count = 0
+
+    for event in events:
+        # Next habit begins, store the figures of the last one
+        if event.habit_id != habit_id:
+            if habit_id is not None:
+                streaks[habit_id] = Streaks(longest, current, count)
+            habit_id = event.habit_id
+            longest = current = count = 0
+
+        if event.status == 1:
+            # a success after a failure starts a new streak
+            if current == 0:
+                count += 1
+            current += 1
+            longest = max(longest, current)
+        else:
+            current = 0
+
+    # Store the figures of the last habit
+    if habit_id is not None:
+        streaks[habit_id] = Streaks(longest, current, count)
+
+    return streaks
+
+
+# Gaps and islands: every failed or pending event starts a new island,
+# the successes inside an island are the length of a streak
+STREAKS_SQL = """
+WITH marked AS (
+    SELECT habit_id, status,
+           SUM(CASE WHEN status = 1 THEN 0 ELSE 1 END) OVER (
+               PARTITION BY habit_id ORDER BY datetime_solved, event_id
+               ROWS UNBOUNDED PRECEDING) AS island
+    FROM HabitEvent {where}
+), islands AS (
+    SELECT habit_id, island, SUM(status = 1) AS length,
+           MAX(island) OVER (PARTITION BY habit_id) AS latest
+    FROM marked
+    GROUP BY habit_id, island
+)
+SELECT habit_id, MAX(length) AS longest,
+       MAX(CASE WHEN island = latest THEN length ELSE 0 END) AS current,
+       SUM(length > 0) AS count
+FROM islands
+GROUP BY habit_id
+"""
+
+
+def get_streaks_sql(connection, habit_ids=None, user_id=None):
+    """ get longest streak, current streak and number of streaks for
+    all habits, the habits of a user or the given habit ids, evaluated
+    inside SQLite with window functions. Only one row per habit is
+    returned to Python.
+
+    Returns a dictionary with the habit id as key and Streaks as value
+    """
+    conditions = []
+    params = {}
+    if user_id is not None:
+        conditions.append("user_id = :user_id")
+        params["user_id"] = user_id
+    if habit_ids is not None:
+        conditions.append("habit_id IN :habit_ids")
+        params["habit_ids"] = list(habit_ids)
+
+    where = "WHERE " + " AND ".join(conditions) if conditions else ""
+    query = text(STREAKS_SQL.format(where=where))
+    if habit_ids is not None:
+        query = query.bindparams(bindparam("habit_ids", expanding=True))
+
+    return dict(map(lambda x: (x.habit_id,
+                               Streaks(x.longest, x.current, x.count)),
+                    connection.execute(query, params)))
+
+
 def get_lstreaks_all(habits, events):
     """ get all longest streaks for all habits """
 
-    # Helping function
-    def streakhelper(habit):
-        # return a string of all habit events
-        # containing 1s (success) or 2s (failed)
-        return (
-            # Concat all strings together to get the string
-            # e.g. "1122221112121"
-            "".join(map(str, map(
-                # if status is 1 or 2, pass it as it is
-                # and if an event is pending, mark it also as 2 (failed)
-                lambda x: x.status if x.status in (1, 2) else 2, (
-                    filter(
-                        # Filter events containing our habit id
-                        lambda x: habit.habit_id == x.habit_id, events))))))
+    # Group events by habit, the sort is stable and will
+    # keep the solved order inside a habit. An EventStore is grouped
+    # already and is streamed without a copy
+    if not getattr(events, "ordered_by_habit", False):
+        events = sorted(events, key=lambda x: x.habit_id)
+    streaks = get_streaks_grouped(events)
 
     # Then return a dictionary of habit object
     return (
-        # Dictionary with object as key
-        dict(map(lambda x: (x,
-                            # Calculating the max value of mapping
-                            max(map(
-                                # the single splits from the streak - function
-                                len, streakhelper(x).split("2")))), habits)))
+        # Dictionary with object as key and the longest streak as value
+        dict(map(lambda x: (x, streaks.get(x.habit_id, NO_STREAKS).longest),
+                 habits)))
 
 
 def get_calculate_avg(events):
     """ Calculates the average quota of a habit """
     return sum(map(lambda x: x.quota, events)) / len(events)
+
+
+def get_weekday_histogram(events):
+    """ Counts the done events of a habit per weekday, Monday first """
+    histogram = [0] * 7
+    for event in filter(lambda x: x.status == 1, events):
+        histogram[event.datetime_solved.weekday()] += 1
+    return histogram
+
+
+def get_statistics(events):
+    """ get Statistics for all habits.
+
+    events is a list of rows with habit_id, status, quota and
+    datetime_solved, ordered by habit id and solved date.
+
+    Returns a dictionary with the habit id as key and Statistics as value
+    """
+    streaks = get_streaks_grouped(events)
+    statistics = {}
+    for habit_id, group in groupby(events, key=lambda x: x.habit_id):
+        group = list(group)
+        statistics[habit_id] = Statistics(
+            streaks[habit_id], get_calculate_avg(group),
+            len(list(filter(lambda x: x.status == 1, group))) / len(group),
+            get_weekday_histogram(group))
+    return statistics
+
+
+def get_completion_trend(buckets):
+    """ get the completion rate and the average quota per bucket and the
+    change of the rate against the previous bucket.
+
+    buckets are rows of a rollup with bucket, done, failed, pending and
+    quota_sum, ordered by the bucket. Returns a list of Trend
+    """
+    trend = []
+    previous = None
+    for row in buckets:
+        events = row.done + row.failed + row.pending
+        completion = row.done / events
+        change = None if previous is None else completion - previous
+        trend.append(Trend(row.bucket, events, completion,
+                           row.quota_sum / events, change))
+        previous = completion
+    return trend
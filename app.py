@@ -8,12 +8,13 @@ haha-bits, a small habit tracker in Python
 
 """
 # Import engine and session creator
-import datetime
 import calendar
-from sqlalchemy import create_engine
+import datetime
+import sys
 from sqlalchemy.orm import sessionmaker
 
-import analytics
+# Import the engine factory
+import database
 
 # Import Base for SQL Classes
 import base
@@ -21,47 +22,60 @@ import base
 from climenu import CliMenu, ask, ask_many
 # Import our model classes
 import models
+# Import the business operations
+import service
+# Import the lookup cache of habits and categories
+import cache
 
 exception_inputs = (KeyboardInterrupt, EOFError)
 
+# Session of the running application, opened by main()
+session = None
+
+# Background persistence of the interactive menu, if running
+persistence_worker = None
+
+# Business operations as units of work, used by the commands
+habit_service = None
+
+# User of the running application, every query is scoped by this user
+current_user = models.DEFAULT_USER
+
+# Metadata of habits and categories, looked up again and again inside
+# one action. Invalidate it, whenever a habit or category is changed
+lookup_cache = cache.LookupCache()
+
 
 def habit_delete(habit_id):
     """ Delete habit and events and then commit to SQL """
 
-    habit = session.query(models.Habit).get(habit_id)
-
     # If the habit is not found, we return
-    if habit is None:
+    if not service.delete_habit(session, habit_id, current_user):
         print("This habit does not exist.")
         return
 
-    session.query(models.Habit).filter(
-        models.Habit.habit_id == habit_id).delete()
-    session.query(models.HabitEvent).filter(
-        models.HabitEvent.habit_id == habit_id).delete()
     session.commit()
+    lookup_cache.invalidate_habit(habit_id)
 
     print("habit deleted.")
 
 
 def cat_delete(cat_id):
     """ Delete habit category and commits to SQL """
-    cat = session.query(models.HabitCategory).get(cat_id)
-
-    # If the habit is not found, we return
-    if cat is None:
+    # If the category is not found, we return
+    if not service.delete_category(session, cat_id, current_user):
         print("This category does not exist.")
         return
 
-    session.query(models.HabitCategory).filter(
-        models.HabitCategory.cat_id == cat_id).delete()
     session.commit()
+    lookup_cache.invalidate_category(cat_id)
     print("category deleted.")
 
 # Habit List
 def habit_list_ay():
     """ Prints out a list of all habits """
-    habits = session.query(models.Habit).filter().all()
+    import analytics
+    habits = service.get_habits(session, current_user).all()
     print("\tAll habits\n\tID\tName\tEnabled")
 
     # Call analytics
@@ -79,20 +93,13 @@ def reset_event():
     except exception_inputs:
         return
 
-    event = session.query(models.HabitEvent).get(event_id)
+    # Pending again, the streaks are evaluated again
+    event = service.reset_event(session, event_id, current_user)
     # If the event is not found, we return
     if event is None:
         print("This event does not exist")
         return
 
-    # Set status of this event to 0 = PENDING with none quota
-    event.set_status(0)
-    event.set_quota(0)
-
-    # Execute against DB
-    session.add(event)
-    session.commit()
-
     print(f"Event reset, please run "
           f"check(o)ff {event.habit_id} to resolve the issue")
 
@@ -105,7 +112,7 @@ def habit_average():
     except exception_inputs:
         return
 
-    habit = session.query(models.Habit).get(habit_id)
+    habit = lookup_cache.habit(session, habit_id, current_user)
     # If the habit is not found, we return
     if habit is None:
         print("This habit does not exist")
@@ -115,11 +122,10 @@ def habit_average():
         print("This habit has no condition function")
         return
 
-    habit_events = session.query(models.HabitEvent). \
-        order_by(models.HabitEvent.datetime_solved).filter(
-        models.HabitEvent.habit_id == habit_id).all()
+    habit_events = service.get_habit_events(session, habit).all()
 
     # Run analytics
+    import analytics
     average = analytics.get_calculate_avg(habit_events)
     print(f"In average you did {average} {habit.unit} per practise")
 
@@ -132,33 +138,22 @@ def longest_streak_int():
     except exception_inputs:
         return
 
-    habit_events = session.query(models.HabitEvent). \
-        order_by(models.HabitEvent.datetime_solved).filter(
-        models.HabitEvent.habit_id == habit_id).all()
-
-    # prepare data for analytics
-    streaks = ""
-    for event in habit_events:
-        streaks = streaks + str(event.status)
-
     # Run analytics
-    longest_streak = analytics.get_lstreaks_single(streaks)
+    longest_streak = get_longest_streak_for_habit(int(habit_id))
     print(f"Longest streak {longest_streak}")
 
 
 def habit_scheduler_list():
-    """ Get longest streak for all habits """
-
-    # Get all habits and habit_events
-    habits = session.query(models.Habit).filter(models.Habit.enabled).all()
+    """ Get the habits scheduled on a weekday """
     try:
         week_input = ask("Please input the weekday-number that you "
                          "want to check for habits", "^([0-6])$")
     except exception_inputs:
         return
 
-    # Call the analytics function
-    habits_weekday = analytics.get_habits_weekday(habits, int(week_input))
+    # only the habits due on the weekday are read, from its index
+    habits_weekday = service.get_scheduled(session, int(week_input),
+                                           current_user).all()
     print("\tScheduled on this day\n\tID\tName\tDays")
     for hab in habits_weekday:
         print_habit_row_weekly(hab)
@@ -167,18 +162,17 @@ def habit_scheduler_list():
 def longest_streak_all_int():
     """ Get longest streak for all habits """
 
-    # Get all habits and habit_events
-    habits = session.query(models.Habit).filter(models.Habit.enabled).all()
-    habit_events = session.query(models.HabitEvent).order_by(
-        models.HabitEvent.datetime_solved).filter().all()
-
-    # Call the analytics
-    habits_with_streaks = analytics.get_lstreaks_all(habits, habit_events)
+    # Get all habits and their longest streaks
+    habits = service.get_habits(session, current_user).filter(
+        models.Habit.enabled).all()
+    habits_with_streaks = service.get_longest_streaks(
+        session, [hab.habit_id for hab in habits], user_id=current_user)
 
     print("Longest streaks of all habits")
     print("\tID\tName\tStreak")
-    for item in habits_with_streaks:
-        print(f"\t{item.habit_id}\t{item.name}\t{habits_with_streaks[item]}")
+    for item in habits:
+        print(f"\t{item.habit_id}\t{item.name}"
+              f"\t{habits_with_streaks[item.habit_id]}")
 
 
 # Interactive helper
@@ -205,42 +199,16 @@ def cat_delete_int():
 
 def habit_today():
     """" print today's habits """
-    habits = session.query(models.Habit, models.HabitCategory).filter(
-        models.Habit.weekday != 0,
-        models.Habit.enabled).join(
-        models.HabitCategory,
-        models.Habit.cat_id == models.HabitCategory.cat_id,
-        isouter=True)
-
-    now = datetime.date.today()
+    wait_for_persistence()
     print("\tToday's list")
     print("\tID\tHabit name\tStreak\tCategory")
-    for row in habits:
-        hab = row[0]
-        cat = row[1]
-        if hab.due_today():
-            if hab.is_weekly():
-                # for a weekly habit, try to get an event
-                # for start and end of the week
-                weekday_today = datetime.datetime.today().weekday()
-                today = datetime.datetime.today()
-                sweek = (today - datetime.timedelta(days=weekday_today % 7)).date()
-                eweek = (today - datetime.timedelta(days=weekday_today - 6 % 7)).date()
-
-                habit_events = session.query(models.HabitEvent).filter(
-                    models.HabitEvent.habit_id == hab.habit_id,
-                    models.HabitEvent.datetime_solved >= str(sweek),
-                    models.HabitEvent.datetime_solved <= str(eweek)).all()
-            else:
-                habit_events = session.query(models.HabitEvent).filter(
-                    models.HabitEvent.habit_id == hab.habit_id,
-                    models.HabitEvent.datetime_solved == now).all()
-            try:
-                habit_event = habit_events[0]
-                print(habit_event.get_status(), end="")
-            except IndexError:
-                print("Open", end="")
-            print_habit_row_simple(hab, cat)
+    for hab, habit_event, cat in service.get_today(
+            session, datetime.date.today(), current_user):
+        if habit_event is not None:
+            print(habit_event.get_status(), end="")
+        else:
+            print("Open", end="")
+        print_habit_row_simple(hab, cat)
 
 
 def print_habit_row_status(hab):
@@ -279,23 +247,23 @@ def print_habit_row_weekly(hab):
     print(end=")\n")
 
 
-def print_habit_row(hab):
+def print_habit_row(hab, longest_streak=0):
     """" print one habit record """
 
-    # print habits name and identification
-    print(f"\t{hab.habit_id}\t{hab.name}\t{hab.enabled}\t", end=" ")
-
     if hab.condition != "":
-        # print the condition function
-        print(f"({hab.condition},{hab.quota} "
-              f"{hab.unit})")
+        # the condition function
+        condition = f"({hab.condition},{hab.quota} {hab.unit})"
     else:
-        # print latest streak
-        print("Check off only")
+        condition = "Check off only"
+
+    # print habits name and identification, condition and longest streak
+    print(f"\t{hab.habit_id}\t{hab.name}\t{hab.enabled}\t"
+          f" {condition}\t{longest_streak}")
 
 
 def resolve_habit_event(habit, event):
-    """ Resolve a habit with an existing event """
+    """ Resolve a habit with an existing event, habit may be the
+    cached HabitInfo """
 
     # Does the habit have a condition? Then run the condition dialog
     if habit.needs_satisfaction():
@@ -312,9 +280,8 @@ def resolve_habit_event(habit, event):
             session.rollback()
             return
 
-        status = habit.satisfied(int(user_quota))
-        event.set_quota(int(user_quota))
-        event.set_status(status)
+        service.resolve_event(session, get_habit_record(habit), event,
+                              quota=int(user_quota))
     else:
         try:
             question = ask(f"Did you do {habit.name} on "
@@ -322,11 +289,8 @@ def resolve_habit_event(habit, event):
         except exception_inputs:
             session.rollback()
             return
-        if question == "y":
-            event.set_status_success()
-        else:
-            event.set_status_fail()
-        event.set_quota(0)
+        service.resolve_event(session, get_habit_record(habit), event,
+                              done=question == "y")
 
     # Check status
     if event.get_status() == "Done":
@@ -334,11 +298,6 @@ def resolve_habit_event(habit, event):
     else:
         print("Oh well, seems you did not reach the target!")
 
-    # Set Quota, will be set to 0 for non condition-tracking habits
-    eday = datetime.datetime.strptime(
-        event.datetime_solved, "%Y-%m-%d").date()
-    event.set_weekday(eday.weekday())
-
     # Save HabitEvent?
     try:
         save = ask(f"Mark this state - {event.get_status()} - for the "
@@ -348,12 +307,17 @@ def resolve_habit_event(habit, event):
         return
 
     if save == "y":
-        session.add(event)
         session.commit()
     else:
         session.rollback()
 
 
+def get_habit_record(habit):
+    """ Returns the mapped Habit of a HabitInfo, that is changed with the
+    streaks. A Habit inside the session is returned as it is """
+    return service.get_habit(session, habit.habit_id, habit.user_id)
+
+
 def check_open_events(habit_id):
     """
     Checks a habit for open events (missed trials)
@@ -361,11 +325,9 @@ def check_open_events(habit_id):
     """
 
     # Pull the habit and pending / open events
-    # events with status == 0
-    habit = session.query(models.Habit).get(habit_id)
-    events = session.query(models.HabitEvent).filter(
-        models.HabitEvent.habit_id == habit_id,
-        models.HabitEvent.status == 0).all()
+    # events with status == 0, also the derived ones of sparse storage
+    habit = lookup_cache.habit(session, habit_id, current_user)
+    events = service.get_open_events(session, get_habit_record(habit))
 
     # If we have some open events, print them
     if len(events) > 0:
@@ -374,14 +336,72 @@ def check_open_events(habit_id):
         print("No open events anymore, all events are marked as final.")
         return
 
+    # several open events can be resolved at once
+    if len(events) > 1:
+        try:
+            question = ask("Resolve (a)ll at once, a date (r)ange at once "
+                           "or (o)ne by one?", r"^(a|r|o)$")
+        except exception_inputs:
+            return
+        if question != "o":
+            resolve_habit_events(habit, question == "r")
+            return
+
     # loop open events and give the user a chance to resolve them
     # event by event
     for event in events:
-        print(f"Resolving event {event.event_id} on {event.datetime_solved}")
+        print(f"Resolving event {event.event_id or '-'} "
+              f"on {event.datetime_solved}")
         # Call resolver
         resolve_habit_event(habit, event)
 
 
+def resolve_habit_events(habit, with_range=False):
+    """ Resolves the open events of a habit, all or those inside a date
+    range, with one answer and a single commit after the confirmation.
+    habit may be the cached HabitInfo """
+    start = end = None
+    try:
+        if with_range:
+            start = ask_date("Resolve events solved from YYYY-MM-DD")
+            end = ask_date("Resolve events solved until YYYY-MM-DD")
+
+        # one quota or answer for all events
+        quota, done = 0, True
+        if habit.needs_satisfaction():
+            print(habit.get_satisfaction())
+            quota = ask(f"Please input the quota for {habit.unit}, that "
+                        f"you have reached on all these days, n for abort",
+                        r"(\d{1,8}|n)")
+            if quota == "n":
+                return
+        else:
+            done = ask(f"Did you do {habit.name} on all these days?",
+                       r"(y|n)") == "y"
+    except exception_inputs:
+        return
+
+    count = service.resolve_events(session, get_habit_record(habit),
+                                   start=start, end=end, quota=quota,
+                                   done=done)
+    if not count:
+        print("No open events to resolve.")
+        return
+
+    # Save the HabitEvents?
+    try:
+        save = ask(f"Mark these {count} events as final?", r"(y|n)")
+    except exception_inputs:
+        session.rollback()
+        return
+
+    if save == "y":
+        session.commit()
+        print(f"Resolved {count} events.")
+    else:
+        session.rollback()
+
+
 def habit_toggle_status():
     """ Toggles en/disable for a habit  """
 
@@ -393,25 +413,22 @@ def habit_toggle_status():
         return
 
     # Get that single habit
-    habit = session.query(models.Habit).get(question)
+    habit = service.get_habit(session, question, current_user)
 
     # If the habit is not found, we return
     if habit is None:
         print("This habit does not exist.")
         return
 
-    # Need adjust the update date, so future open event calls from
-    # persistence() will work, else persistence() will add events from the past
-    habit.set_updated(datetime.date.today())
-    if habit.enabled:
-        habit.disable()
-        print(f"Disabled {habit.name}")
-    else:
-        habit.enable()
+    # the update date is adjusted, else persistence() would add the
+    # events of the days the habit was disabled
+    if service.toggle_habit(session, habit):
         print(f"Enabled {habit.name}")
+    else:
+        print(f"Disabled {habit.name}")
 
-    session.add(habit)
     session.commit()
+    lookup_cache.invalidate_habit(habit.habit_id)
 
 
 # Check off habit
@@ -426,7 +443,7 @@ def habit_info():
         return
 
     # Try to get a habit
-    habit = session.query(models.Habit).get(habit_id)
+    habit = service.get_habit(session, habit_id, current_user)
     # No habit, no cry ...
     if habit is None:
         return
@@ -451,20 +468,14 @@ def habit_info():
             print(f"{calendar.day_abbr[i]}", end=" ")
     print(end="\n")
 
-    # Get events with this particular habit id
-    events = session.query(models.HabitEvent).filter(
-        models.HabitEvent.habit_id == habit_id).all()
-
-    print("\tHabit Events\n\tEvent\tStatus\tQuota\tSolved\tWeekday")
-    for event in events:
-        print_habitevent_row(event)
-        print()
+    # Page through the events with this particular habit id
+    page_events(habit_id=habit.habit_id)
 
 
 def print_habitevent_row(event):
     """ prints a habitevent row """
 
-    print(f"\t{event.event_id}\t"
+    print(f"\t{event.event_id or '-'}\t"
           f"{event.get_status()}\t{event.quota}"
           f"\t{event.datetime_solved}"
           f"\t{calendar.day_abbr[event.weekday]}", end="")
@@ -484,8 +495,11 @@ def habit_checkoff():
     except exception_inputs:
         return
 
-    # Try to get the habit from the db layer
-    habit = session.query(models.Habit).get(habit_id)
+    # Missed events of this habit need to be caught first
+    wait_for_persistence(int(habit_id))
+
+    # Try to get the habit from the cache or the db layer
+    habit = lookup_cache.habit(session, habit_id, current_user)
 
     # No habit, no cry ...
     if habit is None:
@@ -497,43 +511,19 @@ def habit_checkoff():
     if not habit.is_weekly() and not habit.due_today():
         # Lets check for any other open event
         check_open_events(habit.habit_id)
-        # Recalculate streaks if necessary
-        recalculate_streak(session, habit.habit_id)
         # exit early, nothing to do
         return
 
     # At this point, left are weekly habit
     # and daily habits, that are due
 
-    # For a daily habit, that is now due heck if was checked off today
-    if not habit.is_weekly():
-        habit_events = session.query(models.HabitEvent).filter(
-            models.HabitEvent.habit_id == habit_id,
-            models.HabitEvent.datetime_solved == now).all()
-    # For a weekly habit, we need to generate the current week
-    # and then check for an open event in this time period
-    elif habit.is_weekly():
-        weekday_today = datetime.datetime.today().weekday()
-        today = datetime.datetime.today()
-        sweek = (today - datetime.timedelta(days=weekday_today % 7)).date()
-        eweek = (today - datetime.timedelta(days=weekday_today - 6 % 7)).date()
-
-        # Try to pull the events
-        habit_events = session.query(models.HabitEvent).filter(
-            models.HabitEvent.habit_id == habit.habit_id,
-            models.HabitEvent.datetime_solved >= str(sweek),
-            models.HabitEvent.datetime_solved <= str(eweek)).all()
-
     # Is there already an event stored for this habit for today,
     # that is open and need be resolved?
-    if len(habit_events) > 0:
-        habit_event = habit_events[0]
+    habit_event = service.get_checkoff_event(session, habit, now)
+    if habit_event is not None:
         print(f"Changes will update the current event "
               f"{habit_event.event_id}  with status "
               f"{habit_event.get_status()}.")
-    else:
-        # Ok, then we need to create a new habit event
-        habit_event = None
 
     # Create new base habit event with the current datetime
     # or update current event
@@ -544,47 +534,123 @@ def habit_checkoff():
 
     # Lets check for any other open event
     check_open_events(habit.habit_id)
-    recalculate_streak(session, habit.habit_id)
 
 
 # Event List
 def event_list():
     """" prints all recent events """
+    page_events()
+
+
+def page_events(habit_id=None):
+    """ Prints events page by page, the user can move forward and
+    backward or filter by date range and status """
+    filters = {"habit_id": habit_id, "user_id": current_user}
+    page = service.get_event_page(session, **filters)
+
+    while True:
+        print_event_page(page, with_habit=habit_id is None)
+
+        try:
+            question = ask("(n)ext page, (p)revious page, (f)ilter "
+                           "or (q)uit", r"^(n|p|f|q)$")
+        except exception_inputs:
+            return
+
+        if question == "q":
+            return
+        if question == "f":
+            try:
+                filters.update(ask_event_filters())
+            except exception_inputs:
+                continue
+            page = service.get_event_page(session, **filters)
+            continue
+
+        if question == "n" and page:
+            neighbour = service.get_event_page(
+                session, after=service.event_key(page[-1][1]), **filters)
+        elif question == "p" and page:
+            neighbour = service.get_event_page(
+                session, before=service.event_key(page[0][1]), **filters)
+        else:
+            neighbour = []
+
+        if neighbour:
+            page = neighbour
+        else:
+            print("No more events in this direction.")
+
+
+def ask_date(text, optional=False):
+    """ Asks for a date like 2022-01-31, until it is a valid one. With
+    optional, an "a" is answered with None """
+    validation = r"^(\d{4}-\d{1,2}-\d{1,2}|a)$" if optional \
+        else r"^\d{4}-\d{1,2}-\d{1,2}$"
+    while True:
+        answer = ask(text, validation)
+        if answer == "a":
+            return None
+        try:
+            return models.to_date(answer)
+        except ValueError:
+            print(f"{answer} is not a valid date.")
+
+
+def ask_event_filters():
+    """ Asks for a date range and a status to filter events,
+    an "a" removes a filter """
+    start = ask_date("Show events solved from YYYY-MM-DD or (a)ll", True)
+    end = ask_date("Show events solved until YYYY-MM-DD or (a)ll", True)
+    status = ask("Show events with status 0 (pending), 1 (done), "
+                 "2 (failed) or (a)ll", r"^[012a]$")
+
+    return {"start": start, "end": end,
+            "status": int(status) if status != "a" else None}
+
+
+def print_event_page(page, with_habit=True):
+    """ prints a page of (habit, event) tuples """
+    if with_habit:
+        print("\tHabit Events\n\tEvent\tStatus\tQuota\tSolved\tWeekday\tHabit")
+    else:
+        print("\tHabit Events\n\tEvent\tStatus\tQuota\tSolved\tWeekday")
 
-    print("\tHabit Events\n\tEvent\tStatus\tQuota\tSolved\tWeekday\tHabit")
-    results = session.query(models.Habit, models.HabitEvent). \
-        join(models.HabitEvent).filter().all()
-    for row in results:
-        print_habitevent_row(row.HabitEvent)
-        print(f"\t{row.Habit.name}({row.HabitEvent.habit_id})", end="\n")
+    for hab, event in page:
+        print_habitevent_row(event)
+        if with_habit:
+            print(f"\t{hab.name}({event.habit_id})", end="")
+        print()
 
 
 # Habit List
 def habit_list():
     """ Prints out a list of all habits """
 
-    habits = session.query(models.Habit).filter().all()
-    print("\tAll habits\n\tID\tName\tEnabled\tCondition")
+    habits = service.get_habits(session, current_user).all()
+    longest_streaks = service.get_longest_streaks(
+        session, [hab.habit_id for hab in habits], user_id=current_user)
+    print("\tAll habits\n\tID\tName\tEnabled\tCondition\tLongest")
 
     for hab in habits:
-        print_habit_row(hab)
+        print_habit_row(hab, longest_streaks[hab.habit_id])
 
 
 # Habit streak list
 def habit_streak_list():
     """ Prints out a list of all habits """
-    habits = session.query(models.Habit).filter().all()
     print("\tStreak list\n\tCurrent\tLongest\tName")
-    for hab in habits:
-        print(f"\t{hab.latest_streak}"
-              f"\t{get_longest_streak_for_habit(hab.habit_id)}"
+    for hab, streaks in service.get_streak_list(session,
+                                                user_id=current_user):
+        print(f"\t{streaks.current}"
+              f"\t{streaks.longest}"
               f"\t{hab.name}({hab.habit_id})")
 
 
 # Cat list
 def cat_list():
     """ Prints out a list of all categories """
-    cats = session.query(models.HabitCategory).filter().all()
+    cats = service.get_categories(session, current_user).all()
     print("\tAll categories\n\tID\t\tName")
     for cat in cats:
         print(f"\t{cat.cat_id}\t\t{cat.cat_name}")
@@ -599,7 +665,7 @@ def habit_modify():
     except exception_inputs:
         return
 
-    habit = session.query(models.Habit).get(hab_id)
+    habit = service.get_habit(session, hab_id, current_user)
     if habit is None:
         return
 
@@ -621,9 +687,10 @@ def habit_modify():
             session.rollback()
             return
 
-        cat = session.query(models.HabitCategory).get(cat_id)
+        cat = lookup_cache.category(session, cat_id, current_user)
         if cat is not None:
-            habit.cat_id = question
+            # the rollups of both categories change
+            service.set_category(session, habit, cat.cat_id)
 
     print(habit)
     try:
@@ -636,6 +703,7 @@ def habit_modify():
     if save == "y":
         session.add(habit)
         session.commit()
+        lookup_cache.invalidate_habit(habit.habit_id)
     else:
         session.rollback()
 
@@ -650,7 +718,7 @@ def cat_modify():
     except exception_inputs:
         return
 
-    cat = session.query(models.HabitCategory).get(cat_id)
+    cat = service.get_category(session, cat_id, current_user)
     if cat is None:
         return
 
@@ -666,6 +734,7 @@ def cat_modify():
     # And commit the category back to the database
     session.add(cat)
     session.commit()
+    lookup_cache.invalidate_category(cat.cat_id)
 
 
 def cat_create():
@@ -681,7 +750,7 @@ def cat_create():
 
     # create a new habit object by using
     # the sqlalchemy constructor with keywords
-    cat = models.HabitCategory(**keyword_arguments)
+    cat = models.HabitCategory(user_id=current_user, **keyword_arguments)
 
     # Commit / create
     session.add(cat)
@@ -693,9 +762,10 @@ def habitevent_create_mod_base(habit, now, habit_event):
 
     # Create a new instance or use existing habit_event
     if habit_event is None:
-        habit_event = models.HabitEvent(habit_id=habit.habit_id,
-                                        datetime=str(now))
-        habit_event.set_solved(str(now))
+        habit_event = models.HabitEvent(user_id=habit.user_id,
+                                        habit_id=habit.habit_id,
+                                        datetime=now)
+        habit_event.set_solved(now)
 
     # Call resolver
     resolve_habit_event(habit, habit_event)
@@ -724,7 +794,7 @@ def habit_create_base():
 
     # create a new habit object by using
     # the sqlalchemy constructor with keywords
-    hab = models.Habit(**keyword_arguments)
+    hab = models.Habit(user_id=current_user, **keyword_arguments)
 
     print("Now let's find the appropriate days of the week for the habit in "
           "your calendar.")
@@ -795,7 +865,8 @@ def habit_create():
                 return
 
             # Try to search for a category
-            habit_category = session.query(models.HabitCategory).get(cat_id)
+            habit_category = lookup_cache.category(session, cat_id,
+                                                   current_user)
             if habit_category is not None:
                 hab.cat_id = cat_id
                 satisfied = True
@@ -822,48 +893,10 @@ def habit_create():
     session.commit()
 
 
-def recalculate_streak(sqlsession, habit_id):
-    """ recalculates streak of a habit by evaluating events """
-    habit = sqlsession.query(models.Habit).get(habit_id)
-    # pull all events
-    habit_events = sqlsession.query(models.HabitEvent). \
-        order_by(models.HabitEvent.datetime_solved).filter(
-        models.HabitEvent.habit_id == habit_id).all()
-
-    streak = 0
-    for event in habit_events:
-        status = event.get_status()
-        if status in ("Failed", "Pending"):
-            streak = 0
-        else:
-            streak += 1
-
-    habit.update_streak(streak)
-    sqlsession.commit()
-
-
 def get_longest_streak_for_habit(habit_id):
     """ get longest streak of a habit by evaluating events """
-
-    # pull all events
-    habit_events = session.query(models.HabitEvent). \
-        order_by(models.HabitEvent.datetime_solved).filter(
-        models.HabitEvent.habit_id == habit_id).all()
-
-    # set starting streaks all to 0
-    streak = 0
-    longest_streak = 0
-    for event in habit_events:
-        status = event.get_status()
-        if status in ("Failed", "Pending"):
-            streak = 0
-        else:
-            streak += 1
-        # only if streak is larger that the longest ever, do a replacement
-        if streak > longest_streak:
-            longest_streak = streak
-
-    return longest_streak
+    return service.get_longest_streaks(
+        session, [habit_id], user_id=current_user)[habit_id]
 
 
 def persistence():
@@ -872,143 +905,73 @@ def persistence():
         that missing events from Monday till at least Thursday are being
         placed in the habit event queue as missing
 
+        Per habit, the existing events are pulled with one query,
+        the missing events are computed in memory and inserted in bulk.
+        The habits are committed in chunks, a run that was interrupted
+        goes on with the habits left, a complete run is only checked.
+
         Returns a list of events generated, so called
         startup-messages
     """
     startup_messages = []
-    today = datetime.datetime.today().date()
-
-    # Get all weekly habits
-    habits = session.query(models.Habit).filter(models.Habit.weekday == 128,
-                                                models.Habit.enabled).all()
-
-    # Weekly habits calculator
-    for hab in habits:
-        # Just triple check :-)
-        if not hab.is_weekly():
-            continue
-
-        need_calc = False
-        # Get start date
-        start = datetime.datetime.strptime(hab.updated, "%Y-%m-%d").date()
-        # calculate s_week (start day of week)
-        # and e_week (end day of a week)
-        # relative from updated column
-        s_week = start - datetime.timedelta(days=start.weekday() % 7)
-        e_week = start - datetime.timedelta(days=start.weekday() - 6 % 7)
-        hab.set_updated(datetime.datetime.today().date())
-
-        # As long as the s_week is smaller the e_week
-        # and also the s_week is smaller than today,
-        # continue to look for missed events
-        while s_week < e_week and s_week < today:
-
-            # Get all habit events in this particular week
-            habit_events = session.query(models.HabitEvent).filter(
-                models.HabitEvent.habit_id == hab.habit_id,
-                models.HabitEvent.datetime_solved >= str(s_week),
-                models.HabitEvent.datetime_solved <= str(e_week)).all()
-
-            # No event? Then add a missing event
-            # IF today is not the start of the week
-            if len(habit_events) == 0 and s_week != today:
-                habit_event = models.HabitEvent(habit_id=hab.habit_id,
-                                                datetime=start,
-                                                datetime_solved=s_week,
-                                                weekday=start.weekday())
-                # Add object to session and commit
-                session.add(habit_event)
-                session.commit()
-                # add Message to startup buffer
-                startup_messages.append(f"You missed {hab.name} "
-                                        f"from {s_week} to {e_week},"
-                                        f"please check(o)ff {hab.habit_id}")
-                need_calc = True
-
-            # Update habit to reflect new end date
-            session.add(hab)
-            session.commit()
-
-            # shift start for at least 7 days
-            s_week = s_week + datetime.timedelta(days=7)
-            # recalculate end_of_the_week for next loop step
-            e_week = s_week - datetime.timedelta(days=start.weekday() - 6 % 7)
-
-        # recalculate habit
-        if need_calc:
-            recalculate_streak(session, hab.habit_id)
-
-    # Daily habits calculator
-    # Get all enabled habits
-    habits = session.query(models.Habit).filter(models.Habit.weekday != 0,
-                                                models.Habit.weekday != 128,
-                                                models.Habit.enabled).all()
-    for hab in habits:
-        # Just double check :-)
-        if hab.is_weekly():
-            continue
-
-        need_calc = False
-        start = datetime.datetime.strptime(hab.updated, "%Y-%m-%d").date()
-        end = datetime.datetime.today().date()
-        hab.set_updated(end)
-
-        while start < end:
-            # if the habit is not to be done on this weekday, ignore that day
-            if not hab.due_weekday(start.weekday()):
-                start = start + datetime.timedelta(days=1)
-                continue
-
-            # Check all habits in an easy loop
-            # 1.) check if there is a habit event for that specific day
-            # 2.) if not, create it
-            # so, pull all events
-            habit_events = session.query(models.HabitEvent).filter(
-                models.HabitEvent.habit_id == hab.habit_id,
-                models.HabitEvent.datetime_solved == start).all()
-
-            # check size of habit events vs today's date
-            if len(habit_events) == 0 and start != today:
-                habit_event = models.HabitEvent(habit_id=hab.habit_id,
-                                                datetime=start,
-                                                datetime_solved=start,
-                                                weekday=start.weekday())
-                # Add object to session and commit
-                session.add(habit_event)
-                session.commit()
-                # add Message to startup buffer
-                startup_messages.append(f"You missed {hab.name} "
-                                        f"on {start}, please run check(o)ff"
-                                        f" {hab.habit_id}")
-                need_calc = True
-
-            # Update habit to reflect new end date
-            session.add(hab)
-            session.commit()
-
-            # continue adding a day to the start
-            # to advance loop to the next day
-            start = start + datetime.timedelta(days=1)
-
-        # recalculate habit, when changes were detected
-        if need_calc:
-            recalculate_streak(session, hab.habit_id)
-
+    for chunk in service.run_persistence(
+            session, datetime.datetime.today().date(), current_user):
+        for _, messages in chunk:
+            startup_messages.extend(messages)
     return startup_messages
 
 
-# Create engine & session
-if __name__ == "__main__":
-    # Create connection to sqlite database
-    engine = create_engine('sqlite:///habit.sqlite3', echo=False)
-    Session = sessionmaker(bind=engine)
-
-    # Create all missing tables if necessary
-    base.Base.metadata.create_all(engine)
-    session = Session()
+def wait_for_persistence(habit_id=None):
+    """ Waits until the background persistence has caught the missed
+    events of a habit, or of all habits without a habit id """
+    if persistence_worker is None:
+        return
 
-    # Check open and missed events
-    startup = persistence()
+    persistence_worker.wait_for(habit_id)
+    # Forget the loaded objects, the worker has changed them
+    session.expire_all()
+
+
+def open_database(path=None, preset=None):
+    """ Creates the connection to the sqlite database, creates all
+    missing tables and upgrades existing databases. A database with the
+    current schema version is used as it is. Path and preset default to
+    the database settings. Returns a session """
+    engine = database.get_engine(path, preset)
+    with engine.connect() as connection:
+        version = connection.exec_driver_sql("PRAGMA user_version").scalar()
+    if version == database.SCHEMA_VERSION:
+        return sessionmaker(bind=engine)()
+
+    import migrations
+    # a read-only preset can not create or upgrade the tables, this is
+    # done with a writable engine first
+    writable = database.get_engine(path, preset, query_only=0) \
+        if engine.settings.get("query_only") else engine
+    base.Base.metadata.create_all(writable)
+    migrations.migrate(writable)
+    if writable is not engine:
+        writable.dispose()
+    return sessionmaker(bind=engine)()
+
+
+def run_menu():
+    """ Runs the interactive menu, while the missed events are
+    caught in the background """
+    global persistence_worker
+    from worker import PersistenceWorker
+
+    # Check open and missed events with an own session, the startup
+    # messages are delivered into the menu, when they are ready. A menu
+    # left open over midnight catches the events of the new day
+    persistence_worker = PersistenceWorker(
+        sessionmaker(bind=session.bind),
+        lambda sqlsession, today: service.run_persistence(
+            sqlsession, today, current_user), repeat=True,
+        pending=lambda sqlsession, today: service.get_catch_up_ids(
+            sqlsession, today, current_user))
+    persistence_worker.start()
+    startup = persistence_worker.messages
 
     # init the menu
     clm = CliMenu(
@@ -1063,5 +1026,297 @@ if __name__ == "__main__":
 
     # Start the menu loop
     clm.run(startup)
-    # Add close the stargate
-    session.close()
+    # Let the persistence finish its work
+    persistence_worker.stop()
+    persistence_worker.join()
+
+
+def command_today(args):
+    """ today: prints today's habits """
+    if not args.json:
+        habit_today()
+        return 0
+
+    return [{"habit_id": hab.habit_id, "name": hab.name,
+             "status": event.get_status() if event else "Open",
+             "streak": hab.latest_streak,
+             "category": cat.cat_name if cat else None}
+            for hab, event, cat in habit_service.today()]
+
+
+def command_habits(args):
+    """ habits: prints all habits """
+    if not args.json:
+        habit_list()
+        return 0
+
+    return [{"habit_id": hab.habit_id, "name": hab.name,
+             "enabled": hab.enabled, "condition": hab.condition,
+             "quota": hab.quota, "unit": hab.unit, "weekday": hab.weekday}
+            for hab in habit_service.habits()]
+
+
+def command_streaks(args):
+    """ streaks: prints current and longest streak of all habits """
+    if not args.json:
+        habit_streak_list()
+        return 0
+
+    return [{"habit_id": hab.habit_id, "name": hab.name,
+             "current": streaks.current, "longest": streaks.longest}
+            for hab, streaks in habit_service.streaks()]
+
+
+def command_checkoff(args):
+    """ checkoff: checks off a habit for today """
+    try:
+        habit, event = habit_service.checkoff(
+            args.habit_id, quota=args.quota, done=not args.failed)
+    except service.HabitError as error:
+        print(error, file=sys.stderr)
+        return 1
+
+    if not args.json:
+        print(f"{habit.name} {event.get_status()} on {event.datetime_solved}")
+        return 0
+
+    return {"event_id": event.event_id, "habit_id": habit.habit_id,
+            "status": event.get_status(), "quota": event.quota,
+            "solved": event.datetime_solved.isoformat(),
+            "streak": habit.latest_streak}
+
+
+def command_resolve(args):
+    """ resolve: resolves the open events of a habit at once """
+    try:
+        habit, count = habit_service.resolve_events(
+            args.habit_id, args.events, args.start, args.end,
+            quota=args.quota,
+            done=not args.failed)
+    except service.HabitError as error:
+        print(error, file=sys.stderr)
+        return 1
+
+    if not args.json:
+        print(f"{habit.name}: {count} events resolved")
+        return 0
+
+    return {"habit_id": habit.habit_id, "resolved": count,
+            "streak": habit.latest_streak}
+
+
+def command_persist(args):
+    """ persist: catches missed habit events """
+    messages = habit_service.persist()
+    if not args.json:
+        for msg in messages:
+            print(msg)
+        return 0
+    return messages
+
+
+def command_trend(args):
+    """ trend: prints the completion rate per day, week or month """
+    trend = habit_service.trend(args.period, args.habit, args.category,
+                                args.start)
+    if not args.json:
+        print("\tBucket\t\tEvents\tDone\tChange")
+        for row in trend:
+            change = "" if row.change is None else f"{row.change:+.0%}"
+            print(f"\t{row.bucket}\t{row.events}\t{row.completion:.0%}"
+                  f"\t{change}")
+        return 0
+
+    return [{"bucket": row.bucket.isoformat(), "events": row.events,
+             "completion": row.completion, "average": row.average,
+             "change": row.change} for row in trend]
+
+
+def command_rollups(args):
+    """ rollups: evaluates the rollup tables again from all events """
+    habit_service.rebuild_rollups()
+    print("rollups rebuilt.")
+    return 0
+
+
+def command_export(args):
+    """ export: writes all data into a CSV directory or JSON Lines file """
+    import transfer
+    counts = transfer.export_path(session.bind, args.path, args.format)
+    if not args.json:
+        for table, count in counts.items():
+            print(f"{table}\t{count} rows exported")
+        return 0
+    return counts
+
+
+def command_import(args):
+    """ import: reads data from a CSV directory or JSON Lines file """
+    import transfer
+    try:
+        counts = transfer.import_path(session.bind, args.path, args.format)
+    except (OSError, transfer.TransferError) as error:
+        print(f"Nothing imported, {error}", file=sys.stderr)
+        return 1
+    lookup_cache.clear()
+    if not args.json:
+        for table, count in counts.items():
+            print(f"{table}\t{count['inserted']} rows imported, "
+                  f"{count['skipped']} already stored")
+        return 0
+    return counts
+
+
+def command_serve(args):
+    """ serve: runs the JSON HTTP server """
+    import logging
+    import server
+    from worker import PersistenceWorker
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(threadName)s %(message)s")
+
+    # the server opens an own pooled engine on the same database
+    settings = session.bind.settings
+    httpd = server.create_server(settings["path"], settings["preset"],
+                                 args.host, args.port,
+                                 args.workers or server.WORKERS)
+    # the missed events of all users are caught after every midnight
+    persistence_worker = PersistenceWorker(
+        httpd.habit_service.session_factory,
+        lambda sqlsession, today: service.run_persistence(
+            sqlsession, today, None), repeat=True)
+    persistence_worker.start()
+    print(f"Serving haha-bits on http://{args.host}:{httpd.server_port}")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        persistence_worker.stop()
+        httpd.server_close()
+    return 0
+
+
+# Commands for the command line, the function and
+# if the command needs a persistence run before
+COMMANDS = {
+    "today": (command_today, False),
+    "habits": (command_habits, False),
+    "streaks": (command_streaks, False),
+    "checkoff": (command_checkoff, True),
+    "resolve": (command_resolve, True),
+    "persist": (command_persist, False),
+    "trend": (command_trend, False),
+    "rollups": (command_rollups, False),
+    "export": (command_export, False),
+    "import": (command_import, False),
+    "serve": (command_serve, True),
+}
+
+
+def day(value):
+    """ Converts a command line argument YYYY-MM-DD into a date, argparse
+    reports the ValueError of an impossible date """
+    return models.to_date(value)
+
+
+# Database presets of the commands, if not given by --preset
+COMMAND_PRESETS = {
+    "import": "bulk",
+}
+
+
+def main(argv=None):
+    """ Runs a single command from the command line, without a command
+    the interactive menu is started. Read-only commands skip the
+    persistence run. Returns the exit code """
+    global session, habit_service, current_user
+    import argparse
+    import rollups
+
+    parser = argparse.ArgumentParser(
+        prog="app.py", description="haha-bits, a small habit tracker")
+    parser.add_argument("--database",
+                        help="path of the SQLite database, "
+                             "default from the database settings")
+    parser.add_argument("--preset", choices=list(database.PRESETS),
+                        help="SQLite settings, import defaults to bulk")
+    parser.add_argument("--user", type=int, default=models.DEFAULT_USER,
+                        help="id of the user, whose habits are used")
+    commands = parser.add_subparsers(dest="command")
+    for name in ("today", "habits", "streaks", "persist"):
+        command = commands.add_parser(name, help=COMMANDS[name][0].__doc__)
+        command.add_argument("--json", action="store_true")
+    command = commands.add_parser("checkoff",
+                                  help=command_checkoff.__doc__)
+    command.add_argument("habit_id", type=int)
+    command.add_argument("--quota", type=int,
+                         help="reached quota for habits with a condition")
+    command.add_argument("--failed", action="store_true",
+                         help="mark the habit as not done")
+    command.add_argument("--json", action="store_true")
+    for name in ("export", "import"):
+        command = commands.add_parser(name, help=COMMANDS[name][0].__doc__)
+        command.add_argument("path", help="directory for csv, "
+                                          "file.jsonl for jsonl")
+        command.add_argument("--format", choices=("csv", "jsonl"),
+                             help="default by the path")
+        command.add_argument("--json", action="store_true")
+    command = commands.add_parser("resolve", help=command_resolve.__doc__)
+    command.add_argument("habit_id", type=int)
+    command.add_argument("--events", type=int, nargs="+",
+                         help="ids of the events, default all")
+    command.add_argument("--start", type=day, help="first day YYYY-MM-DD")
+    command.add_argument("--end", type=day, help="last day YYYY-MM-DD")
+    command.add_argument("--quota", type=int,
+                         help="reached quota for habits with a condition")
+    command.add_argument("--failed", action="store_true",
+                         help="mark the events as not done")
+    command.add_argument("--json", action="store_true")
+    command = commands.add_parser("trend", help=command_trend.__doc__)
+    command.add_argument("--period", choices=rollups.PERIODS,
+                         default="month")
+    command.add_argument("--habit", type=int, help="id of a single habit")
+    command.add_argument("--category", type=int, help="id of a category")
+    command.add_argument("--start", type=day, help="first day YYYY-MM-DD")
+    command.add_argument("--json", action="store_true")
+    commands.add_parser("rollups", help=command_rollups.__doc__)
+    command = commands.add_parser("serve", help=command_serve.__doc__)
+    command.add_argument("--host", default="127.0.0.1")
+    command.add_argument("--port", type=int, default=8080)
+    command.add_argument("--workers", type=int,
+                         help="worker threads and database connections, "
+                              "default of the server")
+    try:
+        args = parser.parse_args(argv)
+    except SystemExit as error:
+        # invalid arguments fail like the commands
+        return 1 if error.code == 2 else error.code
+
+    preset = args.preset or COMMAND_PRESETS.get(args.command)
+    session = open_database(args.database, preset)
+    current_user = args.user
+    habit_service = service.HabitService(
+        service.create_session_factory(session.bind), user_id=current_user)
+    try:
+        if args.command is None:
+            run_menu()
+            return 0
+
+        func, needs_persistence = COMMANDS[args.command]
+        if needs_persistence:
+            habit_service.persist()
+        result = func(args)
+        if isinstance(result, int):
+            return result
+
+        import json
+        print(json.dumps(result, indent=2))
+        return 0
+    finally:
+        # Add close the stargate
+        session.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
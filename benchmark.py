@@ -0,0 +1,618 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for haha-bits
+
+Generates a deterministic database with habits, categories and years of
+events and times the main scenarios on a fresh copy of it, reporting
+wall time, number of SQL statements and peak memory. Results can be
+stored as a baseline and compared with later runs. Run with
+
+    python3 benchmark.py
+    python3 benchmark.py --save bench_baseline.json
+    python3 benchmark.py --compare bench_baseline.json
+
+"""
+import argparse
+import contextlib
+import datetime
+import http.client
+import io
+import json
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+
+import analytics
+import app
+import base
+import database
+import eventstore
+import migrations
+import models
+import rollups
+import server
+import service
+
+# Number of habits and days away for the persistence benchmark
+HABITS = 20
+DAYS_AWAY = (1, 7, 30, 90, 365)
+
+
+def generate(sqlsession, habits=50, categories=5, years=2, success=0.7,
+             pending=0.02, days_away=3, seed=42, users=1):
+    """ Fills a database with generated habits and events.
+
+    The same arguments always give the same data. Habits are scheduled
+    on random weekdays or weekly, every scheduled day (or week) since the
+    creation gets an event, that is done with the probability success,
+    pending with the probability pending and failed otherwise. The habits
+    were updated days_away days ago, so persistence() has work to do.
+    With several users, every user gets the categories and habits and
+    events are dealt round robin, user 1 keeps the data of a single user.
+    """
+    rnd = random.Random(seed)
+    today = datetime.date.today()
+    created = today - datetime.timedelta(days=int(365 * years))
+    updated = today - datetime.timedelta(days=days_away)
+
+    cats = {user: [models.HabitCategory(user_id=user,
+                                        cat_name=f"Category {i}")
+                   for i in range(0, categories)]
+            for user in range(1, users + 1)}
+    for user_cats in cats.values():
+        sqlsession.add_all(user_cats)
+    sqlsession.flush()
+
+    habs = []
+    for i in range(0, habits * users):
+        user = 1 + i % users
+        hab = models.Habit(user_id=user, name=f"Habit {i // users}",
+                           enabled=True,
+                           cat_id=rnd.choice(cats[user]).cat_id
+                           if categories else 0)
+        # every fifth habit is weekly, the others have a random
+        # but non-empty set of weekdays
+        if rnd.random() < 0.2:
+            hab.set_weekly()
+        else:
+            hab.weekday = rnd.randint(1, 127)
+        # a third of the habits tracks a quota
+        if rnd.random() < 0.33:
+            hab.set_condition(rnd.choice(("eq", "lt", "gt")))
+            hab.set_quota(rnd.randint(1, 50), "units")
+        hab.created = created
+        hab.set_updated(updated)
+        habs.append(hab)
+    sqlsession.add_all(habs)
+    sqlsession.flush()
+
+    rows = []
+    for hab in habs:
+        day = created
+        while day < updated:
+            if hab.is_weekly():
+                # one event on a random day of every week
+                solved = day + datetime.timedelta(days=rnd.randint(0, 6))
+                day = day + datetime.timedelta(days=7)
+                if solved >= updated:
+                    continue
+            else:
+                solved = day
+                day = day + datetime.timedelta(days=1)
+                if not hab.due_weekday(solved.weekday()):
+                    continue
+
+            roll = rnd.random()
+            if roll < pending:
+                status, quota = 0, 0
+            elif hab.needs_satisfaction():
+                quota = max(0, hab.quota + rnd.randint(-3, 3))
+                status = hab.satisfied(quota)
+            else:
+                status, quota = (1 if roll < success else 2), 0
+            rows.append({"user_id": hab.user_id,
+                         "habit_id": hab.habit_id, "datetime": solved,
+                         "datetime_solved": solved,
+                         "weekday": solved.weekday(),
+                         "status": status, "quota": quota})
+    sqlsession.bulk_insert_mappings(models.HabitEvent, rows)
+    sqlsession.commit()
+
+    for hab in habs:
+        service.recalculate_streak(sqlsession, hab.habit_id, commit=False)
+    rollups.rebuild(sqlsession)
+    sqlsession.commit()
+
+    return len(rows)
+
+
+def open_database(path, preset="default"):
+    """ Creates or upgrades a database file and returns engine and session,
+    the SQLite defaults are used without a preset """
+    engine = database.get_engine(path, preset)
+    base.Base.metadata.create_all(engine)
+    migrations.migrate(engine)
+    return engine, sessionmaker(bind=engine)()
+
+
+@contextlib.contextmanager
+def scripted_answers(answer):
+    """ Replaces the interactive questions of app with answer(text) """
+    ask = app.ask
+    app.ask = lambda text, validation: answer(text)
+    try:
+        yield
+    finally:
+        app.ask = ask
+
+
+@contextlib.contextmanager
+def event_storage(storage):
+    """ Switches the event storage of service, e.g. to sparse """
+    previous = service.EVENT_STORAGE
+    service.EVENT_STORAGE = storage
+    try:
+        yield
+    finally:
+        service.EVENT_STORAGE = previous
+
+
+def measure(engine, func, trace=False):
+    """ Runs func and returns the wall time in seconds and the number of
+    SQL statements, or only the peak of traced memory in bytes when
+    trace is set, as tracing slows down the run """
+    statements = []
+
+    def count(*_):
+        statements.append(1)
+
+    event.listen(engine, "before_cursor_execute", count)
+    if trace:
+        tracemalloc.start()
+    begin = time.perf_counter()
+    try:
+        # keep the output of the menu functions out of the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            func()
+        elapsed = time.perf_counter() - begin
+        if trace:
+            return {"peak": tracemalloc.get_traced_memory()[1]}
+    finally:
+        if trace:
+            tracemalloc.stop()
+        event.remove(engine, "before_cursor_execute", count)
+
+    return {"seconds": elapsed, "queries": len(statements)}
+
+
+def scenario_persistence(sqlsession):
+    """ Backfill of the missed days since the last update """
+    app.persistence()
+
+
+def scenario_persistence_sparse(sqlsession):
+    """ Catch-up of the missed days in the sparse storage, only the
+    streaks are updated """
+    with event_storage("sparse"):
+        app.persistence()
+
+
+def scenario_habit_today(sqlsession):
+    """ Today's habit list """
+    app.habit_today()
+
+
+def scenario_habit_scheduled(sqlsession):
+    """ Habits due on Wednesday, read from the weekday index """
+    service.get_scheduled(sqlsession, 2, app.current_user).all()
+
+
+def scenario_habit_scheduled_scan(sqlsession):
+    """ Habits due on Wednesday, by testing all habits in Python """
+    analytics.get_habits_weekday(
+        service.get_habits(sqlsession, app.current_user).all(), 2)
+
+
+def scenario_habit_checkoff(sqlsession):
+    """ Checkoff of a habit due today, resolving its open events """
+    hab = service.get_today(sqlsession, datetime.date.today(),
+                            app.current_user)[0][0]
+
+    def answer(text):
+        if "id for the habit" in text:
+            return str(hab.habit_id)
+        if "quota" in text:
+            return str(hab.quota)
+        return "y"
+
+    with scripted_answers(answer):
+        app.habit_checkoff()
+
+
+def pending_habit(sqlsession):
+    """ Returns the habit of the current user with the most pending
+    events """
+    habit_id = sqlsession.query(models.HabitEvent.habit_id).filter(
+        models.HabitEvent.user_id == app.current_user,
+        models.HabitEvent.status == 0).group_by(
+        models.HabitEvent.habit_id).order_by(
+        sqlalchemy.func.count().desc()).limit(1).scalar()
+    return sqlsession.get(models.Habit, habit_id)
+
+
+def scenario_resolve_bulk(sqlsession):
+    """ All pending events of a habit resolved with one update """
+    hab = pending_habit(sqlsession)
+    service.resolve_events(sqlsession, hab, quota=hab.quota)
+    sqlsession.commit()
+
+
+def scenario_resolve_each(sqlsession):
+    """ All pending events of a habit resolved one by one, with a
+    commit per event like the dialog """
+    hab = pending_habit(sqlsession)
+    for event in sqlsession.query(models.HabitEvent).filter(
+            models.HabitEvent.user_id == hab.user_id,
+            models.HabitEvent.habit_id == hab.habit_id,
+            models.HabitEvent.status == 0).all():
+        service.resolve_event(sqlsession, hab, event, quota=hab.quota)
+        sqlsession.commit()
+
+
+def scenario_recalculate_streak(sqlsession):
+    """ Full rebuild of the streaks of every habit """
+    for (habit_id,) in sqlsession.query(models.Habit.habit_id).filter(
+            models.Habit.user_id == app.current_user).all():
+        service.recalculate_streak(sqlsession, habit_id, commit=False)
+    sqlsession.commit()
+
+
+def scenario_recalculate_streak_sparse(sqlsession):
+    """ Full rebuild of the streaks of every habit, with the missed days
+    derived like in the sparse storage """
+    with event_storage("sparse"):
+        scenario_recalculate_streak(sqlsession)
+
+
+def scenario_lstreaks_all(sqlsession):
+    """ analytics.get_lstreaks_all on all loaded habits and events """
+    habits = service.get_habits(sqlsession, app.current_user).filter(
+        models.Habit.enabled).all()
+    habit_events = sqlsession.query(models.HabitEvent).filter(
+        models.HabitEvent.user_id == app.current_user).order_by(
+        models.HabitEvent.datetime_solved).all()
+    analytics.get_lstreaks_all(habits, habit_events)
+
+
+def scenario_lstreaks_all_store(sqlsession):
+    """ analytics.get_lstreaks_all on all habits and the events loaded
+    into an EventStore instead of ORM objects """
+    habits = service.get_habits(sqlsession, app.current_user).filter(
+        models.Habit.enabled).all()
+    store = eventstore.EventStore.load(sqlsession.connection(),
+                                       user_id=app.current_user)
+    analytics.get_lstreaks_all(habits, store)
+
+
+def scenario_trend_events(sqlsession):
+    """ Monthly completion rates of all habits, grouped from the events """
+    month = rollups.bucket_sql("month", "datetime_solved")
+    sqlsession.execute(sqlalchemy.text(
+        f"SELECT {month} AS bucket, SUM(status = 1), COUNT(*) "
+        f"FROM HabitEvent WHERE user_id = :user_id GROUP BY bucket"),
+        {"user_id": app.current_user}).all()
+
+
+def scenario_trend_rollups(sqlsession):
+    """ Monthly completion rates of all habits, read from the rollups """
+    service.get_trend(sqlsession, "month", user_id=app.current_user)
+
+
+def scenario_calculate_avg(sqlsession):
+    """ analytics.get_calculate_avg for every habit with a condition """
+    habits = service.get_habits(sqlsession, app.current_user).filter(
+        models.Habit.condition != "").all()
+    for hab in habits:
+        analytics.get_calculate_avg(
+            service.get_habit_events(sqlsession, hab).all())
+
+
+def scenario_statistics_python(sqlsession):
+    """ Statistics of all habits with the pure Python analytics """
+    service.get_statistics(sqlsession, backend="python",
+                           user_id=app.current_user)
+
+
+def scenario_statistics_numpy(sqlsession):
+    """ Statistics of all habits with the NumPy backend, the same as
+    statistics_python without NumPy """
+    service.get_statistics(sqlsession, backend="numpy",
+                           user_id=app.current_user)
+
+
+SCENARIOS = {
+    "persistence": scenario_persistence,
+    "persistence_sparse": scenario_persistence_sparse,
+    "habit_today": scenario_habit_today,
+    "habit_scheduled": scenario_habit_scheduled,
+    "habit_scheduled_scan": scenario_habit_scheduled_scan,
+    "habit_checkoff": scenario_habit_checkoff,
+    "resolve_bulk": scenario_resolve_bulk,
+    "resolve_each": scenario_resolve_each,
+    "recalculate_streak": scenario_recalculate_streak,
+    "recalculate_streak_sparse": scenario_recalculate_streak_sparse,
+    "get_lstreaks_all": scenario_lstreaks_all,
+    "lstreaks_all_store": scenario_lstreaks_all_store,
+    "get_calculate_avg": scenario_calculate_avg,
+    "trend_events": scenario_trend_events,
+    "trend_rollups": scenario_trend_rollups,
+    "statistics_python": scenario_statistics_python,
+    "statistics_numpy": scenario_statistics_numpy,
+}
+
+
+def run_scenarios(names, preset="default", **generator):
+    """ Generates one database and runs every scenario on a fresh copy
+    of it with the database preset. Returns a dictionary with the
+    measurements per scenario """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, "generated.sqlite3")
+        _, sqlsession = open_database(source)
+        events = generate(sqlsession, **generator)
+        sqlsession.close()
+        print(f"Generated {events} events with {generator}")
+
+        for name in names:
+            # one run for time and queries, one for the memory peak
+            results[name] = {}
+            for trace in (False, True):
+                target = os.path.join(tmp, f"{name}-{trace}.sqlite3")
+                shutil.copy(source, target)
+                engine, app.session = open_database(target, preset)
+                results[name].update(measure(
+                    engine, lambda: SCENARIOS[name](app.session), trace))
+                app.session.close()
+                engine.dispose()
+
+    return results
+
+
+def print_results(results, baseline=None):
+    """ Prints the measurements, compared to a baseline if given """
+    print("\tScenario\t\tSeconds\tQueries\tPeak KiB\tvs. baseline")
+    for name, result in results.items():
+        line = (f"\t{name:<20}\t{result['seconds']:.4f}"
+                f"\t{result['queries']}\t{result['peak'] // 1024}")
+        if baseline and name in baseline:
+            before = baseline[name]["seconds"]
+            line += f"\t\t{(result['seconds'] - before) / before:+.0%}"
+        print(line)
+
+
+# Scenarios for the presets, the writing ones are
+# left out for the read-only presets
+PRESET_SCENARIOS = ("persistence", "habit_checkoff", "habit_today",
+                    "get_lstreaks_all")
+WRITING_SCENARIOS = ("persistence", "habit_checkoff")
+
+
+def bench_presets(presets=tuple(database.PRESETS), **generator):
+    """ Runs the checkoff, persistence and reading scenarios
+    for every database preset and prints the seconds """
+    seconds = {name: [] for name in PRESET_SCENARIOS}
+    for preset in presets:
+        names = [name for name in PRESET_SCENARIOS
+                 if name not in WRITING_SCENARIOS
+                 or not database.PRESETS[preset].get("query_only")]
+        results = run_scenarios(names, preset, **generator)
+        for name in PRESET_SCENARIOS:
+            seconds[name].append(f"{results[name]['seconds']:.4f}"
+                                 if name in results else "-")
+
+    print("\tScenario\t\t" + "\t".join(presets))
+    for name, values in seconds.items():
+        print(f"\t{name:<20}\t" + "\t".join(values))
+
+
+def load_paths(habit_ids, requests):
+    """ Returns the requests of a load test, a mix of reads
+    and checkoffs of the given habits """
+    rnd = random.Random(7)
+    paths = []
+    for i in range(0, requests):
+        roll = rnd.random()
+        if roll < 0.3:
+            paths.append(("GET", "/habits/today"))
+        elif roll < 0.6:
+            paths.append(("GET", f"/events?habit_id={rnd.choice(habit_ids)}"
+                                 f"&limit=20"))
+        elif roll < 0.75:
+            paths.append(("GET", "/analytics/streaks"))
+        elif roll < 0.85:
+            paths.append(("GET", f"/analytics/scheduled/{i % 7}"))
+        else:
+            paths.append(("POST", f"/habits/{rnd.choice(habit_ids)}"
+                                  f"/checkoff"))
+    return paths
+
+
+def bench_server(requests=2000, clients=8, workers=server.WORKERS,
+                 **generator):
+    """ Starts the HTTP server on a generated database and sends the
+    requests from several clients, the server closes the connection
+    after every answer. Prints requests per second and latencies per
+    endpoint """
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "server.sqlite3")
+        _, sqlsession = open_database(path)
+        generate(sqlsession, **generator)
+        # checkoffs are sent for the habits due today
+        habit_ids = [hab.habit_id for hab, _, _ in
+                     service.get_today(sqlsession, datetime.date.today())
+                     if not hab.needs_satisfaction()]
+        sqlsession.close()
+        if not habit_ids:
+            print("No habits without quota due today, nothing to send")
+            return
+
+        httpd = server.create_server(path, "interactive", port=0,
+                                     workers=workers)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+        paths = load_paths(habit_ids, requests)
+        latencies = {}
+        lock = threading.Lock()
+
+        def client(share):
+            connection = http.client.HTTPConnection("127.0.0.1",
+                                                    httpd.server_port)
+            for method, url in share:
+                begin = time.perf_counter()
+                connection.request(method, url)
+                response = connection.getresponse()
+                response.read()
+                elapsed = time.perf_counter() - begin
+                endpoint = method + " " + re.sub(r"/\d+", "/<n>",
+                                                 url.split("?")[0])
+                with lock:
+                    latencies.setdefault(endpoint, []).append(elapsed)
+                    if response.status != 200:
+                        latencies.setdefault("errors", []).append(elapsed)
+            connection.close()
+
+        senders = [threading.Thread(target=client, args=(paths[i::clients],))
+                   for i in range(0, clients)]
+        begin = time.perf_counter()
+        for sender in senders:
+            sender.start()
+        for sender in senders:
+            sender.join()
+        elapsed = time.perf_counter() - begin
+
+        httpd.shutdown()
+        httpd.server_close()
+
+    def percentile(values, fraction):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * fraction))]
+
+    print(f"{requests} requests from {clients} clients, "
+          f"{workers} workers: {requests / elapsed:.0f} requests/s")
+    print("\tEndpoint\t\t\tCount\tp50 ms\tp99 ms")
+    everything = [value for values in latencies.values() for value in values]
+    for name, values in sorted(latencies.items()) + [("all", everything)]:
+        print(f"\t{name:<30}\t{len(values)}"
+              f"\t{percentile(values, 0.5) * 1000:.1f}"
+              f"\t{percentile(values, 0.99) * 1000:.1f}")
+
+
+def setup_database(path, habits, days_away):
+    """ Creates a database with daily and weekly habits,
+    that were last updated days_away days ago """
+    _, sqlsession = open_database(path)
+
+    updated = datetime.date.today() - datetime.timedelta(days=days_away)
+    for i in range(0, habits):
+        hab = models.Habit(name=f"Habit {i}", enabled=True)
+        # every fourth habit is weekly, the others are
+        # scheduled on two days of the week
+        if i % 4 == 0:
+            hab.set_weekly()
+        else:
+            hab.add_day(i % 7)
+            hab.add_day((i + 3) % 7)
+        hab.set_updated(updated)
+        sqlsession.add(hab)
+    sqlsession.commit()
+
+    return sqlsession
+
+
+def bench_persistence(habits=HABITS, days_away=DAYS_AWAY):
+    """ Times persistence() on a database file for every
+    value in days_away and prints a small table """
+    print(f"persistence() with {habits} habits")
+    print("\tDays away\tEvents\tSeconds")
+    for days in days_away:
+        with tempfile.TemporaryDirectory() as tmp:
+            app.session = setup_database(os.path.join(tmp, "bench.sqlite3"),
+                                         habits, days)
+
+            begin = time.perf_counter()
+            messages = app.persistence()
+            elapsed = time.perf_counter() - begin
+
+            app.session.close()
+        print(f"\t{days}\t\t{len(messages)}\t{elapsed:.4f}")
+
+
+def main():
+    """ Parses the arguments and runs the benchmarks """
+    parser = argparse.ArgumentParser(description="haha-bits benchmarks")
+    parser.add_argument("scenarios", nargs="*", default=list(SCENARIOS),
+                        help="scenarios to run, default all: "
+                             + ", ".join(SCENARIOS))
+    parser.add_argument("--habits", type=int, default=50)
+    parser.add_argument("--categories", type=int, default=5)
+    parser.add_argument("--years", type=float, default=2)
+    parser.add_argument("--success", type=float, default=0.7)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--users", type=int, default=1,
+                        help="users with the same number of habits, "
+                             "the scenarios run for user 1")
+    parser.add_argument("--save", metavar="FILE",
+                        help="store the results as baseline")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="compare the results with a baseline")
+    parser.add_argument("--days-away", action="store_true",
+                        help="only time persistence() against days away")
+    parser.add_argument("--presets", action="store_true",
+                        help="only compare the database presets")
+    parser.add_argument("--server", action="store_true",
+                        help="only run the load test of the HTTP server")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--clients", type=int, default=8)
+    args = parser.parse_args()
+
+    if args.days_away:
+        bench_persistence()
+        return
+    if args.server:
+        bench_server(args.requests, args.clients, habits=args.habits,
+                     categories=args.categories, years=args.years,
+                     success=args.success, seed=args.seed)
+        return
+    if args.presets:
+        bench_presets(habits=args.habits, categories=args.categories,
+                      years=args.years, success=args.success, seed=args.seed)
+        return
+
+    results = run_scenarios(args.scenarios, habits=args.habits,
+                            categories=args.categories, years=args.years,
+                            success=args.success, seed=args.seed,
+                            users=args.users)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            baseline = json.load(file)
+    print_results(results, baseline)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+""" Read-through cache for the metadata of habits and categories.
+
+A single user action looks up the same habit or category several times,
+the identity map of the session forgets them at every commit. The
+LookupCache keeps immutable HabitInfo and CategoryInfo snapshots until
+they are invalidated, so a repeated lookup costs no SQL. Every path,
+that modifies, toggles or deletes a habit or category, needs to
+invalidate it. Changes of other processes on the same database, e.g.
+of the menu beside the server, can not invalidate it, so a snapshot is
+loaded again after TTL seconds. The streaks and dates of a habit are not
+cached, they change with every event.
+"""
+import threading
+import time
+from collections import namedtuple
+
+import models
+
+# Seconds a snapshot is used, before it is loaded again
+TTL = 5.0
+
+
+class HabitInfo(models.HabitRules, namedtuple("HabitInfo", [
+        "habit_id", "user_id", "name", "enabled", "cat_id", "cat_name",
+        "condition", "quota", "unit", "weekday"])):
+    """ Snapshot of the metadata of a habit with its category name,
+    it answers the schedule and condition rules like a Habit """
+    __slots__ = ()
+
+
+# Snapshot of a category
+CategoryInfo = namedtuple("CategoryInfo", ["cat_id", "user_id", "cat_name"])
+
+
+class LookupCache:
+    """ Caches HabitInfo and CategoryInfo by id for ttl seconds and counts
+    the hits and misses. Lookups of another user are answered with None.
+    Missing habits and categories are not cached, so new ones are found """
+
+    def __init__(self, ttl=TTL, clock=time.monotonic):
+        # id => (snapshot, expiry time of the clock)
+        self.habits = {}
+        self.categories = {}
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def lookup(self, entries, key, user_id, load):
+        """ Returns the cached entry of key or the one returned by load,
+        None if it does not exist or belongs to another user """
+        now = self.clock()
+        with self.lock:
+            info, expiry = entries.get(key, (None, now))
+            if expiry > now:
+                self.hits += 1
+            else:
+                info = None
+                self.misses += 1
+        if info is None:
+            info = load()
+            with self.lock:
+                if info is None:
+                    entries.pop(key, None)
+                    return None
+                entries[key] = (info, now + self.ttl)
+        return info if info.user_id == user_id else None
+
+    def habit(self, sqlsession, habit_id, user_id=models.DEFAULT_USER):
+        """ Returns the HabitInfo of a habit of the user, or None """
+        return self.lookup(self.habits, int(habit_id), user_id,
+                           lambda: load_habit(sqlsession, habit_id))
+
+    def category(self, sqlsession, cat_id, user_id=models.DEFAULT_USER):
+        """ Returns the CategoryInfo of a category of the user, or None """
+        return self.lookup(self.categories, int(cat_id), user_id,
+                           lambda: load_category(sqlsession, cat_id))
+
+    def invalidate_habit(self, habit_id):
+        """ Forgets a habit, after it was modified or deleted """
+        with self.lock:
+            self.habits.pop(int(habit_id), None)
+
+    def invalidate_category(self, cat_id):
+        """ Forgets a category and the habits inside it, they hold
+        the category name """
+        cat_id = int(cat_id)
+        with self.lock:
+            self.categories.pop(cat_id, None)
+            for habit_id in [info.habit_id
+                             for info, _ in self.habits.values()
+                             if info.cat_id == cat_id]:
+                del self.habits[habit_id]
+
+    def clear(self):
+        """ Forgets everything, e.g. after an import """
+        with self.lock:
+            self.habits.clear()
+            self.categories.clear()
+
+    def stats(self):
+        """ Returns the hits, misses and the hit rate of the lookups """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+def load_habit(sqlsession, habit_id):
+    """ Returns the HabitInfo of a habit from the database, or None """
+    row = sqlsession.query(
+        models.Habit.habit_id, models.Habit.user_id, models.Habit.name,
+        models.Habit.enabled, models.Habit.cat_id,
+        models.HabitCategory.cat_name, models.Habit.condition,
+        models.Habit.quota, models.Habit.unit,
+        models.Habit.weekday).outerjoin(
+        models.HabitCategory,
+        models.Habit.cat_id == models.HabitCategory.cat_id).filter(
+        models.Habit.habit_id == habit_id).first()
+    return HabitInfo(*row) if row is not None else None
+
+
+def load_category(sqlsession, cat_id):
+    """ Returns the CategoryInfo of a category from the database, or None """
+    row = sqlsession.query(
+        models.HabitCategory.cat_id, models.HabitCategory.user_id,
+        models.HabitCategory.cat_name).filter(
+        models.HabitCategory.cat_id == cat_id).first()
+    return CategoryInfo(*row) if row is not None else None
@@ -0,0 +1,171 @@
+""" Engine factory for the SQLite database.
+
+The settings are taken, from lowest to highest priority, from the
+defaults, a preset, the [database] section of the config file, the
+environment variables and the arguments. The variables are named
+HAHABITS_DATABASE for the path and HAHABITS_<SETTING> else, e.g.
+HAHABITS_JOURNAL_MODE=wal. The SQLite pragmas are applied on every
+new connection.
+"""
+import configparser
+import os
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
+
+# Config file, if it exists
+CONFIG_FILE = os.environ.get("HAHABITS_CONFIG", "haha-bits.ini")
+
+DEFAULTS = {
+    "path": "habit.sqlite3",
+    "preset": "interactive",
+}
+
+# Settings per preset, a missing pragma keeps the SQLite default.
+# cache_size is in pages, or in KiB if negative
+PRESETS = {
+    # many short transactions, the menu and the worker share the file
+    "interactive": {
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "cache_size": -8000,
+        "mmap_size": 64 * 1024 * 1024,
+        "busy_timeout": 5000,
+        "temp_store": "memory",
+    },
+    # imports and generated data, trades durability for speed
+    "bulk": {
+        "journal_mode": "wal",
+        "synchronous": "off",
+        "cache_size": -64000,
+        "busy_timeout": 5000,
+        "temp_store": "memory",
+    },
+    # reports, reads only and maps the file into memory
+    "analytics": {
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "cache_size": -64000,
+        "mmap_size": 256 * 1024 * 1024,
+        "busy_timeout": 5000,
+        "temp_store": "memory",
+        "query_only": 1,
+    },
+    # the SQLite defaults
+    "default": {},
+}
+
+# Schema version of an up-to-date database, the number of upgrade steps
+# in migrations.STEPS. Opening a current file skips the migrations
+SCHEMA_VERSION = 9
+
+# Pragmas in the order they are applied and their allowed values,
+# None for integers
+PRAGMAS = {
+    "journal_mode": ("delete", "truncate", "persist", "memory", "wal", "off"),
+    "synchronous": ("off", "normal", "full", "extra"),
+    "cache_size": None,
+    "mmap_size": None,
+    "busy_timeout": None,
+    "temp_store": ("default", "file", "memory"),
+    "query_only": None,
+}
+
+
+def read_config(path=CONFIG_FILE):
+    """ Returns the [database] section of the config file as a dictionary,
+    empty if the file does not exist """
+    parser = configparser.ConfigParser()
+    parser.read(path, encoding="utf-8")
+    if not parser.has_section("database"):
+        return {}
+    return dict(parser.items("database"))
+
+
+def read_environment(environ=None):
+    """ Returns the settings given by the environment variables,
+    HAHABITS_DATABASE for the path and HAHABITS_<SETTING> else """
+    environ = os.environ if environ is None else environ
+    settings = {}
+    for name in list(DEFAULTS) + list(PRAGMAS):
+        key = "HAHABITS_DATABASE" if name == "path" else \
+            "HAHABITS_" + name.upper()
+        if key in environ:
+            settings[name] = environ[key]
+    return settings
+
+
+def get_settings(preset=None, config=CONFIG_FILE, environ=None, **overrides):
+    """ Returns the merged settings, the path, the preset name and the
+    checked pragmas. Overrides with None are ignored """
+    configured = {**read_config(config), **read_environment(environ)}
+    overrides = {key: value for key, value in overrides.items()
+                 if value is not None}
+
+    settings = {**DEFAULTS, **configured, **overrides}
+    if preset:
+        settings["preset"] = preset
+    if settings["preset"] not in PRESETS:
+        raise ValueError(f"Unknown preset {settings['preset']}")
+
+    # the preset is the base, explicit pragmas change it
+    pragmas = {**PRESETS[settings["preset"]],
+               **{key: value for key, value in {**configured,
+                                                **overrides}.items()
+                  if key in PRAGMAS}}
+    settings.update(check_pragmas(pragmas))
+    return settings
+
+
+def check_pragmas(pragmas):
+    """ Returns the pragmas with checked values, raises ValueError
+    for an unknown pragma or value """
+    checked = {}
+    for name, value in pragmas.items():
+        if name not in PRAGMAS:
+            raise ValueError(f"Unknown pragma {name}")
+        if PRAGMAS[name] is None:
+            checked[name] = int(value)
+        elif str(value).lower() in PRAGMAS[name]:
+            checked[name] = str(value).lower()
+        else:
+            raise ValueError(f"{name} has to be one of "
+                             f"{', '.join(PRAGMAS[name])}, not {value}")
+    return checked
+
+
+def apply_pragmas(dbapi_connection, pragmas):
+    """ Sets the pragmas on a new DBAPI connection """
+    cursor = dbapi_connection.cursor()
+    for name in PRAGMAS:
+        if name in pragmas:
+            cursor.execute(f"PRAGMA {name} = {pragmas[name]}")
+    cursor.close()
+
+
+def get_engine(path=None, preset=None, config=CONFIG_FILE, environ=None,
+               pool_size=None, **pragmas):
+    """ Creates the engine for a database file, ':memory:' gives an in
+    memory database. Without a pool size, every session opens a new
+    connection, else up to pool_size connections are kept open and
+    shared by the threads. Returns the engine, the used settings are
+    stored in engine.settings """
+    settings = get_settings(preset, config, environ, path=path, **pragmas)
+    url = "sqlite://" if settings["path"] == ":memory:" else \
+        f"sqlite:///{settings['path']}"
+    if pool_size:
+        # a pooled connection moves between the threads
+        engine = create_engine(url, echo=False, poolclass=QueuePool,
+                               pool_size=pool_size, max_overflow=0,
+                               connect_args={"check_same_thread": False})
+    else:
+        engine = create_engine(url, echo=False)
+
+    pragmas = {name: settings[name] for name in PRAGMAS if name in settings}
+
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, _):
+        apply_pragmas(dbapi_connection, pragmas)
+
+    engine.settings = settings
+    return engine
@@ -0,0 +1,135 @@
+""" Compact, read-only store of the events for the analytics.
+
+An ORM object of an event carries the instance state of SQLAlchemy and
+all its attributes, loading a long history with .all() costs hundreds
+of megabytes. The EventStore keeps only status, quota and solved day
+as typed array columns, about 9 bytes per event, grouped by habit.
+It is filled straight from a raw cursor.
+
+The store and the events of a single habit are iterables of StoredEvent
+tuples, that are created on the fly, so the functions of analytics.py
+consume them like ORM objects.
+"""
+import datetime
+from array import array
+from collections import namedtuple
+from itertools import groupby
+
+import models
+
+# Rows fetched from the cursor at once
+FETCH_SIZE = 5000
+
+# Events migrated from text dates may lack the solved day, these fall
+# back on the day of the event, rows without any day are left out
+EVENTS_SQL = ("SELECT habit_id, COALESCE(status, 0), COALESCE(quota, 0), "
+              "COALESCE(datetime_solved, datetime) AS day FROM HabitEvent "
+              "WHERE user_id = ?{where} AND day IS NOT NULL "
+              "ORDER BY habit_id, day, event_id")
+
+
+def events_query(habit_ids=None, user_id=models.DEFAULT_USER):
+    """ Returns the SQL and the parameters for a raw cursor, that select
+    habit id, status, quota and solved day ordinal of the events of a
+    user or the given habit ids, ordered by habit and solved date.
+    Without a solved day, the day of the event is used """
+    params = [user_id]
+    where = ""
+    if habit_ids is not None:
+        habit_ids = list(habit_ids)
+        where = f" AND habit_id IN ({', '.join('?' * len(habit_ids))})"
+        params.extend(habit_ids)
+    return EVENTS_SQL.format(where=where), params
+
+
+# A single event of the store, created when it is read
+StoredEvent = namedtuple("StoredEvent",
+                         ["habit_id", "status", "quota", "datetime_solved"])
+
+
+class HabitEvents:
+    """ The events of one habit inside an EventStore, in solved order """
+
+    def __init__(self, store, habit_id, start, stop):
+        self.store = store
+        self.habit_id = habit_id
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __iter__(self):
+        status, quota, day = self.store.status, self.store.quota, \
+            self.store.day
+        for index in range(self.start, self.stop):
+            yield StoredEvent(self.habit_id, status[index], quota[index],
+                              datetime.date.fromordinal(day[index]))
+
+
+class EventStore:
+    """ Status, quota and solved day ordinal of the events as array
+    columns, ranges maps every habit id to the slice of its events """
+    # the events are iterated habit by habit, see get_lstreaks_all
+    ordered_by_habit = True
+
+    def __init__(self):
+        self.status = array("b")
+        self.quota = array("i")
+        self.day = array("i")
+        self.ranges = {}
+
+    @classmethod
+    def load(cls, connection, habit_ids=None, user_id=models.DEFAULT_USER,
+             fetch_size=FETCH_SIZE):
+        """ Returns a store with the events of a user, or of the given
+        habit ids, read from a raw cursor of the connection """
+        store = cls()
+        cursor = connection.connection.cursor()
+        try:
+            cursor.execute(*events_query(habit_ids, user_id))
+            for rows in iter(lambda: cursor.fetchmany(fetch_size), []):
+                store.extend(rows)
+        finally:
+            cursor.close()
+        return store
+
+    def extend(self, rows):
+        """ Appends rows of habit id, status, quota and day ordinal,
+        ordered by habit. A habit may go on from the previous rows """
+        habit_ids, status, quota, day = zip(*rows)
+        offset = len(self.status)
+        self.status.extend(status)
+        self.quota.extend(quota)
+        self.day.extend(day)
+
+        for habit_id, group in groupby(habit_ids):
+            stop = offset + sum(1 for _ in group)
+            start = self.ranges.get(habit_id, (offset, offset))[0]
+            self.ranges[habit_id] = (start, stop)
+            offset = stop
+
+    def __len__(self):
+        return len(self.status)
+
+    def __iter__(self):
+        for habit_id in self.ranges:
+            yield from self.habit(habit_id)
+
+    def __contains__(self, habit_id):
+        return habit_id in self.ranges
+
+    def habits(self):
+        """ Returns the ids of the habits with events """
+        return list(self.ranges)
+
+    def habit(self, habit_id):
+        """ Returns the HabitEvents of a habit, empty without events """
+        start, stop = self.ranges.get(habit_id, (0, 0))
+        return HabitEvents(self, habit_id, start, stop)
+
+    @property
+    def nbytes(self):
+        """ Bytes used by the array columns """
+        return sum(len(column) * column.itemsize
+                   for column in (self.status, self.quota, self.day))
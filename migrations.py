@@ -0,0 +1,292 @@
+""" Small migration system, that upgrades existing databases step by step.
+
+The schema version is stored inside the SQLite file itself (user_version),
+every upgrade step raises it by one. Steps are applied in order at
+startup, after create_all() has created any missing table.
+"""
+from sqlalchemy import bindparam, text
+
+import analytics
+import models
+import rollups
+
+
+def get_columns(connection, table):
+    """ Returns the column names of a table """
+    return [row.name for row in
+            connection.execute(text(f"PRAGMA table_info({table})"))]
+
+
+def create_event_indexes(connection):
+    """ Adds the indexes for the event lookups and the category key """
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_HabitEvent_habit_id_datetime_solved "
+        "ON HabitEvent (habit_id, datetime_solved)"))
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_HabitEvent_habit_id_status "
+        "ON HabitEvent (habit_id, status)"))
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_Habit_cat_id ON Habit (cat_id)"))
+
+
+def add_streak_columns(connection):
+    """ Adds the longest streak and the date of the latest evaluated
+    event to the habits and evaluates the streaks of the existing events """
+    columns = get_columns(connection, "Habit")
+    if "longest_streak" not in columns:
+        connection.execute(text(
+            "ALTER TABLE Habit ADD COLUMN longest_streak INTEGER DEFAULT 0"))
+    if "streak_date" not in columns:
+        connection.execute(text(
+            "ALTER TABLE Habit ADD COLUMN streak_date VARCHAR"))
+
+    # Evaluate all histories once, later updates are incremental
+    evaluate_streaks(connection)
+
+
+def evaluate_streaks(connection, habit_ids=None):
+    """ Evaluates and stores the streaks of all habits,
+    or only of the given habit ids """
+    where, params = "", {}
+    if habit_ids is not None:
+        where, params = "WHERE habit_id IN :habit_ids", {
+            "habit_ids": list(habit_ids)}
+
+    def query(sql):
+        if habit_ids is None:
+            return text(sql.format(where=where))
+        return text(sql.format(where=where)).bindparams(
+            bindparam("habit_ids", expanding=True))
+
+    # with users, the events are read in the order of the user index,
+    # the events of a habit stay together
+    order = "user_id, habit_id" if "user_id" in get_columns(
+        connection, "HabitEvent") else "habit_id"
+    streaks = analytics.get_streaks_grouped(connection.execute(query(
+        "SELECT habit_id, status FROM HabitEvent {where} "
+        f"ORDER BY {order}, datetime_solved, event_id"), params))
+    streak_dates = dict(connection.execute(query(
+        "SELECT habit_id, MAX(datetime_solved) FROM HabitEvent {where} "
+        "GROUP BY habit_id"), params).all())
+
+    for habit_id, figures in streaks.items():
+        connection.execute(text(
+            "UPDATE Habit SET latest_streak = :latest, "
+            "longest_streak = :longest, streak_date = :streak_date "
+            "WHERE habit_id = :habit_id"),
+            {"latest": figures.current, "longest": figures.longest,
+             "streak_date": streak_dates[habit_id], "habit_id": habit_id})
+
+
+# Tables with the dates stored as integer day numbers,
+# the date columns of every table and the indexes
+DAY_NUMBER_TABLES = {
+    "Habit": ("""
+        CREATE TABLE "Habit" (
+            habit_id INTEGER NOT NULL,
+            cat_id INTEGER,
+            name VARCHAR NOT NULL,
+            enabled BOOLEAN,
+            created INTEGER,
+            updated INTEGER,
+            condition VARCHAR,
+            quota INTEGER,
+            unit VARCHAR,
+            weekday INTEGER,
+            latest_streak INTEGER,
+            longest_streak INTEGER,
+            streak_date INTEGER,
+            PRIMARY KEY (habit_id),
+            FOREIGN KEY(cat_id) REFERENCES "HabitCategory" (cat_id)
+        )""", ("created", "updated", "streak_date")),
+    "HabitEvent": ("""
+        CREATE TABLE "HabitEvent" (
+            event_id INTEGER NOT NULL,
+            habit_id INTEGER,
+            datetime INTEGER,
+            datetime_solved INTEGER,
+            weekday INTEGER,
+            status INTEGER,
+            quota INTEGER,
+            PRIMARY KEY (event_id),
+            FOREIGN KEY(habit_id) REFERENCES "Habit" (habit_id)
+        )""", ("datetime", "datetime_solved")),
+}
+
+
+def rebuild_table(connection, table, create, convert):
+    """ Rebuilds a table with a new definition, SQLite can not change the
+    type of a column. Every row is passed through convert on the copy,
+    the indexes of the old table are dropped and need to be created again """
+    connection.execute(text(f'ALTER TABLE "{table}" RENAME TO "{table}_old"'))
+    for index in connection.execute(text(
+            "SELECT name FROM sqlite_master WHERE type = 'index' "
+            "AND tbl_name = :table AND sql IS NOT NULL"),
+            {"table": f"{table}_old"}).scalars().all():
+        connection.execute(text(f'DROP INDEX "{index}"'))
+
+    connection.execute(text(create))
+    columns = [column for column in get_columns(connection, f"{table}_old")
+               if column in get_columns(connection, table)]
+    rows = [convert(dict(row)) for row in connection.execute(text(
+        f'SELECT {", ".join(columns)} FROM "{table}_old"')).mappings()]
+    if rows:
+        connection.execute(text(
+            f'INSERT INTO "{table}" ({", ".join(columns)}) '
+            f'VALUES ({", ".join(":" + column for column in columns)})'),
+            rows)
+    connection.execute(text(f'DROP TABLE "{table}_old"'))
+
+
+def store_days_as_integers(connection):
+    """ Converts the date columns of habits and events from text
+    into integer day numbers """
+    types = {row.name: row.type for row in connection.execute(
+        text("PRAGMA table_info(HabitEvent)"))}
+    if types["datetime_solved"] == "INTEGER":
+        return
+
+    def converter(date_columns):
+        def convert(row):
+            for column in date_columns:
+                if column not in row:
+                    continue
+                try:
+                    day = models.to_date(row[column])
+                except ValueError:
+                    day = None
+                row[column] = day.toordinal() if day else None
+            return row
+        return convert
+
+    # Keep the references of the other tables, while renaming
+    connection.execute(text("PRAGMA legacy_alter_table = ON"))
+    for table, (create, date_columns) in DAY_NUMBER_TABLES.items():
+        rebuild_table(connection, table, create, converter(date_columns))
+    connection.execute(text("PRAGMA legacy_alter_table = OFF"))
+
+    create_event_indexes(connection)
+    # Text dates like 2022-01-9 were sorted wrong, evaluate again
+    evaluate_streaks(connection)
+
+
+def create_solved_index(connection):
+    """ Adds the index for the event pages ordered by the solved date,
+    the event id is part of every index as row id """
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_HabitEvent_datetime_solved "
+        "ON HabitEvent (datetime_solved)"))
+
+
+# Categories with a name unique per user
+USER_CATEGORY_TABLE = """
+    CREATE TABLE "HabitCategory" (
+        cat_id INTEGER NOT NULL,
+        cat_name VARCHAR NOT NULL,
+        user_id INTEGER DEFAULT '1' NOT NULL,
+        PRIMARY KEY (cat_id),
+        CONSTRAINT "uq_HabitCategory_user_id_cat_name"
+            UNIQUE (user_id, cat_name)
+    )"""
+
+
+def add_users(connection):
+    """ Adds the owning user to categories, habits and events, the
+    existing rows belong to the default user. The event indexes are
+    replaced with ones leading with the user """
+    if "user_id" not in get_columns(connection, "HabitCategory"):
+        # the unique category name becomes unique per user
+        connection.execute(text("PRAGMA legacy_alter_table = ON"))
+        rebuild_table(connection, "HabitCategory", USER_CATEGORY_TABLE,
+                      lambda row: row)
+        connection.execute(text("PRAGMA legacy_alter_table = OFF"))
+
+    for table in ("Habit", "HabitEvent"):
+        if "user_id" not in get_columns(connection, table):
+            connection.execute(text(
+                f'ALTER TABLE "{table}" ADD COLUMN '
+                f"user_id INTEGER DEFAULT '1' NOT NULL"))
+
+    for index in ("ix_HabitEvent_habit_id_datetime_solved",
+                  "ix_HabitEvent_habit_id_status",
+                  "ix_HabitEvent_datetime_solved"):
+        connection.execute(text(f'DROP INDEX IF EXISTS "{index}"'))
+
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_Habit_user_id ON Habit (user_id)"))
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS "
+        "ix_HabitEvent_user_id_habit_id_datetime_solved "
+        "ON HabitEvent (user_id, habit_id, datetime_solved)"))
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_HabitEvent_user_id_habit_id_status "
+        "ON HabitEvent (user_id, habit_id, status)"))
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_HabitEvent_user_id_datetime_solved "
+        "ON HabitEvent (user_id, datetime_solved)"))
+
+
+def build_rollups(connection):
+    """ Adds the rollup tables and fills them from the existing events """
+    for model in (models.HabitRollup, models.CategoryRollup):
+        model.__table__.create(connection, checkfirst=True)
+    rollups.rebuild(connection)
+
+
+def create_due_indexes(connection):
+    """ Adds the partial indexes of the habits due on every weekday """
+    for index in models.DUE_INDEXES:
+        index.create(connection, checkfirst=True)
+
+
+def add_persistence_runs(connection):
+    """ Adds the watermark table of the persistence runs """
+    models.PersistenceRun.__table__.create(connection, checkfirst=True)
+
+
+def add_habit_pauses(connection):
+    """ Adds the table of the periods, the habits were disabled """
+    models.HabitPause.__table__.create(connection, checkfirst=True)
+
+
+# Ordered upgrade steps, a database with version n has
+# the first n steps applied. Never reorder or remove a step,
+# only append new ones.
+STEPS = [
+    create_event_indexes,
+    add_streak_columns,
+    store_days_as_integers,
+    create_solved_index,
+    add_users,
+    build_rollups,
+    create_due_indexes,
+    add_persistence_runs,
+    add_habit_pauses,
+]
+
+
+def get_version(connection):
+    """ Returns the schema version of the database """
+    return connection.execute(text("PRAGMA user_version")).scalar()
+
+
+def set_version(connection, version):
+    """ Stores the schema version inside the database """
+    connection.execute(text(f"PRAGMA user_version = {int(version)}"))
+
+
+def migrate(engine):
+    """ Applies all missing upgrade steps, every step inside its own
+    transaction. Returns the list of the applied step names """
+    applied = []
+
+    with engine.begin() as connection:
+        version = get_version(connection)
+
+    for number, step in enumerate(STEPS[version:], start=version + 1):
+        with engine.begin() as connection:
+            step(connection)
+            set_version(connection, number)
+        applied.append(step.__name__)
+
+    return applied
@@ -1,18 +1,75 @@
 """Models used for playing with Habits"""
 import datetime
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Index, \
+    PrimaryKeyConstraint, UniqueConstraint, and_, literal_column, or_
+from sqlalchemy.orm import relationship, validates
+from sqlalchemy.types import TypeDecorator
 
 from base import Base
 
+# The user of a database with a single person
+DEFAULT_USER = 1
+
+
+def user_column():
+    """ Returns the column of the owning user, every table leads its
+    indexes with it, so the queries of a user stay in its index range """
+    return Column('user_id', Integer, nullable=False, default=DEFAULT_USER,
+                  server_default=str(DEFAULT_USER))
+
+
+def to_date(value):
+    """ Converts a date, datetime or a string like 2022-01-31 or 2022-1-3
+    into a date, empty values are returned as None """
+    if value is None or value == "":
+        return None
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+
+    # strip any time part, then split year, month and day
+    day = str(value).strip().split(" ")[0].split("T")[0]
+    return datetime.date(*map(int, day.split("-")))
+
+
+class DayNumber(TypeDecorator):
+    """ Stores a date as integer day number (proleptic ordinal, 1 is
+    0001-01-01), so ranges are compared as integers. Callers read and
+    write datetime.date """
+    impl = Integer
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        """ date => day number """
+        value = to_date(value)
+        if value is None:
+            return None
+        return value.toordinal()
+
+    def process_result_value(self, value, dialect):
+        """ day number => date """
+        if value is None:
+            return None
+        return datetime.date.fromordinal(value)
+
 
 class HabitCategory(Base):
     """ Class for habit category, e.g. sports, inherits super constructor"""
     __tablename__ = 'HabitCategory'
 
+    # category names are unique per user
+    __table_args__ = (
+        UniqueConstraint('user_id', 'cat_name',
+                         name='uq_HabitCategory_user_id_cat_name'),
+    )
+
     # an unique id and a name for the category of a habit
     cat_id = Column('cat_id', Integer, primary_key=True, autoincrement=True)
-    cat_name = Column('cat_name', String, unique=True, nullable=False)
+    cat_name = Column('cat_name', String, nullable=False)
+
+    # the user, that owns this category
+    user_id = user_column()
 
     def set_name(self, name):
         """" Sets the name of a category """
@@ -23,20 +80,109 @@ class HabitCategory(Base):
         return f"Name: {self.cat_name}"
 
 
-class Habit(Base):
+class HabitRules:
+    """ Schedule and condition rules of a habit, shared by the mapped
+    Habit and the cached HabitInfo. Needs the attributes name, weekday,
+    condition, quota and unit """
+    __slots__ = ()
+
+    def due_today(self):
+        """ Checks if habit is due today """
+
+        # If the habit is weekly, it will be due at least at one day per week
+        # so always return true
+        if self.is_weekly():
+            return True
+
+        # Get today's weekday and return
+        today_weekday = int(datetime.datetime.today().weekday())
+        return self.due_weekday(today_weekday)
+
+    def due_weekday(self, weekday):
+        """ Checks if habit is due at some specific weekday """
+
+        # If the habit is weekly, it will be due at least at one day per week
+        # so always return true
+        if self.is_weekly():
+            return True
+
+        # If habit is day by day, check if bit is not set for this weekday
+        if (self.weekday & (1 << weekday)) == 0:
+            return False
+
+        # by default, a habit is due
+        return True
+
+    def is_weekly(self):
+        """ Returns if habit is weekly """
+        if self.weekday == 128:
+            return True
+        return False
+
+    def get_satisfaction(self):
+        """ Returns satisfaction condition as a string """
+
+        if self.condition == "eq":
+            return f"You need exactly {self.quota} " \
+                   f"{self.unit} for succeeding {self.name}."
+        if self.condition == "lt":
+            return f"You need less or equal {self.quota} " \
+                   f"{self.unit} for succeeding {self.name}."
+        if self.condition == "gt":
+            return f"You need greater or equal {self.quota} " \
+                   f"{self.unit} for succeeding {self.name}."
+
+        return "Just doing it, is enough for succeeding."
+
+    def needs_satisfaction(self):
+        """ Checks if this habit has a condition parameter """
+        if self.condition != "":
+            return True
+        return False
+
+    def satisfied(self, user_quota):
+        """ Returns status, if habit condition function
+        is satisfied by user quota """
+        user_quota = int(user_quota)
+
+        if self.condition == "eq":
+            if self.quota == user_quota:
+                return 1
+        elif self.condition == "lt":
+            if user_quota <= self.quota:
+                return 1
+        elif self.condition == "gt":
+            if user_quota >= self.quota:
+                return 1
+
+        return 2
+
+
+class Habit(HabitRules, Base):
     """ Class for general habit """
     __tablename__ = 'Habit'
 
+    # the habits of a user, ordered by the habit id
+    __table_args__ = (
+        Index('ix_Habit_user_id', 'user_id'),
+    )
+
     # id member
     habit_id = Column('habit_id', Integer,
                       primary_key=True,
                       autoincrement=True)
 
+    # the user, that owns this habit
+    user_id = user_column()
+
     # define a relationship to the event table
     habit_events = relationship("HabitEvent", backref="Habit",
                                 lazy='dynamic')
+    # the periods the habit was disabled, in the order of the days
+    pauses = relationship("HabitPause", order_by="HabitPause.start")
     # define a relationship to the category table
-    cat_id = Column(Integer, ForeignKey('HabitCategory.cat_id'), default=0)
+    cat_id = Column(Integer, ForeignKey('HabitCategory.cat_id'), default=0,
+                    index=True)
 
     # a user-definable name for a habit
     name = Column('name', String, nullable=False)
@@ -45,9 +191,9 @@ class Habit(Base):
     enabled = Column('enabled', Boolean, default=True)
 
     # when habit was created
-    created = Column('created', String)
+    created = Column('created', DayNumber)
     # when habit was updated
-    updated = Column('updated', String)
+    updated = Column('updated', DayNumber)
 
     # a condition function, that needs to be matched
     # eq => exactly match
@@ -75,6 +221,16 @@ class Habit(Base):
     # latest_streak for easier sorting
     latest_streak = Column('latest_streak', Integer, default=0)
 
+    # the longest streak ever and the solved date of the latest event,
+    # that was evaluated for the streaks
+    longest_streak = Column('longest_streak', Integer, default=0)
+    streak_date = Column('streak_date', DayNumber)
+
+    @validates('created', 'updated', 'streak_date')
+    def validate_date(self, _, value):
+        """ Keeps dates as date objects, also when set by string """
+        return to_date(value)
+
     def __str__(self):
         return f"Name: {self.name}\n" \
                f"Condition: {self.condition} Quota / Units:" \
@@ -116,39 +272,6 @@ class Habit(Base):
         """ Adds a day to the weekday scheduler by integer """
         self.weekday = (1 << day) | self.weekday
 
-    def due_today(self):
-        """ Checks if habit is due today """
-
-        # If the habit is weekly, it will be due at least at one day per week
-        # so always return true
-        if self.is_weekly():
-            return True
-
-        # Get today's weekday and return
-        today_weekday = int(datetime.datetime.today().weekday())
-        return self.due_weekday(today_weekday)
-
-    def due_weekday(self, weekday):
-        """ Checks if habit is due at some specific weekday """
-
-        # If the habit is weekly, it will be due at least at one day per week
-        # so always return true
-        if self.is_weekly():
-            return True
-
-        # If habit is day by day, check if bit is not set for this weekday
-        if (self.weekday & (1 << weekday)) == 0:
-            return False
-
-        # by default, a habit is due
-        return True
-
-    def is_weekly(self):
-        """ Returns if habit is weekly """
-        if self.weekday == 128:
-            return True
-        return False
-
     def disable(self):
         """ Disables the habit """
         self.enabled = False
@@ -170,44 +293,6 @@ class Habit(Base):
         self.reset_weekday()
         self.weekday = 1 << 7
 
-    def get_satisfaction(self):
-        """ Returns satisfaction condition as a string """
-
-        if self.condition == "eq":
-            return f"You need exactly {self.quota} " \
-                   f"{self.unit} for succeeding {self.name}."
-        if self.condition == "lt":
-            return f"You need less or equal {self.quota} " \
-                   f"{self.unit} for succeeding {self.name}."
-        if self.condition == "gt":
-            return f"You need greater or equal {self.quota} " \
-                   f"{self.unit} for succeeding {self.name}."
-
-        return "Just doing it, is enough for succeeding."
-
-    def needs_satisfaction(self):
-        """ Checks if this habit has a condition parameter """
-        if self.condition != "":
-            return True
-        return False
-
-    def satisfied(self, user_quota):
-        """ Returns status, if habit condition function
-        is satisfied by user quota """
-        user_quota = int(user_quota)
-
-        if self.condition == "eq":
-            if self.quota == user_quota:
-                return 1
-        elif self.condition == "lt":
-            if user_quota <= self.quota:
-                return 1
-        elif self.condition == "gt":
-            if user_quota >= self.quota:
-                return 1
-
-        return 2
-
     def set_quota(self, quota, unit):
         """ Sets the quota and unit name for this habit """
         self.quota = quota
@@ -224,11 +309,72 @@ class Habit(Base):
         """ updates number of latest streaks """
         self.latest_streak = streak
 
+    def set_streaks(self, latest, longest, streak_date):
+        """ sets all streak figures after a full evaluation of the events """
+        self.latest_streak = latest
+        self.longest_streak = longest
+        self.streak_date = streak_date
+
+    def apply_event_streak(self, solved, status):
+        """ updates the streaks with a single event, that is newer than
+        all events evaluated so far. Returns False, if the event is not
+        newer and the streaks need to be evaluated again """
+        solved = to_date(solved)
+        if self.streak_date is not None and solved <= self.streak_date:
+            return False
+
+        if status == 1:
+            self.latest_streak = (self.latest_streak or 0) + 1
+            self.longest_streak = max(self.longest_streak or 0,
+                                      self.latest_streak)
+        else:
+            # pending and failed events break the streak
+            self.latest_streak = 0
+
+        self.streak_date = solved
+        return True
+
+
+# weekday of the weekly habits, they are due on every day
+WEEKLY = 1 << 7
+
+
+def due_on(weekday):
+    """ Returns the SQL condition of the enabled habits due on a weekday,
+    0 is Monday. The same condition is the one of the partial index of
+    the weekday, so the query needs to use it unchanged and the due
+    habits are read from the index instead of testing all habits """
+    # literal numbers, a bound parameter does not match the index
+    return and_(Habit.enabled == literal_column("1"),
+                or_(Habit.weekday == literal_column(str(WEEKLY)),
+                    Habit.weekday.op("&")(literal_column(
+                        str(1 << weekday))) != literal_column("0")))
+
+
+# one partial index per weekday, that holds the habits due on it,
+# ordered by user and habit id. enabled is part of the key, so the
+# planner prefers it over ix_Habit_user_id also without statistics
+DUE_INDEXES = [Index(f'ix_Habit_due_{weekday}', Habit.user_id, Habit.enabled,
+                     sqlite_where=due_on(weekday))
+               for weekday in range(0, 7)]
+
 
 class HabitEvent(Base):
     """ Class for tracking single events """
     __tablename__ = 'HabitEvent'
 
+    # indexes for the lookups of events by habit and date or status
+    # and for the event pages ordered by date (and the event id),
+    # all inside the range of a user
+    __table_args__ = (
+        Index('ix_HabitEvent_user_id_habit_id_datetime_solved',
+              'user_id', 'habit_id', 'datetime_solved'),
+        Index('ix_HabitEvent_user_id_habit_id_status',
+              'user_id', 'habit_id', 'status'),
+        Index('ix_HabitEvent_user_id_datetime_solved',
+              'user_id', 'datetime_solved'),
+    )
+
     # the event_id for easier identification
     event_id = Column('event_id', Integer,
                       primary_key=True,
@@ -236,9 +382,12 @@ class HabitEvent(Base):
     # foreign "key" to match habit to its events
     habit_id = Column(Integer, ForeignKey('Habit.habit_id'))
 
+    # the user of the habit, copied for the user leading indexes
+    user_id = user_column()
+
     # when was date/time to be scheduled, when was ist solved (t.b.a.)
-    datetime = Column('datetime', String)
-    datetime_solved = Column('datetime_solved', String, default="")
+    datetime = Column('datetime', DayNumber)
+    datetime_solved = Column('datetime_solved', DayNumber)
 
     # day of month and day of month the event as was done
     weekday = Column('weekday', Integer, default=0)
@@ -250,6 +399,11 @@ class HabitEvent(Base):
     # variable for number of quota that was solved in that single event
     quota = Column('quota', Integer, default=0)
 
+    @validates('datetime', 'datetime_solved')
+    def validate_date(self, _, value):
+        """ Keeps dates as date objects, also when set by string """
+        return to_date(value)
+
     def set_status(self, status):
         """set_status"""
         self.status = status
@@ -298,3 +452,87 @@ class HabitEvent(Base):
     def __str__(self):
         """ prints Habits event id """
         return f"<HabitEvent {self.event_id}>"
+
+
+class RollupColumns:
+    """ Figures of the events inside one bucket of a period, the bucket
+    is the first day of the day, week (Monday) or month """
+    # day, week or month
+    period = Column('period', String, nullable=False)
+    bucket = Column('bucket', DayNumber, nullable=False)
+
+    # number of events per status
+    done = Column('done', Integer, default=0)
+    failed = Column('failed', Integer, default=0)
+    pending = Column('pending', Integer, default=0)
+
+    # the quotas of all events
+    quota_sum = Column('quota_sum', Integer, default=0)
+    quota_min = Column('quota_min', Integer, default=0)
+    quota_max = Column('quota_max', Integer, default=0)
+
+    def events(self):
+        """ Returns the number of events inside the bucket """
+        return self.done + self.failed + self.pending
+
+
+class HabitRollup(RollupColumns, Base):
+    """ Event figures of a habit per bucket, maintained with the events """
+    __tablename__ = 'HabitRollup'
+
+    __table_args__ = (
+        PrimaryKeyConstraint('habit_id', 'period', 'bucket'),
+        Index('ix_HabitRollup_user_id_period_bucket',
+              'user_id', 'period', 'bucket'),
+    )
+
+    habit_id = Column('habit_id', Integer, nullable=False)
+    user_id = user_column()
+
+
+class CategoryRollup(RollupColumns, Base):
+    """ Event figures of the habits of a category per bucket """
+    __tablename__ = 'CategoryRollup'
+
+    __table_args__ = (
+        PrimaryKeyConstraint('cat_id', 'period', 'bucket'),
+    )
+
+    cat_id = Column('cat_id', Integer, nullable=False)
+    user_id = user_column()
+
+
+class HabitPause(Base):
+    """ A period a habit was disabled, from the day it was disabled till
+    before the day it was enabled again. The sparse storage derives no
+    missed days inside it """
+    __tablename__ = 'HabitPause'
+
+    __table_args__ = (
+        Index('ix_HabitPause_habit_id', 'habit_id'),
+    )
+
+    pause_id = Column('pause_id', Integer, primary_key=True,
+                      autoincrement=True)
+    habit_id = Column(Integer, ForeignKey('Habit.habit_id'), nullable=False)
+    user_id = user_column()
+
+    # first day of the pause and the day the habit was enabled again
+    start = Column('start', DayNumber, nullable=False)
+    end = Column('end', DayNumber, nullable=False)
+
+    def covers(self, day):
+        """ Checks if the habit was disabled on day """
+        return self.start <= day < self.end
+
+
+class PersistenceRun(Base):
+    """ Watermark of the persistence runs of a user, the day of the last
+    run, that caught the missed events of all habits """
+    __tablename__ = 'PersistenceRun'
+
+    user_id = Column('user_id', Integer, primary_key=True,
+                     autoincrement=False)
+
+    # the day, the last complete run was made for
+    completed = Column('completed', DayNumber, nullable=False)
@@ -0,0 +1,184 @@
+""" Rollup tables with the event figures per habit and category.
+
+For every day, week and month with events, HabitRollup and
+CategoryRollup hold the number of done, failed and pending events and
+the sum, minimum and maximum of the quotas. Trends are read from these
+buckets instead of all events.
+
+When events are created, resolved or reset, the buckets of their days
+are evaluated again from the events, inside the same transaction.
+A bucket holds at most a month of events of a habit, so this stays
+cheap and the minimum and maximum stay exact. The buckets of a
+category are added up from the buckets of its habits. rebuild()
+evaluates all buckets again, e.g. after events were changed outside
+the application.
+
+The functions take a session or a connection and leave committing to
+the caller.
+"""
+import datetime
+
+from sqlalchemy import bindparam, text
+
+PERIODS = ("day", "week", "month")
+
+# day number of 0001-01-01 => julian day of SQLite
+JULIAN_OFFSET = 1721424.5
+
+COLUMNS = ("period, bucket, done, failed, pending, "
+           "quota_sum, quota_min, quota_max")
+
+HABIT_SELECT_SQL = """
+SELECT user_id, habit_id, '{period}', {bucket},
+       SUM(status = 1), SUM(status = 2),
+       SUM(COALESCE(status, 0) NOT IN (1, 2)),
+       SUM(COALESCE(quota, 0)), MIN(COALESCE(quota, 0)),
+       MAX(COALESCE(quota, 0))
+FROM HabitEvent
+WHERE {where}
+GROUP BY user_id, habit_id, {bucket}
+"""
+
+# habits without a category have the cat_id 0 or NULL
+CATEGORY_SQL = f"""
+INSERT INTO CategoryRollup (user_id, cat_id, {COLUMNS})
+SELECT r.user_id, h.cat_id, r.period, r.bucket,
+       SUM(r.done), SUM(r.failed), SUM(r.pending),
+       SUM(r.quota_sum), MIN(r.quota_min), MAX(r.quota_max)
+FROM HabitRollup r JOIN Habit h ON h.habit_id = r.habit_id
+WHERE h.cat_id > 0 AND {{where}}
+GROUP BY r.user_id, h.cat_id, r.period, r.bucket
+"""
+
+
+def bucket_sql(period, day):
+    """ Returns the SQL of the first day of the bucket of a day number """
+    if period == "week":
+        # the day number 1 is a Monday
+        return f"({day} - ({day} - 1) % 7)"
+    if period == "month":
+        return (f"CAST(julianday({day} + {JULIAN_OFFSET}, 'start of month') "
+                f"- {JULIAN_OFFSET} AS INTEGER)")
+    return day
+
+
+def bucket_of(period, day):
+    """ Returns the first day of the bucket of a date """
+    if period == "week":
+        return day - datetime.timedelta(days=day.weekday())
+    if period == "month":
+        return day.replace(day=1)
+    return day
+
+
+def bucket_end(period, day):
+    """ Returns the last day of the bucket of a date """
+    if period == "week":
+        return bucket_of(period, day) + datetime.timedelta(days=6)
+    if period == "month":
+        following = day.replace(day=28) + datetime.timedelta(days=4)
+        return following.replace(day=1) - datetime.timedelta(days=1)
+    return day
+
+
+def execute(connection, sql, params, expanding=()):
+    """ Executes SQL with the parameters, those named in expanding are
+    lists for an IN """
+    query = text(sql)
+    if expanding:
+        query = query.bindparams(*(bindparam(name, expanding=True)
+                                   for name in expanding))
+    connection.execute(query, params)
+
+
+def insert_habits(connection, where, params, expanding=()):
+    """ Evaluates the habit buckets of all periods from the events
+    matching where, it may use {period} for the conditions of a
+    period, e.g. a range of days """
+    selects = " UNION ALL ".join(
+        HABIT_SELECT_SQL.format(period=period,
+                                bucket=bucket_sql(period, "datetime_solved"),
+                                where=where.format(period=period))
+        for period in PERIODS)
+    execute(connection,
+            f"INSERT INTO HabitRollup (user_id, habit_id, {COLUMNS}) "
+            f"{selects}", params, expanding)
+
+
+def insert_categories(connection, where, params, expanding=()):
+    """ Adds up the category buckets from the habit buckets matching
+    where, the columns of the habit are prefixed with h """
+    execute(connection, CATEGORY_SQL.format(where=where), params, expanding)
+
+
+def refresh(connection, habit, start, end=None):
+    """ Evaluates the buckets of a habit and its category again, that
+    hold the days from start till end. habit needs a habit_id, user_id
+    and cat_id """
+    end = end or start
+    params = {"user_id": habit.user_id, "habit_id": habit.habit_id,
+              "cat_id": habit.cat_id}
+    ranges = []
+    for period in PERIODS:
+        params[f"first_{period}"] = bucket_of(period, start).toordinal()
+        params[f"end_{period}"] = bucket_end(period, end).toordinal()
+        ranges.append(f"(period = '{period}' AND bucket BETWEEN "
+                      f":first_{period} AND :end_{period})")
+    # the window around all ranges lets SQLite search the buckets by
+    # the primary key, for an OR alone it only uses the first column
+    params["first"] = min(params[f"first_{period}"] for period in PERIODS)
+    params["end"] = max(params[f"end_{period}"] for period in PERIODS)
+    periods = ", ".join(f"'{period}'" for period in PERIODS)
+    ranges = (f"period IN ({periods}) AND bucket BETWEEN :first AND :end "
+              f"AND ({' OR '.join(ranges)})")
+
+    execute(connection, "DELETE FROM HabitRollup WHERE habit_id = :habit_id "
+                        f"AND ({ranges})", params)
+    # both ends are first and last days, so the events are
+    # searched by the solved date index
+    insert_habits(connection, "user_id = :user_id AND habit_id = :habit_id "
+                              "AND datetime_solved BETWEEN :first_{period} "
+                              "AND :end_{period}", params)
+
+    if habit.cat_id:
+        execute(connection, "DELETE FROM CategoryRollup "
+                            f"WHERE cat_id = :cat_id AND ({ranges})", params)
+        insert_categories(connection, f"h.cat_id = :cat_id AND ({ranges})",
+                          params)
+
+
+def rebuild(connection, habit_ids=None, user_id=None):
+    """ Evaluates all buckets again from the events, only those of a
+    user, or only those of the given habit ids and of their categories """
+    if habit_ids is None:
+        params = {"user_id": user_id}
+        where = "1 = 1" if user_id is None else "user_id = :user_id"
+        execute(connection, f"DELETE FROM HabitRollup WHERE {where}", params)
+        execute(connection, f"DELETE FROM CategoryRollup WHERE {where}",
+                params)
+        insert_habits(connection, where, params)
+        insert_categories(connection, f"h.{where}" if user_id else where,
+                          params)
+        return
+
+    params = {"habit_ids": list(habit_ids)}
+    expanding = ("habit_ids",)
+    execute(connection, "DELETE FROM HabitRollup WHERE habit_id IN :habit_ids",
+            params, expanding)
+    insert_habits(connection, "habit_id IN :habit_ids", params, expanding)
+
+    categories = ("SELECT cat_id FROM Habit WHERE habit_id IN :habit_ids "
+                  "AND cat_id > 0")
+    execute(connection, f"DELETE FROM CategoryRollup WHERE cat_id IN "
+                        f"({categories})", params, expanding)
+    insert_categories(connection, f"h.cat_id IN ({categories})", params,
+                      expanding)
+
+
+def rebuild_category(connection, cat_id):
+    """ Evaluates all buckets of a category again, e.g. after a habit
+    moved into it or out of it """
+    params = {"cat_id": cat_id}
+    execute(connection, "DELETE FROM CategoryRollup WHERE cat_id = :cat_id",
+            params)
+    insert_categories(connection, "h.cat_id = :cat_id", params)
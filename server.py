@@ -0,0 +1,291 @@
+""" Small JSON HTTP server for haha-bits, built on the standard library.
+
+Requests are handled by a bounded pool of worker threads, every request
+is one unit of work of a HabitService on a pooled engine. Endpoints:
+
+    GET  /habits                     all habits
+    GET  /habits/today?day=          habits due today, or on day
+    POST /habits/<id>/checkoff       {"quota": 5, "done": true, "day": ...}
+    POST /habits/<id>/resolve        {"quota": 5, "done": true, "start": ...,
+                                     "end": ..., "event_ids": [...]}
+                                     resolves the pending events at once
+    GET  /events?habit_id=&start=&end=&status=&after=&limit=
+                                     one page of events, "next" is the
+                                     after value of the following page
+    GET  /analytics/streaks          current and longest streaks
+    GET  /analytics/scheduled/<day>  habits due on a weekday, 0 is Monday
+    GET  /analytics/average/<id>     average quota of a habit
+    GET  /analytics/trend?period=&habit_id=&cat_id=&start=&end=
+                                     completion rate per day, week or
+                                     month, read from the rollups
+
+The user is given by the header X-User-Id, default the user 1, every
+request sees only the data of its user.
+
+Answers are JSON, errors are {"error": ...} with the status 400 for bad
+input, 404 for unknown paths and 409, when the service refuses the
+operation, e.g. a checkoff of a habit, that is not due.
+"""
+import json
+import logging
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import database
+import models
+import service
+
+logger = logging.getLogger("haha-bits.server")
+
+# Worker threads and the connections, that may wait for a worker
+WORKERS = 8
+QUEUE_SIZE = 64
+
+# Largest page of the event list
+MAX_PAGE_SIZE = 100
+
+
+def habit_json(hab):
+    """ Returns a habit as dictionary for the JSON output """
+    return {"habit_id": hab.habit_id, "name": hab.name,
+            "enabled": hab.enabled, "cat_id": hab.cat_id,
+            "condition": hab.condition, "quota": hab.quota,
+            "unit": hab.unit, "weekday": hab.weekday,
+            "weekly": hab.is_weekly(), "streak": hab.latest_streak,
+            "longest_streak": hab.longest_streak}
+
+
+def event_json(event):
+    """ Returns an event as dictionary for the JSON output """
+    return {"event_id": event.event_id, "habit_id": event.habit_id,
+            "status": event.get_status(), "quota": event.quota,
+            "solved": event.datetime_solved.isoformat()}
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """ Maps the requests to the routes and answers with JSON """
+    server_version = "haha-bits/0.1"
+    # one request per connection, an idle keep-alive client would hold
+    # one of the few workers, while the others wait in the queue
+    protocol_version = "HTTP/1.0"
+    # seconds a slow client may take to send its request
+    timeout = 5
+    # headers and body are written apart, without TCP_NODELAY the
+    # body waits for the delayed ACK of the client
+    disable_nagle_algorithm = True
+
+    # method, path pattern and name of the route function
+    routes = [
+        ("GET", re.compile(r"^/habits$"), "habits"),
+        ("GET", re.compile(r"^/habits/today$"), "today"),
+        ("POST", re.compile(r"^/habits/(\d+)/checkoff$"), "checkoff"),
+        ("POST", re.compile(r"^/habits/(\d+)/resolve$"), "resolve"),
+        ("GET", re.compile(r"^/events$"), "events"),
+        ("GET", re.compile(r"^/analytics/streaks$"), "streaks"),
+        ("GET", re.compile(r"^/analytics/scheduled/([0-6])$"), "scheduled"),
+        ("GET", re.compile(r"^/analytics/average/(\d+)$"), "average"),
+        ("GET", re.compile(r"^/analytics/trend$"), "trend"),
+    ]
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """ Handles a GET request """
+        self.dispatch("GET")
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """ Handles a POST request """
+        self.dispatch("POST")
+
+    def dispatch(self, method):
+        """ Runs the route of the request, sends the answer and
+        logs the timing """
+        begin = time.perf_counter()
+        url = urlsplit(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+        status, body = 404, {"error": "Not found"}
+        try:
+            for route_method, pattern, name in self.routes:
+                match = pattern.match(url.path)
+                if match and route_method == method:
+                    status, body = 200, getattr(self, f"route_{name}")(
+                        query, *match.groups())
+                    break
+        except service.HabitError as error:
+            status, body = 409, {"error": str(error)}
+        except (ValueError, TypeError, KeyError) as error:
+            status, body = 400, {"error": f"Bad request: {error}"}
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("%s %s failed", method, self.path)
+            status, body = 500, {"error": "Internal error"}
+
+        self.send_json(status, body)
+        logger.info("%s %s %d %.1fms", method, self.path, status,
+                    (time.perf_counter() - begin) * 1000)
+
+    def send_json(self, status, body):
+        """ Sends a JSON answer """
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_json(self):
+        """ Returns the JSON body of a request, an empty body is {} """
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        body = json.loads(self.rfile.read(length))
+        if not isinstance(body, dict):
+            raise ValueError("the body needs to be an object")
+        return body
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """ The requests are logged with their timing by dispatch() """
+
+    @property
+    def habit_service(self):
+        """ The service of the server for the user of the request """
+        user_id = int(self.headers.get("X-User-Id") or models.DEFAULT_USER)
+        return self.server.habit_service.for_user(user_id)
+
+    def route_habits(self, query):
+        """ All habits """
+        return [habit_json(hab) for hab in self.habit_service.habits()]
+
+    def route_today(self, query):
+        """ Habits due on a day, default today """
+        day = models.to_date(query.get("day"))
+        return [{**habit_json(hab),
+                 "status": event.get_status() if event else "Open",
+                 "category": cat.cat_name if cat else None}
+                for hab, event, cat in self.habit_service.today(day)]
+
+    def route_checkoff(self, query, habit_id):
+        """ Checks off a habit """
+        body = self.read_json()
+        quota = body.get("quota")
+        habit, event = self.habit_service.checkoff(
+            int(habit_id), models.to_date(body.get("day")),
+            quota=None if quota is None else int(quota),
+            done=bool(body.get("done", True)))
+        return {**event_json(event), "streak": habit.latest_streak}
+
+    def route_resolve(self, query, habit_id):
+        """ Resolves the pending events of a habit at once """
+        body = self.read_json()
+        quota = body.get("quota")
+        event_ids = body.get("event_ids")
+        if event_ids is not None:
+            event_ids = [int(event_id) for event_id in event_ids]
+        habit, count = self.habit_service.resolve_events(
+            int(habit_id), event_ids, models.to_date(body.get("start")),
+            models.to_date(body.get("end")),
+            quota=None if quota is None else int(quota),
+            done=bool(body.get("done", True)))
+        return {"habit_id": habit.habit_id, "resolved": count,
+                "streak": habit.latest_streak}
+
+    def route_events(self, query):
+        """ A page of events, ordered by the solved date """
+        limit = min(int(query.get("limit", service.EVENT_PAGE_SIZE)),
+                    MAX_PAGE_SIZE)
+        filters = {
+            "habit_id": int(query["habit_id"]) if "habit_id" in query
+            else None,
+            "start": models.to_date(query.get("start")),
+            "end": models.to_date(query.get("end")),
+            "status": int(query["status"]) if "status" in query else None,
+        }
+        if "after" in query:
+            # the key of the last event of the previous page, day,event_id
+            day, event_id = query["after"].split(",")
+            filters["after"] = (models.to_date(day), int(event_id))
+
+        page = self.habit_service.event_page(limit=limit, **filters)
+        following = None
+        if len(page) == limit:
+            day, event_id = service.event_key(page[-1][1])
+            following = f"{day.isoformat()},{event_id}"
+        return {"events": [event_json(event) for _, event in page],
+                "next": following}
+
+    def route_streaks(self, query):
+        """ Current and longest streaks of all habits """
+        return [{"habit_id": hab.habit_id, "name": hab.name,
+                 "current": streaks.current, "longest": streaks.longest}
+                for hab, streaks in self.habit_service.streaks()]
+
+    def route_scheduled(self, query, weekday):
+        """ Habits due on a weekday """
+        return [habit_json(hab)
+                for hab in self.habit_service.scheduled(int(weekday))]
+
+    def route_average(self, query, habit_id):
+        """ Average quota of a habit """
+        habit, average = self.habit_service.average(int(habit_id))
+        return {"habit_id": habit.habit_id, "unit": habit.unit,
+                "average": average}
+
+    def route_trend(self, query):
+        """ Completion rate per bucket of a habit, category or all habits """
+        trend = self.habit_service.trend(
+            query.get("period", "month"),
+            int(query["habit_id"]) if "habit_id" in query else None,
+            int(query["cat_id"]) if "cat_id" in query else None,
+            models.to_date(query.get("start")),
+            models.to_date(query.get("end")))
+        return [{"bucket": row.bucket.isoformat(), "events": row.events,
+                 "completion": row.completion, "average": row.average,
+                 "change": row.change} for row in trend]
+
+
+class HabitServer(HTTPServer):
+    """ HTTP server with a bounded pool of worker threads. A worker
+    answers a single request and closes the connection. When all
+    workers are busy and the queue is full, new connections wait
+    in the listen backlog """
+
+    def __init__(self, address, habit_service, workers=WORKERS,
+                 queue_size=QUEUE_SIZE):
+        super().__init__(address, RequestHandler)
+        self.habit_service = habit_service
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix="http")
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+
+    def process_request(self, request, client_address):
+        """ Hands a connection to the worker pool """
+        self.slots.acquire()
+        self.executor.submit(self.process_request_thread, request,
+                             client_address)
+
+    def process_request_thread(self, request, client_address):
+        """ Handles a connection inside a worker thread """
+        try:
+            self.finish_request(request, client_address)
+        except Exception:  # pylint: disable=broad-except
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def server_close(self):
+        """ Closes the socket and waits for the running requests """
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+
+def create_server(path=None, preset=None, host="127.0.0.1", port=8080,
+                  workers=WORKERS):
+    """ Creates a server on a pooled engine with one connection
+    per worker, port 0 picks a free port """
+    engine = database.get_engine(path, preset, pool_size=workers)
+    habit_service = service.HabitService(
+        service.create_session_factory(engine))
+    return HabitServer((host, port), habit_service, workers)
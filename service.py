@@ -0,0 +1,1172 @@
+""" Business operations on habits, categories and events.
+
+The functions take the session to work on and leave committing to the
+caller, unless documented else. Every query is scoped by the user, so it
+stays inside the index range of that user. HabitService wraps them into
+units of work, every call gets an own session from a session factory,
+so one service can be used by several threads at once.
+"""
+import bisect
+import contextlib
+import datetime
+import os
+from collections import namedtuple
+from itertools import chain, groupby
+
+from sqlalchemy import Integer, and_, func, or_, type_coerce
+from sqlalchemy.orm import scoped_session, selectinload, sessionmaker
+
+import analytics
+import cache
+import models
+import rollups
+import sparse
+import vectorized
+
+# Number of events on one page of the event lists
+EVENT_PAGE_SIZE = 20
+
+# Number of habits committed at once by a persistence run
+PERSISTENCE_CHUNK = 50
+
+# Backend for the streak analytics, "python" streams the events through
+# the analytics functions, "sql" evaluates the streaks inside SQLite,
+# "numpy" loads the events into arrays, if NumPy is installed
+STREAK_BACKEND = os.environ.get("HAHABITS_STREAK_BACKEND", "python")
+
+# Storage of the events, "dense" stores a pending event for every missed
+# day, "sparse" stores only resolved events and derives the missed days
+EVENT_STORAGE = os.environ.get("HAHABITS_EVENT_STORAGE", "dense")
+
+# A bucket of a trend, the rollup figures with the derived missed days
+TrendBucket = namedtuple("TrendBucket",
+                         ["bucket", "done", "failed", "pending", "quota_sum"])
+
+
+class HabitError(ValueError):
+    """ Raised, when an operation is not possible for a habit """
+
+
+def get_owned(sqlsession, model, key, user_id):
+    """ Returns the object of a model by its primary key, if it belongs
+    to the user, else None. Objects of the identity map of the session
+    are returned without SQL """
+    obj = sqlsession.get(model, int(key))
+    if obj is None or obj.user_id != user_id:
+        return None
+    return obj
+
+
+def get_habit(sqlsession, habit_id, user_id=models.DEFAULT_USER):
+    """ Returns a habit of the user, or None """
+    return get_owned(sqlsession, models.Habit, habit_id, user_id)
+
+
+def get_category(sqlsession, cat_id, user_id=models.DEFAULT_USER):
+    """ Returns a category of the user, or None """
+    return get_owned(sqlsession, models.HabitCategory, cat_id, user_id)
+
+
+def get_event(sqlsession, event_id, user_id=models.DEFAULT_USER):
+    """ Returns an event of the user, or None """
+    return get_owned(sqlsession, models.HabitEvent, event_id, user_id)
+
+
+def get_habits(sqlsession, user_id=models.DEFAULT_USER):
+    """ Returns a query for the habits of the user """
+    return sqlsession.query(models.Habit).filter(
+        models.Habit.user_id == user_id)
+
+
+def get_categories(sqlsession, user_id=models.DEFAULT_USER):
+    """ Returns a query for the categories of the user """
+    return sqlsession.query(models.HabitCategory).filter(
+        models.HabitCategory.user_id == user_id)
+
+
+def get_habit_events(sqlsession, habit):
+    """ Returns a query for the events of a habit in the solved order """
+    return sqlsession.query(models.HabitEvent).filter(
+        models.HabitEvent.user_id == habit.user_id,
+        models.HabitEvent.habit_id == habit.habit_id).order_by(
+        models.HabitEvent.datetime_solved, models.HabitEvent.event_id)
+
+
+def is_sparse():
+    """ Checks if the missed days are derived instead of stored """
+    return EVENT_STORAGE == "sparse"
+
+
+def get_logical_events(sqlsession, habit, today=None, start=None, end=None):
+    """ Returns the events of a habit in the solved order, optional only
+    those from start till end. In the sparse storage, the derived
+    pending events of the missed days till today are part of them """
+    query = get_habit_events(sqlsession, habit)
+    if not is_sparse():
+        if start is not None:
+            query = query.filter(models.HabitEvent.datetime_solved >= start)
+        if end is not None:
+            query = query.filter(models.HabitEvent.datetime_solved <= end)
+        return query.all()
+
+    # a weekly habit is missed, when its whole week has no event
+    if start is not None:
+        query = query.filter(
+            models.HabitEvent.datetime_solved >= week_range(start)[0])
+    if end is not None:
+        query = query.filter(models.HabitEvent.datetime_solved <= end)
+    events = sparse.logical_events(habit, query.all(),
+                                   today or datetime.date.today(), start, end)
+    if start is None:
+        return events
+    return [event for event in events if event.datetime_solved >= start]
+
+
+def get_open_events(sqlsession, habit, today=None):
+    """ Returns the pending events of a habit in the solved order, in the
+    sparse storage with the derived ones of the missed days """
+    if not is_sparse():
+        return get_habit_events(sqlsession, habit).filter(
+            models.HabitEvent.status == 0).all()
+    return [event for event in get_logical_events(sqlsession, habit, today)
+            if event.status == 0]
+
+
+def week_range(day):
+    """ Returns the first (Monday) and the last day (Sunday)
+    of the week, that contains day """
+    s_week = day - datetime.timedelta(days=day.weekday())
+    return s_week, s_week + datetime.timedelta(days=6)
+
+
+def get_scheduled(sqlsession, weekday, user_id=models.DEFAULT_USER):
+    """ Returns the query of the enabled habits of the user due on a
+    weekday, 0 is Monday, weekly habits are due on every day """
+    return sqlsession.query(models.Habit).filter(
+        models.Habit.user_id == user_id,
+        models.due_on(weekday)).order_by(models.Habit.habit_id)
+
+
+def get_today(sqlsession, today, user_id=models.DEFAULT_USER):
+    """ Returns the habits of the user due on the day today with their
+    category and their event of today, or of this week for weekly
+    habits, if any.
+
+    Everything is pulled with one query, the result is a list of
+    (habit, event, category) tuples ordered by the habit id
+    """
+    s_week, e_week = week_range(today)
+    weekly = models.Habit.weekday == 128
+
+    rows = sqlsession.query(
+        models.Habit, models.HabitEvent, models.HabitCategory).join(
+        models.HabitEvent, and_(
+            models.HabitEvent.user_id == models.Habit.user_id,
+            models.HabitEvent.habit_id == models.Habit.habit_id,
+            # the whole week as range, so the index on habit and
+            # solved date is searched instead of all events of a habit,
+            # daily habits need the event of today
+            models.HabitEvent.datetime_solved >= s_week,
+            models.HabitEvent.datetime_solved <= e_week,
+            or_(weekly, models.HabitEvent.datetime_solved == today)),
+        isouter=True).join(
+        models.HabitCategory,
+        models.Habit.cat_id == models.HabitCategory.cat_id,
+        isouter=True).filter(
+        models.Habit.user_id == user_id,
+        # weekly habits are always due, daily ones by their weekday bit,
+        # read from the partial index of the weekday
+        models.due_on(today.weekday())).order_by(
+        models.Habit.habit_id, models.HabitEvent.event_id)
+
+    # A weekly habit can have more than one event in a week,
+    # only the first one is of interest
+    today_habits = []
+    seen = set()
+    for hab, event, cat in rows:
+        if hab.habit_id not in seen:
+            seen.add(hab.habit_id)
+            today_habits.append((hab, event, cat))
+
+    return today_habits
+
+
+def resolve_event(sqlsession, habit, event, quota=0, done=True):
+    """ Resolves an event without questions, habits with a condition are
+    graded by the quota, the others are done or failed. The streaks are
+    updated, committing is left to the caller """
+    if habit.needs_satisfaction():
+        event.set_quota(int(quota))
+        event.set_status(habit.satisfied(int(quota)))
+    else:
+        # Quota will be set to 0 for non condition-tracking habits
+        event.set_quota(0)
+        if done:
+            event.set_status_success()
+        else:
+            event.set_status_fail()
+
+    event.set_weekday(event.datetime_solved.weekday())
+    sqlsession.add(event)
+    update_streak_for_event(sqlsession, habit, event)
+    refresh_rollups(sqlsession, habit, event.datetime_solved)
+
+
+def set_category(sqlsession, habit, cat_id):
+    """ Moves a habit into a category, 0 for none. The rollups of both
+    categories are evaluated again, committing is left to the caller """
+    previous = habit.cat_id
+    habit.cat_id = cat_id
+    sqlsession.flush()
+    if previous != cat_id:
+        rollups.rebuild_category(sqlsession, previous)
+        rollups.rebuild_category(sqlsession, cat_id)
+
+
+def refresh_rollups(sqlsession, habit, start, end=None):
+    """ Evaluates the rollups of a habit and its category for the days
+    from start till end again, inside the transaction of the session """
+    sqlsession.flush()
+    rollups.refresh(sqlsession, habit, start, end)
+
+
+def get_checkoff_event(sqlsession, habit, day):
+    """ Returns the event of a habit, that a checkoff on day updates,
+    or None, when a new event needs to be created """
+
+    if is_sparse():
+        # a missed day is derived, resolving it stores it
+        start, end = week_range(day) if habit.is_weekly() else (day, day)
+        events = get_logical_events(sqlsession, habit, start=start, end=end)
+        return events[0] if events else None
+
+    # For a daily habit check if it was checked off on that day
+    if not habit.is_weekly():
+        return sqlsession.query(models.HabitEvent).filter(
+            models.HabitEvent.user_id == habit.user_id,
+            models.HabitEvent.habit_id == habit.habit_id,
+            models.HabitEvent.datetime_solved == day).first()
+
+    # For a weekly habit, we need to generate the week
+    # and then check for an event in this time period
+    sweek, eweek = week_range(day)
+    return sqlsession.query(models.HabitEvent).filter(
+        models.HabitEvent.user_id == habit.user_id,
+        models.HabitEvent.habit_id == habit.habit_id,
+        models.HabitEvent.datetime_solved >= sweek,
+        models.HabitEvent.datetime_solved <= eweek).order_by(
+        models.HabitEvent.event_id).first()
+
+
+def checkoff(sqlsession, habit, day, quota=0, done=True):
+    """ Checks off a habit for day without questions, the event of that
+    day (or week) is updated or created. Returns the committed event """
+    event = get_checkoff_event(sqlsession, habit, day)
+    if event is None:
+        event = models.HabitEvent(user_id=habit.user_id,
+                                  habit_id=habit.habit_id, datetime=day,
+                                  datetime_solved=day)
+
+    resolve_event(sqlsession, habit, event, quota=quota, done=done)
+    sqlsession.commit()
+    return event
+
+
+def resolve_events(sqlsession, habit, event_ids=None, start=None, end=None,
+                   quota=0, done=True):
+    """ Resolves the pending events of a habit at once, all of them or
+    only the given event ids and those solved from start till end.
+    Like resolve_event(), habits with a condition grade the same quota
+    for every event, the others are done or failed.
+
+    One UPDATE changes all events, the streaks and rollups are evaluated
+    once afterwards, committing is left to the caller. In the sparse
+    storage, the missed days are inserted as resolved events, unless
+    event ids are given. Returns the number of resolved events
+    """
+    conditions = [models.HabitEvent.user_id == habit.user_id,
+                  models.HabitEvent.habit_id == habit.habit_id,
+                  models.HabitEvent.status == 0]
+    if event_ids is not None:
+        conditions.append(models.HabitEvent.event_id.in_(list(event_ids)))
+    if start is not None:
+        conditions.append(models.HabitEvent.datetime_solved >= start)
+    if end is not None:
+        conditions.append(models.HabitEvent.datetime_solved <= end)
+
+    count, first, last = sqlsession.query(
+        func.count(), func.min(models.HabitEvent.datetime_solved),
+        func.max(models.HabitEvent.datetime_solved)).filter(
+        *conditions).one()
+
+    missed = []
+    if is_sparse() and event_ids is None:
+        since = start or sparse.first_day(habit)
+        if since is not None:
+            missed = list(sparse.missed_days(
+                habit, solved_dates(sqlsession, habit, week_range(since)[0]),
+                datetime.date.today(), start, end))
+    if missed:
+        first = min(first or missed[0], missed[0])
+        last = max(last or missed[-1], missed[-1])
+    if not count and not missed:
+        return 0
+
+    if habit.needs_satisfaction():
+        quota = int(quota)
+        status = habit.satisfied(quota)
+    else:
+        # Quota will be set to 0 for non condition-tracking habits
+        quota, status = 0, 1 if done else 2
+
+    # the day number 1 is a Monday
+    day = type_coerce(models.HabitEvent.datetime_solved, Integer)
+    if count:
+        sqlsession.query(models.HabitEvent).filter(*conditions).update(
+            {models.HabitEvent.status: status,
+             models.HabitEvent.quota: quota,
+             models.HabitEvent.weekday: (day - 1) % 7},
+            synchronize_session="fetch")
+    if missed:
+        sqlsession.bulk_insert_mappings(models.HabitEvent, [
+            {"user_id": habit.user_id, "habit_id": habit.habit_id,
+             "datetime": missed_day, "datetime_solved": missed_day,
+             "status": status, "quota": quota,
+             "weekday": missed_day.weekday()} for missed_day in missed])
+
+    refresh_rollups(sqlsession, habit, first, last)
+    recalculate_streak(sqlsession, habit.habit_id, commit=False)
+    return count + len(missed)
+
+
+def get_event_page(sqlsession, habit_id=None, start=None, end=None,
+                   status=None, after=None, before=None,
+                   limit=EVENT_PAGE_SIZE, user_id=models.DEFAULT_USER):
+    """ Returns one page of (habit, event) tuples of the user, ordered by
+    the solved date and the event id, optional filtered by habit, date
+    range and status.
+
+    after and before are the keys (solved date, event id) of the last
+    or the first event of the neighbouring page, so every page is
+    a seek on the index instead of an offset scan
+    """
+    query = sqlsession.query(models.Habit, models.HabitEvent).join(
+        models.HabitEvent).filter(models.HabitEvent.user_id == user_id)
+    if habit_id is not None:
+        query = query.filter(models.HabitEvent.habit_id == habit_id)
+    if start is not None:
+        query = query.filter(models.HabitEvent.datetime_solved >= start)
+    if end is not None:
+        query = query.filter(models.HabitEvent.datetime_solved <= end)
+    if status is not None:
+        query = query.filter(models.HabitEvent.status == status)
+
+    page = seek_page(query, after, before, limit)
+    if is_sparse() and habit_id is not None and status in (None, 0):
+        habit = get_habit(sqlsession, habit_id, user_id)
+        if habit is not None:
+            return get_logical_page(sqlsession, habit, page, start, end,
+                                    after, before, limit)
+    return page
+
+
+def seek_page(query, after=None, before=None, limit=EVENT_PAGE_SIZE):
+    """ Returns the page of (habit, event) tuples of a query, that
+    follows the key after or precedes the key before """
+    solved = models.HabitEvent.datetime_solved
+    event_id = models.HabitEvent.event_id
+    if before is not None:
+        # walk backwards from the key and turn the page around
+        query = query.filter(or_(
+            solved < before[0],
+            and_(solved == before[0], event_id < before[1]))).order_by(
+            solved.desc(), event_id.desc())
+        return list(reversed(list(query.limit(limit).yield_per(limit))))
+
+    if after is not None:
+        query = query.filter(or_(
+            solved > after[0],
+            and_(solved == after[0], event_id > after[1])))
+    return list(query.order_by(solved, event_id).limit(limit).yield_per(limit))
+
+
+def get_logical_page(sqlsession, habit, page, start=None, end=None,
+                     after=None, before=None, limit=EVENT_PAGE_SIZE):
+    """ Merges the derived events of the missed days into a page of the
+    stored events of a habit in the sparse storage.
+
+    The missed days are derived from the key on, window by window of
+    limit weeks, only until the page is full or its stored events are
+    passed. So a page stays a seek with bounded memory.
+    """
+    first_day = sparse.first_day(habit)
+    if first_day is None:
+        return page
+
+    today = datetime.date.today()
+    window = datetime.timedelta(weeks=limit + 1)
+    missed = []
+    if before is None:
+        low = max(day for day in (first_day, start, after and after[0])
+                  if day is not None)
+        high = today if end is None else min(today, end)
+        if len(page) == limit:
+            high = min(high, page[-1][1].datetime_solved)
+        while low <= high and len(missed) < limit:
+            last = min(high, low + window)
+            missed.extend(event for event in get_missed_events(
+                sqlsession, habit, low, last, today)
+                if after is None or event_key(event) > tuple(after))
+            low = last + sparse.ONE_DAY
+        # the stored events after the derived days follow on the next page
+        events = missed + [event for _, event in page if low > high or
+                           event.datetime_solved < low]
+    else:
+        high = min(today, before[0] if end is None else min(before[0], end))
+        low = first_day if start is None else max(first_day, start)
+        if len(page) == limit:
+            low = max(low, page[0][1].datetime_solved)
+        while low <= high and len(missed) < limit:
+            first = max(low, high - window)
+            missed[:0] = [event for event in get_missed_events(
+                sqlsession, habit, first, high, today)
+                if event_key(event) < tuple(before)]
+            high = first - sparse.ONE_DAY
+        events = missed + [event for _, event in page if low > high or
+                           event.datetime_solved > high]
+    events.sort(key=sparse.event_order)
+    if before is not None:
+        return [(habit, event) for event in events[-limit:]]
+    return [(habit, event) for event in events[:limit]]
+
+
+def get_missed_events(sqlsession, habit, start, end, today):
+    """ Returns the derived events of the missed days of a habit from
+    start till end, the stored events are searched for the window only """
+    # a weekly habit is missed, when its whole week has no event
+    solved = [day for (day,) in sqlsession.query(
+        models.HabitEvent.datetime_solved).filter(
+        models.HabitEvent.user_id == habit.user_id,
+        models.HabitEvent.habit_id == habit.habit_id,
+        models.HabitEvent.datetime_solved.between(
+            week_range(start)[0], end + sparse.ONE_WEEK)).order_by(
+        models.HabitEvent.datetime_solved)]
+    return [sparse.missed_event(habit, day) for day in sparse.missed_days(
+        habit, solved, today, start, end)]
+
+
+def iter_events(sqlsession, page_size=EVENT_PAGE_SIZE, **filters):
+    """ Streams all (habit, event) tuples matching the filters of
+    get_event_page() page by page, with bounded memory """
+    after = None
+    while True:
+        page = get_event_page(sqlsession, after=after, limit=page_size,
+                              **filters)
+        yield from page
+        if len(page) < page_size:
+            return
+        after = event_key(page[-1][1])
+
+
+def event_key(event):
+    """ Returns the key of an event for the page seeks, derived events
+    of the sparse storage have no event id """
+    return event.datetime_solved, event.event_id or 0
+
+
+def get_backend(backend=None):
+    """ Returns the analytics backend, default the configured one.
+    Without NumPy, the numpy backend falls back to python """
+    backend = backend or STREAK_BACKEND
+    if backend == "numpy" and not vectorized.AVAILABLE:
+        return "python"
+    return backend
+
+
+def compute_streaks(sqlsession, habit_ids=None, backend=None,
+                    user_id=models.DEFAULT_USER):
+    """ Evaluates the streaks of all habits of the user or the given
+    habit ids with the streak backend, default the configured one """
+    if is_sparse():
+        return get_logical_streaks(sqlsession, habit_ids, user_id)
+    backend = get_backend(backend)
+    if backend == "sql":
+        return analytics.get_streaks_sql(sqlsession, habit_ids, user_id)
+    if backend == "numpy":
+        return vectorized.get_streaks(vectorized.load_events(
+            sqlsession.connection(), habit_ids, user_id))
+
+    # Stream the habit_events in the order of habits and solved dates,
+    # without loading any event object
+    habit_events = sqlsession.query(
+        models.HabitEvent.habit_id, models.HabitEvent.status).filter(
+        models.HabitEvent.user_id == user_id)
+    if habit_ids is not None:
+        habit_events = habit_events.filter(
+            models.HabitEvent.habit_id.in_(habit_ids))
+
+    return analytics.get_streaks_grouped(habit_events.order_by(
+        models.HabitEvent.habit_id,
+        models.HabitEvent.datetime_solved,
+        models.HabitEvent.event_id).yield_per(1000))
+
+
+def get_logical_streaks(sqlsession, habit_ids=None,
+                        user_id=models.DEFAULT_USER):
+    """ Evaluates the streaks of the sparse storage, the stored events of
+    every habit are merged with its missed days """
+    habits = get_habits(sqlsession, user_id)
+    rows = sqlsession.query(
+        models.HabitEvent.habit_id, models.HabitEvent.status,
+        models.HabitEvent.datetime_solved, models.HabitEvent.event_id).filter(
+        models.HabitEvent.user_id == user_id)
+    if habit_ids is not None:
+        habits = habits.filter(models.Habit.habit_id.in_(habit_ids))
+        rows = rows.filter(models.HabitEvent.habit_id.in_(habit_ids))
+    stored = {habit_id: list(group) for habit_id, group in groupby(
+        rows.order_by(models.HabitEvent.habit_id,
+                      models.HabitEvent.datetime_solved,
+                      models.HabitEvent.event_id),
+        key=lambda row: row.habit_id)}
+
+    today = datetime.date.today()
+    # the pauses of all habits are loaded with one query
+    return analytics.get_streaks_grouped(chain.from_iterable(
+        sparse.logical_events(hab, stored.get(hab.habit_id, []), today)
+        for hab in habits.options(selectinload(models.Habit.pauses)).order_by(
+            models.Habit.habit_id)))
+
+
+def get_longest_streaks(sqlsession, habit_ids, backend=None,
+                        user_id=models.DEFAULT_USER):
+    """ get the longest streaks of many habits of the user at once,
+    evaluated from a single query. Returns a dictionary with the
+    habit id as key """
+    streaks = compute_streaks(sqlsession, habit_ids, backend, user_id)
+    return {habit_id: streaks.get(habit_id, analytics.NO_STREAKS).longest
+            for habit_id in habit_ids}
+
+
+def get_streak_list(sqlsession, backend=None, user_id=models.DEFAULT_USER):
+    """ Returns all habits of the user with their Streaks, as printed
+    by habit_streak_list """
+    habits = get_habits(sqlsession, user_id).all()
+
+    # The sql backend evaluates the streaks inside the database,
+    # else the maintained streaks of the habits are used
+    if get_backend(backend) == "sql":
+        streaks = analytics.get_streaks_sql(sqlsession, user_id=user_id)
+    else:
+        streaks = {hab.habit_id: analytics.Streaks(
+            hab.longest_streak, hab.latest_streak, 0) for hab in habits}
+
+    return [(hab, streaks.get(hab.habit_id, analytics.NO_STREAKS))
+            for hab in habits]
+
+
+def get_statistics(sqlsession, habit_ids=None, backend=None,
+                   user_id=models.DEFAULT_USER):
+    """ Evaluates the Statistics of all habits of the user or the given
+    habit ids. The numpy backend evaluates all habits at once on arrays,
+    the other backends run the pure Python analytics """
+    if get_backend(backend) == "numpy":
+        return vectorized.get_statistics(vectorized.load_events(
+            sqlsession.connection(), habit_ids, user_id))
+
+    habit_events = sqlsession.query(
+        models.HabitEvent.habit_id, models.HabitEvent.status,
+        models.HabitEvent.quota, models.HabitEvent.datetime_solved).filter(
+        models.HabitEvent.user_id == user_id)
+    if habit_ids is not None:
+        habit_events = habit_events.filter(
+            models.HabitEvent.habit_id.in_(habit_ids))
+    return analytics.get_statistics(habit_events.order_by(
+        models.HabitEvent.habit_id,
+        models.HabitEvent.datetime_solved,
+        models.HabitEvent.event_id).all())
+
+
+def get_trend(sqlsession, period="month", habit_id=None, cat_id=None,
+              start=None, end=None, user_id=models.DEFAULT_USER):
+    """ Returns the completion trend of a habit, a category or of all
+    habits of the user per day, week or month, read from the rollups.
+    In the sparse storage, the missed days are added as pending.
+    start and end limit the buckets """
+    if period not in rollups.PERIODS:
+        raise ValueError(f"period has to be one of "
+                         f"{', '.join(rollups.PERIODS)}, not {period}")
+
+    if habit_id is not None or cat_id is not None:
+        model = models.HabitRollup if habit_id is not None \
+            else models.CategoryRollup
+        buckets = sqlsession.query(model).filter(
+            model.user_id == user_id,
+            model.habit_id == habit_id if habit_id is not None
+            else model.cat_id == cat_id)
+    else:
+        # all habits, the buckets of the habits are added up
+        model = models.HabitRollup
+        buckets = sqlsession.query(
+            model.bucket, func.sum(model.done).label("done"),
+            func.sum(model.failed).label("failed"),
+            func.sum(model.pending).label("pending"),
+            func.sum(model.quota_sum).label("quota_sum")).filter(
+            model.user_id == user_id).group_by(model.bucket)
+
+    buckets = buckets.filter(model.period == period)
+    if start is not None:
+        buckets = buckets.filter(
+            model.bucket >= rollups.bucket_of(period, start))
+    if end is not None:
+        buckets = buckets.filter(model.bucket <= end)
+    buckets = buckets.order_by(model.bucket)
+
+    if is_sparse():
+        habits = get_habits(sqlsession, user_id)
+        if habit_id is not None:
+            habits = habits.filter(models.Habit.habit_id == habit_id)
+        elif cat_id is not None:
+            habits = habits.filter(models.Habit.cat_id == cat_id)
+        buckets = add_missed_buckets(sqlsession, buckets, period, habits,
+                                     start, end)
+    return analytics.get_completion_trend(buckets)
+
+
+def add_missed_buckets(sqlsession, buckets, period, habits, start=None,
+                       end=None):
+    """ Adds the missed days of the habits, that the sparse storage
+    derives, as pending events to the rollup buckets of a period.
+    The stored events are searched habit by habit.
+    Returns the TrendBucket list ordered by the bucket """
+    figures = {row.bucket: [row.done, row.failed, row.pending,
+                            row.quota_sum] for row in buckets}
+    first = None if start is None else rollups.bucket_of(period, start)
+    today = datetime.date.today()
+    for hab in habits.options(selectinload(models.Habit.pauses)):
+        since = sparse.first_day(hab)
+        if since is None:
+            continue
+        if first is not None:
+            since = max(since, first)
+        solved = solved_dates(sqlsession, hab, week_range(since)[0])
+        for day in sparse.missed_days(hab, solved, today, first):
+            bucket = rollups.bucket_of(period, day)
+            if end is None or bucket <= end:
+                figures.setdefault(bucket, [0, 0, 0, 0])[2] += 1
+    return [TrendBucket(bucket, *figures[bucket])
+            for bucket in sorted(figures)]
+
+
+def delete_habit(sqlsession, habit_id, user_id=models.DEFAULT_USER):
+    """ Deletes a habit of the user and its events, committing is left
+    to the caller. Returns False, if the habit does not exist """
+    habit = get_habit(sqlsession, habit_id, user_id)
+    if habit is None:
+        return False
+
+    cat_id = habit.cat_id
+    sqlsession.query(models.Habit).filter(
+        models.Habit.habit_id == habit_id).delete()
+    sqlsession.query(models.HabitEvent).filter(
+        models.HabitEvent.user_id == user_id,
+        models.HabitEvent.habit_id == habit_id).delete()
+    sqlsession.query(models.HabitPause).filter(
+        models.HabitPause.habit_id == habit_id).delete()
+    sqlsession.query(models.HabitRollup).filter(
+        models.HabitRollup.habit_id == habit_id).delete()
+    rollups.rebuild_category(sqlsession, cat_id)
+    return True
+
+
+def toggle_habit(sqlsession, habit, day=None):
+    """ Disables an enabled habit or enables a disabled one on day,
+    default today. The days since it was disabled become a pause of the
+    habit and it is caught up from day on. Committing is left to the
+    caller. Returns True, if the habit is enabled now """
+    day = day or datetime.date.today()
+    if habit.enabled:
+        habit.disable()
+    else:
+        # a disabled habit keeps the day it was disabled on
+        if habit.updated is not None and habit.updated < day:
+            habit.pauses.append(models.HabitPause(
+                user_id=habit.user_id, start=habit.updated, end=day))
+        habit.enable()
+        reset_watermark(sqlsession, habit.user_id)
+    # persistence() catches the events from day on
+    habit.set_updated(day)
+    return habit.enabled
+
+
+def delete_category(sqlsession, cat_id, user_id=models.DEFAULT_USER):
+    """ Deletes a category of the user, committing is left to the
+    caller. Returns False, if the category does not exist """
+    if get_category(sqlsession, cat_id, user_id) is None:
+        return False
+
+    sqlsession.query(models.HabitCategory).filter(
+        models.HabitCategory.cat_id == cat_id).delete()
+    sqlsession.query(models.CategoryRollup).filter(
+        models.CategoryRollup.cat_id == cat_id).delete()
+    return True
+
+
+def reset_event(sqlsession, event_id, user_id=models.DEFAULT_USER):
+    """ Sets an event of the user back to pending, so it can be checked
+    off again. Returns the committed event or None, if it does not exist """
+    event = get_event(sqlsession, event_id, user_id)
+    if event is None:
+        return None
+
+    # Set status of this event to 0 = PENDING with none quota
+    event.set_status(0)
+    event.set_quota(0)
+
+    # Execute against DB, the streaks and rollups need to be evaluated again
+    sqlsession.add(event)
+    refresh_rollups(sqlsession, event.Habit, event.datetime_solved)
+    recalculate_streak(sqlsession, event.habit_id)
+    return event
+
+
+def recalculate_streak(sqlsession, habit_id, commit=True):
+    """ recalculates streak of a habit by evaluating all events """
+    habit = sqlsession.query(models.Habit).get(habit_id)
+    if is_sparse():
+        events = get_logical_events(sqlsession, habit)
+        streaks = analytics.get_streaks_grouped(events).get(
+            habit_id, analytics.NO_STREAKS)
+        habit.set_streaks(streaks.current, streaks.longest,
+                          events[-1].datetime_solved if events else None)
+        if commit:
+            sqlsession.commit()
+        return
+
+    # stream all events in the solved order
+    habit_events = sqlsession.query(
+        models.HabitEvent.habit_id, models.HabitEvent.status).order_by(
+        models.HabitEvent.datetime_solved,
+        models.HabitEvent.event_id).filter(
+        models.HabitEvent.user_id == habit.user_id,
+        models.HabitEvent.habit_id == habit_id)
+    streaks = analytics.get_streaks_grouped(habit_events).get(
+        habit_id, analytics.NO_STREAKS)
+
+    # remember the latest evaluated event for the incremental updates
+    streak_date = sqlsession.query(
+        func.max(models.HabitEvent.datetime_solved)).filter(
+        models.HabitEvent.user_id == habit.user_id,
+        models.HabitEvent.habit_id == habit_id).scalar()
+
+    habit.set_streaks(streaks.current, streaks.longest, streak_date)
+    if commit:
+        sqlsession.commit()
+
+
+def update_streak_for_event(sqlsession, habit, event):
+    """ updates the streaks of a habit with a new or resolved event,
+    only when an older event has changed, all events are evaluated again """
+    solved = event.datetime_solved
+    if is_sparse():
+        # the event covers a week, that was evaluated as missed
+        if habit.is_weekly() and habit.streak_date is not None and \
+                habit.streak_date >= week_range(solved)[0]:
+            recalculate_streak(sqlsession, habit.habit_id, commit=False)
+            return
+        # a missed day since the evaluated events breaks the streak
+        previous = sparse.previous_due(habit, solved)
+        if previous is not None and (habit.streak_date is None or
+                                     previous > habit.streak_date):
+            habit.apply_event_streak(previous, 0)
+
+    if not habit.apply_event_streak(solved, event.status):
+        recalculate_streak(sqlsession, habit.habit_id, commit=False)
+
+
+def solved_dates(sqlsession, hab, since):
+    """ Returns a sorted list of all solved dates of a habit
+    from since on, pulled with a single query """
+    rows = sqlsession.query(models.HabitEvent.datetime_solved).filter(
+        models.HabitEvent.user_id == hab.user_id,
+        models.HabitEvent.habit_id == hab.habit_id,
+        models.HabitEvent.datetime_solved >= since)
+    return sorted(row.datetime_solved for row in rows)
+
+
+def backfill_weekly(sqlsession, hab, today):
+    """ Computes the missed weeks of a weekly habit, starting with
+    the week of the last update till the current week.
+
+    Returns a tuple with the event mappings to insert and the
+    startup messages
+    """
+    rows = []
+    messages = []
+
+    start = hab.updated
+    s_week, e_week = week_range(start)
+    solved = solved_dates(sqlsession, hab, s_week)
+
+    # As long as the s_week is smaller than today,
+    # continue to look for missed events
+    while s_week < today:
+        # Any event solved inside this week? bisect the sorted dates
+        pos = bisect.bisect_left(solved, s_week)
+        if pos == len(solved) or solved[pos] > e_week:
+            rows.append({"user_id": hab.user_id,
+                         "habit_id": hab.habit_id,
+                         "datetime": start,
+                         "datetime_solved": s_week,
+                         "weekday": start.weekday()})
+            messages.append(f"You missed {hab.name} "
+                            f"from {s_week} to {e_week},"
+                            f"please check(o)ff {hab.habit_id}")
+
+        # shift the week for 7 days
+        s_week = s_week + datetime.timedelta(days=7)
+        e_week = e_week + datetime.timedelta(days=7)
+
+    return rows, messages
+
+
+def backfill_daily(sqlsession, hab, today):
+    """ Computes the missed days of a daily habit, starting with
+    the day of the last update till yesterday.
+
+    Returns a tuple with the event mappings to insert and the
+    startup messages
+    """
+    rows = []
+    messages = []
+
+    start = hab.updated
+    solved = set(solved_dates(sqlsession, hab, start))
+
+    while start < today:
+        # if the habit is due on this weekday and there
+        # is no event for that specific day, it was missed
+        if hab.due_weekday(start.weekday()) and start not in solved:
+            rows.append({"user_id": hab.user_id,
+                         "habit_id": hab.habit_id,
+                         "datetime": start,
+                         "datetime_solved": start,
+                         "weekday": start.weekday()})
+            messages.append(f"You missed {hab.name} "
+                            f"on {start}, please run check(o)ff"
+                            f" {hab.habit_id}")
+
+        # advance loop to the next day
+        start = start + datetime.timedelta(days=1)
+
+    return rows, messages
+
+
+def get_catch_up_habits(sqlsession, today, user_id=models.DEFAULT_USER):
+    """ Returns the query of the enabled habits of the user, that are not
+    caught up till today, weekly habits first """
+    return get_habits(sqlsession, user_id).filter(
+        models.Habit.enabled,
+        models.Habit.weekday != 0,
+        models.Habit.updated < today).order_by(
+        (models.Habit.weekday == models.WEEKLY).desc(),
+        models.Habit.habit_id)
+
+
+def get_catch_up_ids(sqlsession, today, user_id=models.DEFAULT_USER):
+    """ Returns the ids of the habits, that a persistence run catches up,
+    without a user those of all users """
+    if user_id is None:
+        return [habit_id for user in get_users(sqlsession)
+                for habit_id in get_catch_up_ids(sqlsession, today, user)]
+    return [habit_id for (habit_id,) in get_catch_up_habits(
+        sqlsession, today, user_id).with_entities(models.Habit.habit_id)]
+
+
+def catch_up_habit(sqlsession, hab, today):
+    """ Inserts the missed events of a habit till today, unless they are
+    derived in the sparse storage, and advances its update date.
+    Returns the startup messages, committing is left to the caller """
+    backfill = backfill_weekly if hab.is_weekly() else backfill_daily
+    rows, messages = backfill(sqlsession, hab, today)
+    hab.set_updated(today)
+
+    # the sparse storage derives the missed events, they are not stored
+    if rows and not is_sparse():
+        sqlsession.bulk_insert_mappings(models.HabitEvent, rows)
+        # the rows are in the order of the days
+        rollups.refresh(sqlsession, hab, rows[0]["datetime_solved"],
+                        rows[-1]["datetime_solved"])
+
+    # missed events are appended as pending and break the
+    # streak, only if one is older than the evaluated
+    # events, rebuild
+    if rows and not all(hab.apply_event_streak(row["datetime_solved"], 0)
+                        for row in rows):
+        recalculate_streak(sqlsession, hab.habit_id, commit=False)
+    return messages
+
+
+def get_users(sqlsession):
+    """ Returns the ids of the users with habits """
+    return [user for (user,) in sqlsession.query(
+        models.Habit.user_id).distinct().order_by(models.Habit.user_id)]
+
+
+def iter_persistence(sqlsession, today, user_id=models.DEFAULT_USER):
+    """ Catches the missed events of a user habit by habit, weekly habits
+    first. Without a user, all users are run one after the other.
+    Yields the habit id and the startup messages after every habit,
+    committing is left to the caller """
+    if user_id is None:
+        for user in get_users(sqlsession):
+            yield from iter_persistence(sqlsession, today, user)
+        return
+
+    for hab in get_catch_up_habits(sqlsession, today, user_id).all():
+        yield hab.habit_id, catch_up_habit(sqlsession, hab, today)
+
+
+def get_watermark(sqlsession, user_id=models.DEFAULT_USER):
+    """ Returns the day of the last complete persistence run of the
+    user, None if there was none """
+    run = sqlsession.get(models.PersistenceRun, user_id)
+    return run.completed if run is not None else None
+
+
+def reset_watermark(sqlsession, user_id=models.DEFAULT_USER):
+    """ Removes the watermark of the user, the next persistence run looks
+    for habits to catch up again. Needed, when a habit is enabled or
+    added after a complete run, committing is left to the caller """
+    sqlsession.query(models.PersistenceRun).filter_by(
+        user_id=user_id).delete()
+
+
+def run_persistence(sqlsession, today, user_id=models.DEFAULT_USER,
+                    chunk_size=PERSISTENCE_CHUNK):
+    """ Catches the missed events as a resumable job.
+
+    When the watermark of the user is today, the run is complete and
+    nothing is done, see reset_watermark(). Otherwise the habits, that
+    are not caught up, are committed in chunks of chunk_size habits, so
+    the write lock is never held for long and a run, that was stopped,
+    goes on with the habits left. The watermark is committed, when all habits are caught up.
+    Without a user, all users are run one after the other.
+
+    Yields the list of (habit id, startup messages) of every committed
+    chunk
+    """
+    if user_id is None:
+        for user in get_users(sqlsession):
+            yield from run_persistence(sqlsession, today, user, chunk_size)
+        return
+
+    completed = get_watermark(sqlsession, user_id)
+    if completed is not None and completed >= today:
+        return
+
+    habit_ids = get_catch_up_ids(sqlsession, today, user_id)
+    for start in range(0, len(habit_ids), chunk_size):
+        chunk = [(hab.habit_id, catch_up_habit(sqlsession, hab, today))
+                 for hab in get_catch_up_habits(
+                     sqlsession, today, user_id).filter(
+                     models.Habit.habit_id.in_(
+                         habit_ids[start:start + chunk_size]))]
+        sqlsession.commit()
+        yield chunk
+
+    sqlsession.merge(models.PersistenceRun(user_id=user_id, completed=today))
+    sqlsession.commit()
+
+
+class HabitService:
+    """ Business operations as units of work.
+
+    Every call opens a session from the session factory, commits on
+    success, rolls back on an error and closes the session. Returned
+    objects are detached, but keep their loaded values, when the factory
+    of create_session_factory() is used. A service works on the data of
+    one user, for_user() gives the service of another user. The services
+    of all users share one LookupCache of the habit metadata.
+    """
+
+    def __init__(self, session_factory, streak_backend=None,
+                 user_id=models.DEFAULT_USER, lookup_cache=None):
+        self.session_factory = session_factory
+        self.streak_backend = streak_backend
+        self.user_id = user_id
+        self.lookup_cache = lookup_cache or cache.LookupCache()
+
+    def for_user(self, user_id):
+        """ Returns a service on the same sessions for another user """
+        if user_id == self.user_id:
+            return self
+        return HabitService(self.session_factory, self.streak_backend,
+                            user_id, self.lookup_cache)
+
+    @contextlib.contextmanager
+    def unit_of_work(self):
+        """ Yields a session, that is committed at the end """
+        sqlsession = self.session_factory()
+        try:
+            yield sqlsession
+            sqlsession.commit()
+        except BaseException:
+            sqlsession.rollback()
+            raise
+        finally:
+            sqlsession.close()
+            # a scoped session is forgotten by its thread
+            if isinstance(self.session_factory, scoped_session):
+                self.session_factory.remove()
+
+    def today(self, day=None):
+        """ Returns the (habit, event, category) tuples due on day """
+        with self.unit_of_work() as sqlsession:
+            return get_today(sqlsession, day or datetime.date.today(),
+                             self.user_id)
+
+    def habits(self):
+        """ Returns all habits """
+        with self.unit_of_work() as sqlsession:
+            return get_habits(sqlsession, self.user_id).all()
+
+    def categories(self):
+        """ Returns all categories """
+        with self.unit_of_work() as sqlsession:
+            return get_categories(sqlsession, self.user_id).all()
+
+    def scheduled(self, weekday):
+        """ Returns the enabled habits due on a weekday """
+        with self.unit_of_work() as sqlsession:
+            return get_scheduled(sqlsession, weekday, self.user_id).all()
+
+    def average(self, habit_id):
+        """ Returns a habit and the average quota of its events, None
+        without events. Raises HabitError, if the habit does not exist """
+        with self.unit_of_work() as sqlsession:
+            habit = self.lookup_cache.habit(sqlsession, habit_id,
+                                            self.user_id)
+            if habit is None:
+                raise HabitError("This habit does not exist")
+            events = get_habit_events(sqlsession, habit).all()
+            if not events:
+                return habit, None
+            return habit, analytics.get_calculate_avg(events)
+
+    def streaks(self):
+        """ Returns all habits with their Streaks """
+        with self.unit_of_work() as sqlsession:
+            return get_streak_list(sqlsession, self.streak_backend,
+                                   self.user_id)
+
+    def longest_streaks(self, habit_ids):
+        """ Returns the longest streaks of the habit ids """
+        with self.unit_of_work() as sqlsession:
+            return get_longest_streaks(sqlsession, habit_ids,
+                                       self.streak_backend, self.user_id)
+
+    def statistics(self, habit_ids=None):
+        """ Returns the Statistics of the habits, see get_statistics """
+        with self.unit_of_work() as sqlsession:
+            return get_statistics(sqlsession, habit_ids, self.streak_backend,
+                                  self.user_id)
+
+    def trend(self, period="month", habit_id=None, cat_id=None, start=None,
+              end=None):
+        """ Returns the completion trend, see get_trend """
+        with self.unit_of_work() as sqlsession:
+            return get_trend(sqlsession, period, habit_id, cat_id, start,
+                             end, self.user_id)
+
+    def rebuild_rollups(self):
+        """ Evaluates the rollups of the habits of the user again from
+        the events """
+        with self.unit_of_work() as sqlsession:
+            rollups.rebuild(sqlsession, user_id=self.user_id)
+
+    def event_page(self, **filters):
+        """ Returns a page of (habit, event) tuples, see get_event_page """
+        with self.unit_of_work() as sqlsession:
+            return get_event_page(sqlsession, user_id=self.user_id, **filters)
+
+    def checkoff(self, habit_id, day=None, quota=None, done=True):
+        """ Checks off a habit on day, default today. Raises HabitError,
+        if the habit does not exist, is not due or needs a quota.
+        Returns the habit and the event """
+        day = day or datetime.date.today()
+        with self.unit_of_work() as sqlsession:
+            # the checks are answered by the cache, only a valid
+            # checkoff loads the habit for its streaks
+            info = self.lookup_cache.habit(sqlsession, habit_id, self.user_id)
+            if info is None:
+                raise HabitError("This habit does not exist")
+            if not info.due_weekday(day.weekday()):
+                raise HabitError(f"{info.name} is not due on {day}")
+            if info.needs_satisfaction() and quota is None:
+                raise HabitError(f"{info.get_satisfaction()} "
+                                 f"Please give a quota.")
+
+            habit = get_habit(sqlsession, habit_id, self.user_id)
+            event = checkoff(sqlsession, habit, day, quota=quota or 0,
+                             done=done)
+            return habit, event
+
+    def resolve_events(self, habit_id, event_ids=None, start=None, end=None,
+                       quota=None, done=True):
+        """ Resolves the pending events of a habit at once, see
+        resolve_events(). Raises HabitError, if the habit does not exist
+        or needs a quota. Returns the habit and the number of events """
+        with self.unit_of_work() as sqlsession:
+            habit = get_habit(sqlsession, habit_id, self.user_id)
+            if habit is None:
+                raise HabitError("This habit does not exist")
+            if habit.needs_satisfaction() and quota is None:
+                raise HabitError(f"{habit.get_satisfaction()} "
+                                 f"Please give a quota.")
+
+            count = resolve_events(sqlsession, habit, event_ids, start, end,
+                                   quota=quota or 0, done=done)
+            return habit, count
+
+    def persist(self, day=None):
+        """ Catches the missed events till day, default today.
+        Returns the startup messages """
+        messages = []
+        with self.unit_of_work() as sqlsession:
+            for chunk in run_persistence(
+                    sqlsession, day or datetime.date.today(), self.user_id):
+                for _, habit_messages in chunk:
+                    messages.extend(habit_messages)
+        return messages
+
+    def delete_habit(self, habit_id):
+        """ Deletes a habit and its events, False if it does not exist """
+        with self.unit_of_work() as sqlsession:
+            deleted = delete_habit(sqlsession, habit_id, self.user_id)
+        self.lookup_cache.invalidate_habit(habit_id)
+        return deleted
+
+    def delete_category(self, cat_id):
+        """ Deletes a category, False if it does not exist """
+        with self.unit_of_work() as sqlsession:
+            deleted = delete_category(sqlsession, cat_id, self.user_id)
+        self.lookup_cache.invalidate_category(cat_id)
+        return deleted
+
+    def reset_event(self, event_id):
+        """ Sets an event back to pending, None if it does not exist """
+        with self.unit_of_work() as sqlsession:
+            return reset_event(sqlsession, event_id, self.user_id)
+
+    def recalculate_streak(self, habit_id):
+        """ Evaluates the streaks of a habit from all its events """
+        with self.unit_of_work() as sqlsession:
+            if get_habit(sqlsession, habit_id, self.user_id) is None:
+                raise HabitError("This habit does not exist")
+            recalculate_streak(sqlsession, habit_id, commit=False)
+
+
+def create_session_factory(engine):
+    """ Returns a thread-local session factory for a HabitService, the
+    objects keep their values after the commit """
+    return scoped_session(sessionmaker(bind=engine, expire_on_commit=False))
@@ -0,0 +1,138 @@
+""" Sparse event storage: only the events, that were resolved, are stored.
+
+In the dense storage, the persistence inserts a pending event for every
+missed day, the events grow with the calendar days of every habit. In
+the sparse storage the missed days are derived instead: every day a
+habit is due on since its creation (for weekly habits every week) till
+yesterday, that has no stored event, is missed. The derived events are
+transient HabitEvent objects with the status pending and without an
+event id, resolving one adds it to the session like a new event.
+
+Days a habit was disabled are not missed, the periods are the pauses
+of the habit. While a habit is disabled, the days since its last
+update are not missed.
+
+The functions work on the habit with its pauses and the solved dates
+of its stored events, sorted, they do not query the database.
+"""
+import bisect
+import datetime
+
+import models
+
+ONE_DAY = datetime.timedelta(days=1)
+ONE_WEEK = datetime.timedelta(days=7)
+
+
+def first_day(habit):
+    """ Returns the first day, the habit is tracked, older habits may
+    only know the day of the last update """
+    return habit.created or habit.updated
+
+
+def due_days(habit, start, end):
+    """ Yields the days from start till before end, the habit is due on,
+    for a weekly habit the Mondays of the weeks """
+    if habit.is_weekly():
+        day = start - datetime.timedelta(days=start.weekday())
+        while day < end:
+            yield day
+            day += ONE_WEEK
+        return
+
+    day = start
+    while day < end:
+        if habit.due_weekday(day.weekday()):
+            yield day
+        day += ONE_DAY
+
+
+def get_pause(habit, day):
+    """ Returns the pause of the habit, that holds day, or None """
+    for pause in habit.pauses:
+        if pause.covers(day):
+            return pause
+    return None
+
+
+def is_covered(habit, solved, day):
+    """ Checks if the sorted solved dates hold an event on day, for
+    a weekly habit inside the week starting with day """
+    pos = bisect.bisect_left(solved, day)
+    last = day + ONE_WEEK - ONE_DAY if habit.is_weekly() else day
+    return pos < len(solved) and solved[pos] <= last
+
+
+def missed_days(habit, solved, today, start=None, end=None):
+    """ Yields the due days before today without an event, optional only
+    those from start till end. solved are the sorted solved dates of the
+    stored events """
+    first = first_day(habit)
+    if first is None:
+        return
+    # a disabled habit is not tracked since the day it was disabled
+    if not habit.enabled and habit.updated is not None:
+        today = min(today, habit.updated)
+    if start is not None:
+        first = max(first, start)
+    stop = today if end is None else min(today, end + ONE_DAY)
+
+    for day in due_days(habit, first, stop):
+        # the Monday of the first week may be before start
+        if start is not None and day < start:
+            continue
+        if not is_covered(habit, solved, day) and \
+                get_pause(habit, day) is None:
+            yield day
+
+
+def missed_event(habit, day):
+    """ Returns the transient pending event of a missed day """
+    return models.HabitEvent(user_id=habit.user_id, habit_id=habit.habit_id,
+                             datetime=day, datetime_solved=day, status=0,
+                             quota=0, weekday=day.weekday())
+
+
+def event_order(event):
+    """ Sort key of stored and derived events, the solved order """
+    return event.datetime_solved, event.event_id or 0
+
+
+def logical_events(habit, stored, today, start=None, end=None):
+    """ Returns the stored events of a habit with the derived events of
+    the missed days, in the solved order. stored are the events from
+    start till end in the solved order, objects or rows with habit_id,
+    status, datetime_solved and event_id """
+    stored = list(stored)
+    solved = [event.datetime_solved for event in stored]
+    missed = [missed_event(habit, day)
+              for day in missed_days(habit, solved, today, start, end)]
+    return sorted(stored + missed, key=event_order)
+
+
+def previous_due(habit, day):
+    """ Returns the last day before day, the habit was due on and not
+    paused, for a weekly habit the Monday of a previous week. None, if
+    the habit was not tracked yet """
+    first = first_day(habit)
+    if habit.is_weekly():
+        previous = day - datetime.timedelta(days=day.weekday()) - ONE_WEEK
+    else:
+        previous = day - ONE_DAY
+        # at most one week back, any weekday bit is inside it
+        while not habit.due_weekday(previous.weekday()):
+            previous -= ONE_DAY
+            if previous < day - ONE_WEEK:
+                return None
+
+    if first is None or previous < first - datetime.timedelta(
+            days=first.weekday() if habit.is_weekly() else 0):
+        return None
+    pause = get_pause(habit, previous)
+    if pause is None:
+        return previous
+    # the last due day before the pause, for a weekly habit the
+    # week of the day before the pause
+    if habit.is_weekly():
+        return previous_due(habit, pause.start - ONE_DAY + ONE_WEEK)
+    return previous_due(habit, pause.start)
@@ -1,11 +1,26 @@
 """ Test cases """
+import datetime
+import json
+
+import pytest
+import sqlalchemy
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
 import analytics
 import app
 import base
+import cache
+import database
+import eventstore
+import migrations
 import models
+import rollups
+import server
+import service
+import transfer
+import vectorized
+import worker
 
 # Create SQLite inside memory
 # Create connection to sqlite database
@@ -353,3 +368,1192 @@ def test_analytics_habits_weekday():
     assert len(habits_within_weekday) == 4
     habits_within_weekday = analytics.get_habits_weekday(habits, 0)
     assert len(habits_within_weekday) == 2
+
+
+def fresh_session():
+    """ Returns a session bound to a new and empty database in memory """
+    fresh_engine = create_engine('sqlite:///', echo=False)
+    base.Base.metadata.create_all(fresh_engine)
+    return sessionmaker(bind=fresh_engine)()
+
+
+def test_persistence_backfill():
+    """ Test the backfill of missed events on startup """
+    app.session = fresh_session()
+    today = datetime.date.today()
+    start = today - datetime.timedelta(days=21)
+
+    # One habit for every day, one weekly habit
+    daily = models.Habit(name="Stretching", enabled=True)
+    for i in range(0, 7):
+        daily.add_day(i)
+    daily.set_updated(str(start))
+    weekly = models.Habit(name="Cleaning", enabled=True)
+    weekly.set_weekly()
+    weekly.set_updated(str(start))
+    app.session.add_all([daily, weekly])
+    app.session.commit()
+
+    # A solved event in between must not be backfilled again
+    solved = start + datetime.timedelta(days=3)
+    app.session.add(models.HabitEvent(habit_id=daily.habit_id,
+                                      datetime=str(solved),
+                                      datetime_solved=str(solved),
+                                      status=1))
+    app.session.commit()
+
+    messages = app.persistence()
+    events = app.session.query(models.HabitEvent).filter(
+        models.HabitEvent.habit_id == daily.habit_id,
+        models.HabitEvent.status == 0).all()
+    assert len(events) == 20
+    assert today not in [event.datetime_solved for event in events]
+    assert messages[0].startswith("You missed Cleaning from")
+    assert len(messages) == 20 + len(
+        app.session.query(models.HabitEvent).filter(
+            models.HabitEvent.habit_id == weekly.habit_id).all())
+    assert daily.latest_streak == 0
+
+    # A second run has nothing left to do
+    assert app.persistence() == []
+
+
+def test_migrations():
+    """ Test the schema upgrade of an existing database """
+    upgrade_engine = create_engine('sqlite:///', echo=False)
+    base.Base.metadata.create_all(upgrade_engine)
+
+    # Simulate an old database without any index
+    with upgrade_engine.begin() as connection:
+        for name in ("ix_HabitEvent_user_id_habit_id_datetime_solved",
+                     "ix_HabitEvent_user_id_habit_id_status",
+                     "ix_Habit_cat_id", "ix_Habit_due_0"):
+            connection.exec_driver_sql(f"DROP INDEX {name}")
+
+    assert migrations.migrate(upgrade_engine) == [
+        step.__name__ for step in migrations.STEPS]
+
+    with upgrade_engine.connect() as connection:
+        assert migrations.get_version(connection) == len(migrations.STEPS) \
+            == database.SCHEMA_VERSION
+        indexes = [row.name for row in connection.exec_driver_sql(
+            "SELECT name FROM sqlite_master WHERE type = 'index'")]
+    # the event indexes lead with the user
+    assert "ix_HabitEvent_user_id_habit_id_datetime_solved" in indexes
+    assert "ix_HabitEvent_user_id_habit_id_status" in indexes
+    assert "ix_HabitEvent_habit_id_datetime_solved" not in indexes
+    assert "ix_Habit_cat_id" in indexes
+    assert "ix_Habit_due_0" in indexes
+
+    # Nothing left to upgrade
+    assert migrations.migrate(upgrade_engine) == []
+
+
+def test_analytics_streaks_grouped():
+    """ Test the single pass streak engine against the fixtures """
+    habit_events = session.query(
+        models.HabitEvent.habit_id, models.HabitEvent.status).order_by(
+        models.HabitEvent.habit_id, models.HabitEvent.event_id)
+
+    streaks = analytics.get_streaks_grouped(habit_events)
+    assert streaks[1] == analytics.Streaks(3, 0, 2)
+    assert streaks[2].longest == 11
+    assert streaks[3] == analytics.Streaks(2, 0, 2)
+    assert streaks[4] == analytics.Streaks(4, 4, 1)
+    assert streaks[5].longest == 1
+    assert 6 not in streaks
+
+    # Works on any iterator, also an empty one
+    assert analytics.get_streaks_grouped(iter([])) == {}
+
+
+def test_incremental_streaks():
+    """ Test the streak updates with new and older events """
+    app.session = fresh_session()
+    hab = models.Habit(name="Juggling", enabled=True)
+    hab.add_day(0)
+    app.session.add(hab)
+    app.session.commit()
+
+    # New events are applied one by one
+    events = []
+    for i, status in enumerate([1, 1, 2, 1, 1, 1]):
+        day = datetime.date(2022, 1, 3) + datetime.timedelta(days=7 * i)
+        event = models.HabitEvent(habit_id=hab.habit_id, datetime=str(day),
+                                  datetime_solved=str(day), status=status)
+        app.session.add(event)
+        service.update_streak_for_event(app.session, hab, event)
+        events.append(event)
+    app.session.commit()
+    assert (hab.latest_streak, hab.longest_streak) == (3, 3)
+    assert hab.streak_date == datetime.date(2022, 2, 7)
+
+    # A changed older event needs a rebuild of the streaks
+    events[2].set_status_success()
+    service.update_streak_for_event(app.session, hab, events[2])
+    app.session.commit()
+    assert (hab.latest_streak, hab.longest_streak) == (6, 6)
+
+    events[5].set_status_fail()
+    service.recalculate_streak(app.session, hab.habit_id)
+    assert (hab.latest_streak, hab.longest_streak) == (0, 5)
+
+
+def test_analytics_streaks_sql():
+    """ Test the streaks evaluated by SQLite against the fixtures """
+    streaks = analytics.get_streaks_sql(session)
+
+    for habit_id in range(1, 6):
+        habit_events = session.query(models.HabitEvent).order_by(
+            models.HabitEvent.datetime_solved,
+            models.HabitEvent.event_id).filter(
+            models.HabitEvent.habit_id == habit_id).all()
+        statuses = "".join(str(event.status) for event in habit_events)
+        assert streaks[habit_id].longest == \
+            analytics.get_lstreaks_single(statuses)
+
+        # Same figures as the python engine
+        assert streaks[habit_id] == analytics.get_streaks_grouped(
+            habit_events)[habit_id]
+
+    assert analytics.get_streaks_sql(session, [4]) == {
+        4: analytics.Streaks(4, 4, 1)}
+    assert analytics.get_streaks_sql(session, []) == {}
+
+
+def test_today_single_query():
+    """ Test today's habits with their events from a single query """
+    app.session = fresh_session()
+    today = datetime.date.today()
+    s_week, _ = service.week_range(today)
+
+    due = models.Habit(name="Due", enabled=True)
+    due.add_day(today.weekday())
+    not_due = models.Habit(name="Not due", enabled=True)
+    not_due.add_day((today.weekday() + 1) % 7)
+    weekly = models.Habit(name="Weekly", enabled=True)
+    weekly.set_weekly()
+    disabled = models.Habit(name="Disabled", enabled=False)
+    disabled.add_day(today.weekday())
+    app.session.add_all([due, not_due, weekly, disabled])
+    app.session.commit()
+
+    app.session.add_all([
+        models.HabitEvent(habit_id=due.habit_id,
+                          datetime_solved=str(today), status=1),
+        models.HabitEvent(habit_id=weekly.habit_id,
+                          datetime_solved=str(s_week), status=2),
+        models.HabitEvent(habit_id=weekly.habit_id,
+                          datetime_solved=str(s_week), status=1)])
+    app.session.commit()
+
+    # Count the statements sent to the database
+    statements = []
+    sqlalchemy.event.listen(app.session.bind, "before_cursor_execute",
+                            lambda *args: statements.append(args[2]))
+    rows = service.get_today(app.session, today)
+    assert len(statements) == 1
+
+    assert [(hab.name, event.get_status() if event else None)
+            for hab, event, _ in rows] == [("Due", "Done"),
+                                           ("Weekly", "Failed")]
+
+
+def test_longest_streaks_batch():
+    """ Test the batch lookup of the longest streaks """
+    app.session = session
+
+    # Count the statements sent to the database
+    statements = []
+
+    def count(*args):
+        statements.append(args[2])
+
+    sqlalchemy.event.listen(engine, "before_cursor_execute", count)
+    streaks = service.get_longest_streaks(app.session, [1, 2, 3, 4, 5, 6])
+    sqlalchemy.event.remove(engine, "before_cursor_execute", count)
+
+    assert len(statements) == 1
+    assert streaks == {
+        habit_id: analytics.get_streaks_sql(session).get(
+            habit_id, analytics.NO_STREAKS).longest
+        for habit_id in range(1, 7)}
+    assert app.get_longest_streak_for_habit(4) == 4
+
+
+def test_migrations_day_numbers():
+    """ Test the conversion of text dates into day numbers """
+    upgrade_engine = create_engine('sqlite:///', echo=False)
+
+    # Tables of the first schema version, dates stored as text
+    with upgrade_engine.begin() as connection:
+        connection.exec_driver_sql(
+            "CREATE TABLE HabitCategory (cat_id INTEGER NOT NULL, "
+            "cat_name VARCHAR NOT NULL, PRIMARY KEY (cat_id), "
+            "UNIQUE (cat_name))")
+        connection.exec_driver_sql(
+            "CREATE TABLE Habit (habit_id INTEGER NOT NULL, cat_id INTEGER, "
+            "name VARCHAR NOT NULL, enabled BOOLEAN, created VARCHAR, "
+            "updated VARCHAR, condition VARCHAR, quota INTEGER, "
+            "unit VARCHAR, weekday INTEGER, latest_streak INTEGER, "
+            "PRIMARY KEY (habit_id))")
+        connection.exec_driver_sql(
+            "CREATE TABLE HabitEvent (event_id INTEGER NOT NULL, "
+            "habit_id INTEGER, datetime VARCHAR, datetime_solved VARCHAR, "
+            "weekday INTEGER, status INTEGER, quota INTEGER, "
+            "PRIMARY KEY (event_id))")
+        connection.exec_driver_sql(
+            "INSERT INTO Habit VALUES (1, NULL, 'Running', 1, "
+            "'2022-01-01', '2022-01-31', '', 0, '', 127, 0)")
+        for day, status in (("2022-01-9", 1), ("2022-01-10", 1),
+                            ("2022-01-11", 2)):
+            connection.exec_driver_sql(
+                "INSERT INTO HabitEvent (habit_id, datetime_solved, status) "
+                f"VALUES (1, '{day}', {status})")
+
+    base.Base.metadata.create_all(upgrade_engine)
+    migrations.migrate(upgrade_engine)
+
+    upgrade_session = sessionmaker(bind=upgrade_engine)()
+    hab = upgrade_session.query(models.Habit).get(1)
+    assert hab.updated == datetime.date(2022, 1, 31)
+    assert (hab.latest_streak, hab.longest_streak) == (0, 2)
+    assert hab.streak_date == datetime.date(2022, 1, 11)
+    assert [event.datetime_solved for event in hab.habit_events.order_by(
+        models.HabitEvent.datetime_solved)] == [
+        datetime.date(2022, 1, 9), datetime.date(2022, 1, 10),
+        datetime.date(2022, 1, 11)]
+
+    # Ranges are compared as integers on the index
+    with upgrade_engine.connect() as connection:
+        assert connection.exec_driver_sql(
+            "SELECT typeof(datetime_solved) FROM HabitEvent").scalar() == \
+            "integer"
+
+
+def test_event_pages():
+    """ Test the keyset pages of the event list """
+    app.session = session
+
+    # Habit 2 has an event on every day of 01/2022
+    first = service.get_event_page(session, habit_id=2, limit=10)
+    assert [event.datetime_solved.day for _, event in first] == \
+        list(range(1, 11))
+    second = service.get_event_page(session, habit_id=2, limit=10,
+                                    after=service.event_key(first[-1][1]))
+    assert [event.datetime_solved.day for _, event in second] == \
+        list(range(11, 21))
+    assert service.get_event_page(
+        session, habit_id=2, limit=10,
+        before=service.event_key(second[0][1])) == first
+
+    # Date range and status filters
+    done = service.get_event_page(session, habit_id=2,
+                                  start=datetime.date(2022, 1, 10),
+                                  end=datetime.date(2022, 1, 20), status=1)
+    assert [event.datetime_solved.day for _, event in done] == \
+        list(range(10, 21))
+
+    # Streaming walks all events in pages
+    events = list(service.iter_events(session, page_size=7))
+    assert len(events) == session.query(models.HabitEvent).count()
+    assert [service.event_key(event) for _, event in events] == sorted(
+        service.event_key(event) for _, event in events)
+
+
+def test_benchmark_generator():
+    """ Test that the benchmark data is the same for the same seed """
+    import benchmark
+
+    def generated(seed):
+        gen_session = fresh_session()
+        benchmark.generate(gen_session, habits=5, categories=2, years=0.2,
+                           seed=seed)
+        return [(event.habit_id, event.datetime_solved, event.status)
+                for event in gen_session.query(models.HabitEvent).order_by(
+                    models.HabitEvent.event_id)]
+
+    assert generated(7) == generated(7)
+    assert generated(7) != generated(8)
+
+
+def test_command_line(tmp_path, capsys):
+    """ Test the non-interactive commands """
+    path = str(tmp_path / "cli.sqlite3")
+    app.session = app.open_database(path)
+    hab = models.Habit(name="Flossing", enabled=True)
+    hab.add_day(datetime.date.today().weekday())
+    hab.set_created()
+    app.session.add(hab)
+    app.session.commit()
+    app.session.close()
+
+    assert app.main(["--database", path, "checkoff", "1", "--json"]) == 0
+    assert json.loads(capsys.readouterr().out)["status"] == "Done"
+    assert app.main(["--database", path, "checkoff", "2"]) == 1
+
+    assert app.main(["--database", path, "today", "--json"]) == 0
+    assert json.loads(capsys.readouterr().out) == [{
+        "habit_id": 1, "name": "Flossing", "status": "Done",
+        "streak": 1, "category": None}]
+
+    assert app.main(["--database", path, "streaks", "--json"]) == 0
+    assert json.loads(capsys.readouterr().out) == [{
+        "habit_id": 1, "name": "Flossing", "current": 1, "longest": 1}]
+
+
+def test_background_persistence(tmp_path):
+    """ Test the persistence in the background with an own session """
+    path = str(tmp_path / "worker.sqlite3")
+    worker_session = app.open_database(path)
+    start = datetime.date.today() - datetime.timedelta(days=14)
+    habs = []
+    for name in ("Stretching", "Reading"):
+        hab = models.Habit(name=name, enabled=True)
+        for i in range(0, 7):
+            hab.add_day(i)
+        hab.set_updated(start)
+        habs.append(hab)
+    worker_session.add_all(habs)
+    worker_session.commit()
+
+    persistence_worker = worker.PersistenceWorker(
+        sessionmaker(bind=worker_session.bind), service.run_persistence,
+        repeat=True)
+    persistence_worker.start()
+    assert persistence_worker.wait_for(habs[0].habit_id, timeout=10)
+    # a repeating worker waits for the next day until it is stopped
+    assert persistence_worker.wait_for(timeout=10)
+    assert persistence_worker.is_alive()
+    persistence_worker.stop()
+    persistence_worker.join(timeout=10)
+    assert not persistence_worker.is_alive()
+
+    assert persistence_worker.error is None
+    assert persistence_worker.ready == {hab.habit_id for hab in habs}
+    assert len(persistence_worker.messages) == 28
+    assert worker_session.query(models.HabitEvent).count() == 28
+
+
+def test_persistence_wait(tmp_path):
+    """ Test that only the habits, that are caught up, are waited for,
+    and that a run starts with new messages """
+    import threading
+
+    sqlsession = app.open_database(str(tmp_path / "wait.sqlite3"))
+    today = datetime.date.today()
+    for name, days_away in (("Stretching", 3), ("Reading", 0)):
+        hab = models.Habit(name=name, enabled=True, weekday=127)
+        hab.set_updated(today - datetime.timedelta(days=days_away))
+        sqlsession.add(hab)
+    sqlsession.commit()
+
+    release = threading.Event()
+
+    def job(job_session, day):
+        release.wait(10)
+        yield from service.run_persistence(job_session, day)
+
+    persistence_worker = worker.PersistenceWorker(
+        sessionmaker(bind=sqlsession.bind), job,
+        pending=service.get_catch_up_ids)
+    persistence_worker.start()
+    # Reading is up to date, Stretching waits for the blocked job
+    assert persistence_worker.wait_for(2, timeout=10)
+    assert not persistence_worker.wait_for(1, timeout=0.1)
+    release.set()
+    assert persistence_worker.wait_for(1, timeout=10)
+    persistence_worker.join(timeout=10)
+    assert len(persistence_worker.messages) == 3
+
+    # the next run, e.g. after midnight, replaces the messages
+    startup = persistence_worker.messages
+    persistence_worker.run_job(today + datetime.timedelta(days=1))
+    assert startup is persistence_worker.messages
+    assert len(startup) == 2
+
+
+def test_transfer(tmp_path):
+    """ Test the export and import with id remapping and duplicates """
+    import benchmark
+    source = app.open_database(str(tmp_path / "source.sqlite3"))
+    benchmark.generate(source, habits=4, categories=2, years=0.2)
+    target = app.open_database(str(tmp_path / "target.sqlite3"))
+    # an existing habit and category move the ids of the import
+    target.add(models.HabitCategory(cat_name="Own"))
+    target.add(models.Habit(name="Own habit", enabled=True))
+    target.commit()
+
+    source.add(models.HabitPause(habit_id=2, start=datetime.date(2022, 1, 3),
+                                 end=datetime.date(2022, 1, 10)))
+    source.commit()
+
+    events = source.query(models.HabitEvent).count()
+    for path in (str(tmp_path / "export"), str(tmp_path / "export.jsonl")):
+        assert transfer.export_path(source.bind, path, chunk_size=7) == {
+            "HabitCategory": 2, "Habit": 4, "HabitEvent": events,
+            "HabitPause": 1}
+
+        counts = transfer.import_path(target.bind, path, batch_size=7)
+        assert counts["HabitEvent"]["inserted"] + \
+            counts["HabitEvent"]["skipped"] == events
+    # the second import only finds duplicates
+    assert counts["HabitEvent"] == {"inserted": 0, "skipped": events}
+    assert target.query(models.Habit).count() == 5
+    assert target.query(models.HabitEvent).count() == events
+    assert [(pause.habit_id, pause.end) for pause in target.query(
+        models.HabitPause)] == [(3, datetime.date(2022, 1, 10))]
+
+    for hab in source.query(models.Habit).all():
+        copy = target.query(models.Habit).filter(
+            models.Habit.name == hab.name).one()
+        assert copy.habit_id == hab.habit_id + 1
+        assert copy.habit_events.count() == hab.habit_events.count()
+        assert (copy.latest_streak, copy.longest_streak) == \
+            (hab.latest_streak, hab.longest_streak)
+
+    # an invalid row rolls back the whole import
+    path = tmp_path / "broken.jsonl"
+    path.write_text(
+        '{"table": "Habit", "row": {"habit_id": 1, "name": "New"}}\n'
+        '{"table": "HabitEvent", "row": {"habit_id": 1, "status": 7, '
+        '"datetime_solved": "2022-01-01"}}\n', encoding="utf-8")
+    with pytest.raises(transfer.TransferError, match="line 2"):
+        transfer.import_path(target.bind, str(path))
+    assert target.query(models.Habit).count() == 5
+
+
+def test_database_settings(tmp_path):
+    """ Test the presets, the config file and the environment """
+    config = tmp_path / "haha-bits.ini"
+    config.write_text("[database]\npath = from-config.sqlite3\n"
+                      "preset = bulk\ncache_size = -1000\n", encoding="utf-8")
+
+    settings = database.get_settings(config=str(config), environ={})
+    assert settings["path"] == "from-config.sqlite3"
+    assert (settings["synchronous"], settings["cache_size"]) == ("off", -1000)
+
+    settings = database.get_settings(
+        "analytics", config=str(config), path="given.sqlite3",
+        environ={"HAHABITS_DATABASE": "env.sqlite3",
+                 "HAHABITS_SYNCHRONOUS": "FULL"})
+    assert settings["path"] == "given.sqlite3"
+    assert (settings["synchronous"], settings["query_only"]) == ("full", 1)
+
+    with pytest.raises(ValueError):
+        database.get_settings(config=str(config),
+                              environ={"HAHABITS_JOURNAL_MODE": "fast"})
+
+    engine = database.get_engine(str(tmp_path / "wal.sqlite3"), "interactive",
+                                 config=str(config), environ={})
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql(
+            "PRAGMA journal_mode").scalar() == "wal"
+        assert connection.exec_driver_sql(
+            "PRAGMA busy_timeout").scalar() == 5000
+
+    # the read-only preset creates and upgrades a new database first
+    sqlsession = app.open_database(str(tmp_path / "new.sqlite3"), "analytics")
+    assert sqlsession.query(models.Habit).count() == 0
+    sqlsession.add(models.Habit(name="Reading", enabled=True))
+    with pytest.raises(sqlalchemy.exc.OperationalError, match="readonly"):
+        sqlsession.commit()
+    sqlsession.close()
+
+
+def test_habit_service(tmp_path):
+    """ Test the units of work of the service from several threads """
+    import threading
+
+    sqlsession = app.open_database(str(tmp_path / "service.sqlite3"))
+    habs = [models.Habit(name=f"Habit {i}", enabled=True) for i in range(4)]
+    for hab in habs:
+        for i in range(0, 7):
+            hab.add_day(i)
+        hab.set_created()
+    habs[3].set_condition("gt")
+    habs[3].set_quota(10, "pages")
+    sqlsession.add_all(habs)
+    sqlsession.commit()
+
+    habit_service = service.HabitService(
+        service.create_session_factory(sqlsession.bind))
+    start = datetime.date.today() - datetime.timedelta(days=20)
+    errors = []
+
+    def check_days(habit_id):
+        try:
+            for i in range(0, 20):
+                habit_service.checkoff(
+                    habit_id, start + datetime.timedelta(days=i), quota=12)
+                habit_service.streaks()
+        except Exception as error:  # pylint: disable=broad-except
+            errors.append(error)
+
+    threads = [threading.Thread(target=check_days, args=(hab.habit_id,))
+               for hab in habs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    for hab, streaks in habit_service.streaks():
+        assert (streaks.current, streaks.longest) == (20, 20)
+
+    with pytest.raises(service.HabitError, match="Please give a quota"):
+        habit_service.checkoff(habs[3].habit_id)
+    with pytest.raises(service.HabitError, match="does not exist"):
+        habit_service.checkoff(99)
+
+    assert habit_service.delete_habit(habs[0].habit_id)
+    assert not habit_service.delete_habit(habs[0].habit_id)
+    assert len(habit_service.habits()) == 3
+
+
+def test_http_server(tmp_path):
+    """ Test the JSON endpoints of the HTTP server """
+    import http.client
+    import threading
+
+    path = str(tmp_path / "server.sqlite3")
+    sqlsession = app.open_database(path)
+    hab = models.Habit(name="Meditation", enabled=True)
+    for i in range(0, 7):
+        hab.add_day(i)
+    hab.set_created()
+    sqlsession.add(hab)
+    sqlsession.add_all(models.HabitEvent(
+        habit_id=1, datetime=datetime.date(2022, 1, i),
+        datetime_solved=datetime.date(2022, 1, i), status=1)
+        for i in range(1, 6))
+    sqlsession.flush()
+    service.recalculate_streak(sqlsession, 1)
+    sqlsession.close()
+
+    httpd = server.create_server(path, port=0, workers=2)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    connection = http.client.HTTPConnection("127.0.0.1", httpd.server_port)
+
+    def request(method, url, body=None):
+        connection.request(method, url, body)
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+
+    try:
+        status, today = request("GET", "/habits/today")
+        assert status == 200
+        assert [(hab["name"], hab["status"]) for hab in today] == [
+            ("Meditation", "Open")]
+
+        status, event = request("POST", "/habits/1/checkoff", "{}")
+        assert (status, event["status"]) == (200, "Done")
+        assert request("POST", "/habits/2/checkoff")[0] == 409
+
+        status, page = request("GET", "/events?habit_id=1&limit=4")
+        assert len(page["events"]) == 4 and page["next"] == "2022-01-04,4"
+        status, page = request("GET", f"/events?limit=4&after={page['next']}")
+        assert [event["event_id"] for event in page["events"]] == [5, 6]
+        assert page["next"] is None
+
+        assert request("GET", "/analytics/streaks")[1] == [{
+            "habit_id": 1, "name": "Meditation", "current": 6, "longest": 6}]
+        assert request("GET", "/events?status=x")[0] == 400
+        assert request("GET", "/unknown")[0] == 404
+
+        # Idle clients do not keep the two workers
+        idle = [http.client.HTTPConnection("127.0.0.1", httpd.server_port)
+                for _ in range(2)]
+        for other in idle:
+            other.request("GET", "/habits")
+            assert other.getresponse().will_close
+        assert request("GET", "/habits")[0] == 200
+        for other in idle:
+            other.close()
+    finally:
+        connection.close()
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def test_users(tmp_path):
+    """ Test that every user sees only the own habits and events """
+    sqlsession = fresh_session()
+    today = datetime.date.today()
+    for user in (1, 2):
+        sqlsession.add(models.HabitCategory(user_id=user, cat_name="Sports"))
+        hab = models.Habit(user_id=user, name=f"Running {user}", enabled=True)
+        for i in range(0, 7):
+            hab.add_day(i)
+        hab.created = hab.updated = today - datetime.timedelta(days=3)
+        sqlsession.add(hab)
+    sqlsession.commit()
+
+    # categories are unique per user only
+    assert service.get_categories(sqlsession, 2).count() == 1
+    assert service.get_habit(sqlsession, 2, user_id=1) is None
+    assert [hab.name for hab, _, _ in service.get_today(
+        sqlsession, today, user_id=2)] == ["Running 2"]
+
+    # a persistence run without a user catches the events of all users
+    list(service.iter_persistence(sqlsession, today, user_id=None))
+    sqlsession.commit()
+    for user in (1, 2):
+        page = service.get_event_page(sqlsession, user_id=user)
+        assert len(page) == 3
+        assert {event.user_id for _, event in page} == {user}
+
+    # the service of a user refuses the habits of others
+    path = str(tmp_path / "users.sqlite3")
+    transfer.export_path(sqlsession.bind, str(tmp_path / "users.jsonl"))
+    engine = app.open_database(path).bind
+    transfer.import_path(engine, str(tmp_path / "users.jsonl"))
+    habit_service = service.HabitService(
+        service.create_session_factory(engine)).for_user(2)
+    assert [hab.name for hab in habit_service.habits()] == ["Running 2"]
+    with pytest.raises(service.HabitError):
+        habit_service.checkoff(1)
+    habit, event = habit_service.checkoff(2)
+    assert (habit.user_id, event.user_id) == (2, 2)
+    assert len(habit_service.event_page()) == 4
+
+    # the rollups of a user are rebuilt without touching the others
+    def rollup_rows(user):
+        with engine.connect() as connection:
+            return sorted(tuple(row) for table in ("HabitRollup",
+                                                   "CategoryRollup")
+                          for row in connection.exec_driver_sql(
+                              f"SELECT * FROM {table} WHERE user_id = ?",
+                              (user,)))
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            "UPDATE HabitRollup SET done = 99 WHERE user_id = 1")
+    others, own = rollup_rows(1), rollup_rows(2)
+    habit_service.rebuild_rollups()
+    assert rollup_rows(1) == others and rollup_rows(2) == own
+
+    # the event queries search the index of the user
+    with engine.connect() as connection:
+        plan = " ".join(row[-1] for row in connection.exec_driver_sql(
+            "EXPLAIN QUERY PLAN SELECT status FROM HabitEvent "
+            "WHERE user_id = 2 AND habit_id = 2 ORDER BY datetime_solved"))
+    assert "ix_HabitEvent_user_id_habit_id_datetime_solved" in plan
+
+
+def test_vectorized_backend(monkeypatch):
+    """ Test the NumPy backend against the pure Python analytics """
+    import benchmark
+
+    # without NumPy the pure Python functions are used
+    monkeypatch.setattr(vectorized, "AVAILABLE", False)
+    assert service.get_backend("numpy") == "python"
+    monkeypatch.undo()
+    pytest.importorskip("numpy")
+
+    gen_session = fresh_session()
+    benchmark.generate(gen_session, habits=8, categories=2, years=0.5,
+                       pending=0.1, seed=3)
+    for sqlsession in (session, gen_session):
+        assert service.compute_streaks(sqlsession, backend="numpy") == \
+            service.compute_streaks(sqlsession, backend="python")
+        expected = service.get_statistics(sqlsession, backend="python")
+        statistics = service.get_statistics(sqlsession, backend="numpy")
+        assert statistics.keys() == expected.keys()
+        for habit_id, figures in statistics.items():
+            assert figures.streaks == expected[habit_id].streaks
+            assert figures.average == pytest.approx(expected[habit_id].average)
+            assert figures.completion == pytest.approx(
+                expected[habit_id].completion)
+            assert figures.weekdays == expected[habit_id].weekdays
+
+    # only the given habits, and no events at all
+    assert list(service.compute_streaks(session, [2, 4], "numpy")) == [2, 4]
+    assert service.get_statistics(session, [], "numpy") == {}
+
+
+def test_event_store():
+    """ Test the array columns of the event store with the analytics """
+    store = eventstore.EventStore.load(session.connection(), fetch_size=7)
+    events = session.query(models.HabitEvent).order_by(
+        models.HabitEvent.habit_id, models.HabitEvent.datetime_solved,
+        models.HabitEvent.event_id).all()
+    assert len(store) == len(events)
+    assert store.nbytes == 9 * len(events)
+    assert [(event.habit_id, event.status, event.datetime_solved)
+            for event in store] == [
+        (event.habit_id, event.status, event.datetime_solved)
+        for event in events]
+
+    # the analytics consume the store like ORM objects
+    habits = session.query(models.Habit).all()
+    assert analytics.get_streaks_grouped(store) == \
+        service.compute_streaks(session, backend="python")
+    assert analytics.get_lstreaks_all(habits, store) == \
+        analytics.get_lstreaks_all(habits, events)
+    assert analytics.get_statistics(store) == \
+        service.get_statistics(session, backend="python")
+    assert analytics.get_calculate_avg(store.habit(2)) == \
+        analytics.get_calculate_avg(session.query(models.Habit).get(
+            2).habit_events.all())
+    assert len(store.habit(99)) == 0 and 99 not in store
+
+    assert len(eventstore.EventStore.load(session.connection(), [4])) == \
+        session.query(models.HabitEvent).filter_by(habit_id=4).count()
+
+    # A migrated legacy row without solved day uses the day of the event,
+    # a row without any day is left out
+    legacy_session = fresh_session()
+    for event_id, day, solved in ((1, 738160, 738161), (2, 738162, None),
+                                  (3, None, None)):
+        legacy_session.execute(sqlalchemy.text(
+            "INSERT INTO HabitEvent (event_id, habit_id, user_id, datetime, "
+            "datetime_solved, status) VALUES (:event_id, 1, 1, :day, "
+            ":solved, 1)"),
+            {"event_id": event_id, "day": day, "solved": solved})
+    legacy = eventstore.EventStore.load(legacy_session.connection())
+    assert [event.datetime_solved for event in legacy] == [
+        datetime.date.fromordinal(738161), datetime.date.fromordinal(738162)]
+
+
+def test_lookup_cache(monkeypatch):
+    """ Test the cached habit metadata and its invalidation """
+    app.session = fresh_session()
+    app.session.add(models.HabitCategory(cat_name="Sports"))
+    hab = models.Habit(name="Rowing", enabled=True, cat_id=1)
+    hab.add_day(0)
+    hab.set_condition("gt")
+    hab.set_quota(5, "km")
+    app.session.add(hab)
+    app.session.commit()
+    monkeypatch.setattr(app, "lookup_cache", cache.LookupCache())
+
+    statements = []
+    sqlalchemy.event.listen(app.session.bind, "before_cursor_execute",
+                            lambda *args: statements.append(args[2]))
+    info = app.lookup_cache.habit(app.session, 1)
+    assert (info.name, info.cat_name) == ("Rowing", "Sports")
+    assert info.due_weekday(0) and not info.due_weekday(1)
+    assert info.needs_satisfaction() and info.satisfied(6) == 1
+    assert app.lookup_cache.habit(app.session, "1") is info
+    assert app.lookup_cache.habit(app.session, 1, user_id=2) is None
+    assert len(statements) == 1
+    assert app.lookup_cache.stats() == {"hits": 2, "misses": 1,
+                                        "hit_rate": 2 / 3}
+
+    # toggling and renaming the category are seen at the next lookup
+    answers = iter(["1", "1", "Rowing club"])
+    monkeypatch.setattr(app, "ask", lambda *args: next(answers))
+    app.habit_toggle_status()
+    assert not app.lookup_cache.habit(app.session, 1).enabled
+    app.cat_modify()
+    assert app.lookup_cache.habit(app.session, 1).cat_name == "Rowing club"
+
+    # the service of the server answers a refused checkoff from the cache
+    habit_service = service.HabitService(sessionmaker(
+        bind=app.session.bind, expire_on_commit=False))
+    with pytest.raises(service.HabitError):
+        habit_service.checkoff(1, datetime.date(2022, 1, 3))
+    statements.clear()
+    with pytest.raises(service.HabitError):
+        habit_service.checkoff(1, datetime.date(2022, 1, 3))
+    assert statements == []
+    assert habit_service.delete_habit(1)
+    assert habit_service.lookup_cache.habit(app.session, 1) is None
+
+    # changes of another process are seen, when the snapshot expired
+    now = [0.0]
+    lookup_cache = cache.LookupCache(ttl=5, clock=lambda: now[0])
+    app.session.add(models.Habit(habit_id=2, name="Diving", enabled=True))
+    app.session.commit()
+    assert lookup_cache.habit(app.session, 2).enabled
+    app.session.get(models.Habit, 2).disable()
+    app.session.commit()
+    now[0] = 4.0
+    assert lookup_cache.habit(app.session, 2).enabled
+    now[0] = 5.0
+    assert not lookup_cache.habit(app.session, 2).enabled
+
+
+def test_rollups():
+    """ Test the rollups maintained with the events and the trends """
+    import benchmark
+
+    sqlsession = fresh_session()
+    benchmark.generate(sqlsession, habits=6, categories=2, years=0.3,
+                       pending=0.1, days_away=5, seed=7)
+
+    def rollup_rows():
+        return sorted(tuple(row) for model in (models.HabitRollup,
+                                               models.CategoryRollup)
+                      for row in sqlsession.query(*model.__table__.columns))
+
+    # the monthly trend of a habit against its events
+    events = sqlsession.query(models.HabitEvent).filter_by(habit_id=1).all()
+    trend = service.get_trend(sqlsession, "month", habit_id=1)
+    assert sum(row.events for row in trend) == len(events)
+    first = [event for event in events
+             if event.datetime_solved.replace(day=1) == trend[0].bucket]
+    assert trend[0].completion == len(
+        [event for event in first if event.status == 1]) / len(first)
+    assert trend[1].change == trend[1].completion - trend[0].completion
+    assert sum(row.events for row in service.get_trend(
+        sqlsession, "week")) == sqlsession.query(models.HabitEvent).count()
+
+    # persistence, checkoff, reset and category moves keep the rollups
+    # equal to a rebuild from all events
+    today = datetime.date.today()
+    list(service.iter_persistence(sqlsession, today))
+    hab = sqlsession.query(models.Habit).filter(
+        models.Habit.weekday.op("&")(1 << today.weekday()) != 0).first()
+    event = service.checkoff(sqlsession, hab, today, quota=hab.quota)
+    service.reset_event(sqlsession, event.event_id)
+    service.set_category(sqlsession, hab, 1 if hab.cat_id != 1 else 2)
+    assert service.delete_habit(sqlsession, 2)
+    sqlsession.commit()
+    maintained = rollup_rows()
+    rollups.rebuild(sqlsession)
+    assert maintained == rollup_rows()
+
+    with pytest.raises(ValueError):
+        service.get_trend(sqlsession, "year")
+
+
+def test_due_indexes():
+    """ Test the habits due on a weekday read from its partial index """
+    sqlsession = fresh_session()
+    for weekday, enabled in ((0, True), (1, True), (5, True), (127, True),
+                             (128, True), (4, False), (128, False)):
+        sqlsession.add(models.Habit(name=f"Habit {weekday}", weekday=weekday,
+                                    enabled=enabled))
+    sqlsession.commit()
+
+    habits = sqlsession.query(models.Habit).all()
+    for weekday in range(0, 7):
+        scheduled = service.get_scheduled(sqlsession, weekday).all()
+        assert scheduled == analytics.get_habits_weekday(habits, weekday)
+    # Monday: the first bit of 1, 5, 127 and the weekly habit
+    assert [hab.weekday for hab in service.get_scheduled(sqlsession, 0)] \
+        == [1, 5, 127, 128]
+
+    # the condition is the one of the index, so it can be used
+    query = service.get_scheduled(sqlsession, 2).statement.compile(
+        sqlsession.bind)
+    plan = sqlsession.connection().exec_driver_sql(
+        f"EXPLAIN QUERY PLAN {query}", tuple(query.params.values())).all()
+    assert "ix_Habit_due_2" in plan[0][-1]
+
+
+def test_bulk_resolve(monkeypatch):
+    """ Test the resolution of many open events with one update """
+    app.session = fresh_session()
+    today = datetime.date.today()
+    for name, condition in (("Push-ups", "gt"), ("Reading", None)):
+        hab = models.Habit(name=name, enabled=True)
+        for i in range(0, 7):
+            hab.add_day(i)
+        if condition:
+            hab.set_condition(condition)
+            hab.set_quota(20, "push-ups")
+        hab.created = hab.updated = today - datetime.timedelta(days=10)
+        app.session.add(hab)
+    app.session.commit()
+    list(service.iter_persistence(app.session, today))
+    app.session.commit()
+
+    updates = []
+    sqlalchemy.event.listen(
+        app.session.bind, "before_cursor_execute",
+        lambda conn, cursor, statement, *args: updates.append(statement)
+        if statement.startswith('UPDATE "HabitEvent"') else None)
+
+    # a date range of the habit with a condition, graded by the quota
+    hab = app.session.get(models.Habit, 1)
+    start = today - datetime.timedelta(days=4)
+    assert service.resolve_events(app.session, hab, start=start,
+                                  quota=25) == 4
+    app.session.commit()
+    assert len(updates) == 1
+    events = service.get_habit_events(app.session, hab).all()
+    assert [event.status for event in events] == [0] * 6 + [1] * 4
+    assert {event.quota for event in events[6:]} == {25}
+    assert [event.weekday for event in events[6:]] == [
+        (start + datetime.timedelta(days=i)).weekday() for i in range(4)]
+    assert (hab.latest_streak, hab.longest_streak) == (4, 4)
+
+    # selected events, a failed quota breaks the streak
+    assert service.resolve_events(app.session, hab, event_ids=[1, 2, 15],
+                                  quota=5) == 2
+    assert service.resolve_events(app.session, hab, event_ids=[1]) == 0
+    app.session.commit()
+
+    # interactive, all open events of a habit with one answer, nothing
+    # is changed until they are marked as final
+    answers = iter(["a", "y", "n", "a", "y", "y"])
+    monkeypatch.setattr(app, "ask", lambda *args: next(answers))
+    app.check_open_events(2)
+    assert {event.status for event in service.get_habit_events(
+        app.session, app.session.get(models.Habit, 2))} == {0}
+    app.check_open_events(2)
+    events = service.get_habit_events(
+        app.session, app.session.get(models.Habit, 2)).all()
+    assert {event.status for event in events} == {1}
+    assert app.session.get(models.Habit, 2).latest_streak == 10
+
+    # the rollups are kept equal to a rebuild
+    def rollup_rows():
+        return sorted(tuple(row) for row in app.session.query(
+            *models.HabitRollup.__table__.columns))
+    maintained = rollup_rows()
+    rollups.rebuild(app.session)
+    assert maintained == rollup_rows()
+
+    habit_service = service.HabitService(sessionmaker(
+        bind=app.session.bind, expire_on_commit=False))
+    with pytest.raises(service.HabitError):
+        habit_service.resolve_events(1)
+    assert habit_service.resolve_events(1, quota=30, done=False)[1] == 4
+
+
+def test_resumable_persistence():
+    """ Test the persistence in chunks with the watermark of the runs """
+    sqlsession = fresh_session()
+    today = datetime.date.today()
+    for i in range(0, 5):
+        hab = models.Habit(name=f"Habit {i}", enabled=True)
+        for day in range(0, 7):
+            hab.add_day(day)
+        hab.set_updated(today - datetime.timedelta(days=3))
+        sqlsession.add(hab)
+    sqlsession.commit()
+
+    # a run stopped after the first chunk keeps the committed habits
+    run = service.run_persistence(sqlsession, today, chunk_size=2)
+    assert [habit_id for habit_id, _ in next(run)] == [1, 2]
+    run.close()
+    sqlsession.rollback()
+    assert sqlsession.query(models.HabitEvent).count() == 6
+    assert service.get_watermark(sqlsession) is None
+
+    # the next run goes on with the habits left
+    chunks = list(service.run_persistence(sqlsession, today, chunk_size=2))
+    assert [[habit_id for habit_id, _ in chunk] for chunk in chunks] == [
+        [3, 4], [5]]
+    assert sqlsession.query(models.HabitEvent).count() == 15
+    assert service.get_watermark(sqlsession) == today
+
+    # a complete run of the day is only checked
+    statements = []
+    sqlalchemy.event.listen(
+        sqlsession.bind, "before_cursor_execute",
+        lambda conn, cursor, statement, *args: statements.append(statement))
+    sqlsession.expire_all()
+    assert list(service.run_persistence(sqlsession, today)) == []
+    assert len(statements) == 1
+
+    # a habit imported after the complete run is caught up the same day
+    importer = transfer.Importer(sqlsession.connection())
+    importer.add("Habit", 1, {
+        "habit_id": "1", "name": "Imported", "enabled": "1",
+        "weekday": "127", "created": "2022-01-01",
+        "updated": (today - datetime.timedelta(days=3)).isoformat()})
+    importer.finish()
+    sqlsession.commit()
+    assert service.get_watermark(sqlsession) is None
+    chunks = list(service.run_persistence(sqlsession, today))
+    assert [[habit_id for habit_id, _ in chunk] for chunk in chunks] == [[6]]
+    assert sqlsession.query(models.HabitEvent).count() == 18
+    assert service.get_watermark(sqlsession) == today
+
+    # the next day runs again
+    tomorrow = today + datetime.timedelta(days=1)
+    assert len(list(service.run_persistence(sqlsession, tomorrow))) == 1
+    assert sqlsession.query(models.HabitEvent).count() == 24
+    assert service.get_watermark(sqlsession) == tomorrow
+
+    assert worker.seconds_till_tomorrow(
+        datetime.datetime(2022, 1, 3, 23, 59, 30)) == 30
+
+
+def test_sparse_storage(monkeypatch):
+    """ Test that the sparse storage derives the history of the dense one """
+    today = datetime.date.today()
+    start = today - datetime.timedelta(days=20)
+    sessions = {}
+    for storage in ("dense", "sparse"):
+        sqlsession = fresh_session()
+        daily = models.Habit(name="Stretching", enabled=True)
+        for day in (0, 2, 3, 4, 5, 6):
+            daily.add_day(day)
+        weekly = models.Habit(name="Cleaning", enabled=True)
+        weekly.set_weekly()
+        paused = models.Habit(name="Reading", enabled=True, weekday=127)
+        sqlsession.add_all([daily, weekly, paused])
+        for hab in (daily, weekly, paused):
+            hab.created = start
+            hab.set_updated(start)
+        sqlsession.add(models.HabitEvent(
+            habit_id=1, datetime=start, datetime_solved=start, status=1))
+        sqlsession.commit()
+        sessions[storage] = sqlsession
+
+    def run(function, *args, **kwargs):
+        """ Runs a function on both storages, returns both results """
+        results = {}
+        for storage, sqlsession in sessions.items():
+            monkeypatch.setattr(service, "EVENT_STORAGE", storage)
+            results[storage] = function(sqlsession, *args, **kwargs)
+            sqlsession.commit()
+        return results["dense"], results["sparse"]
+
+    def history(sqlsession, habit_id):
+        hab = sqlsession.get(models.Habit, habit_id)
+        return [(event.datetime_solved, event.status, event.quota)
+                for event in service.get_logical_events(sqlsession, hab)]
+
+    def streaks(sqlsession):
+        return (service.compute_streaks(sqlsession),
+                [(hab.latest_streak, hab.longest_streak)
+                 for hab in sqlsession.query(models.Habit).all()])
+
+    # Reading is disabled after ten days, no more days are missed
+    disabled = start + datetime.timedelta(days=10)
+    run(lambda sqlsession: list(service.run_persistence(sqlsession,
+                                                        disabled)))
+    run(lambda sqlsession: service.toggle_habit(
+        sqlsession, sqlsession.get(models.Habit, 3), disabled))
+    run(lambda sqlsession: list(service.run_persistence(sqlsession, today)))
+    # the missed days are only derived
+    assert sessions["sparse"].query(models.HabitEvent).count() == 1
+    assert len(run(history, 3)[1]) == 10
+    for habit_id in (1, 2, 3):
+        dense, sparse = run(history, habit_id)
+        assert dense == sparse and len(dense) > 1
+        dense, sparse = run(lambda sqlsession: len(service.get_open_events(
+            sqlsession, sqlsession.get(models.Habit, habit_id))))
+        assert dense == sparse > 0
+    assert run(streaks)[0] == run(streaks)[1]
+
+    # Reading is enabled again five days ago, the days in between are
+    # a pause and not missed
+    run(lambda sqlsession: service.toggle_habit(
+        sqlsession, sqlsession.get(models.Habit, 3),
+        today - datetime.timedelta(days=5)))
+    run(lambda sqlsession: list(service.run_persistence(sqlsession, today)))
+    dense, sparse = run(history, 3)
+    assert dense == sparse and len(dense) == 15
+    run(lambda sqlsession: service.checkoff(
+        sqlsession, sqlsession.get(models.Habit, 3), today))
+    assert run(history, 3)[0] == run(history, 3)[1]
+    assert run(streaks)[0] == run(streaks)[1]
+
+    # checkoffs today and in the current week, a range and a single
+    # missed day resolved
+    run(lambda sqlsession: service.checkoff(
+        sqlsession, sqlsession.get(models.Habit, 1), today))
+    run(lambda sqlsession: service.checkoff(
+        sqlsession, sqlsession.get(models.Habit, 2), today))
+    dense, sparse = run(lambda sqlsession: service.resolve_events(
+        sqlsession, sqlsession.get(models.Habit, 1),
+        start=today - datetime.timedelta(days=6)))
+    assert dense == sparse > 0
+    run(lambda sqlsession: service.resolve_event(
+        sqlsession, sqlsession.get(models.Habit, 1),
+        service.get_open_events(
+            sqlsession, sqlsession.get(models.Habit, 1))[0], done=False))
+    for habit_id in (1, 2):
+        dense, sparse = run(history, habit_id)
+        assert dense == sparse
+    assert run(streaks)[0] == run(streaks)[1]
+    # the last week without the Tuesday, unless it is checked off today
+    assert run(streaks)[1][1][0][0] == (7 if today.weekday() == 1 else 6)
+
+    # the trends count the missed days as pending
+    for period, habit_id in (("day", 3), ("week", 2), ("month", None)):
+        dense, sparse = run(service.get_trend, period, habit_id,
+                            start=start)
+        assert dense == sparse and dense
+
+    # the info pages of a habit walk the same events
+    dense, sparse = run(lambda sqlsession: [
+        (event.datetime_solved, event.status)
+        for _, event in service.iter_events(sqlsession, page_size=4,
+                                            habit_id=1)])
+    assert dense == sparse
+
+    def pages_back(sqlsession):
+        """ Walks the pages of a habit backwards, like the info dialog """
+        keys = []
+        before = (today + datetime.timedelta(days=1), 0)
+        while True:
+            page = service.get_event_page(sqlsession, habit_id=1,
+                                          before=before, limit=4)
+            keys = [event.datetime_solved for _, event in page] + keys
+            if len(page) < 4:
+                return keys
+            before = service.event_key(page[0][1])
+    dense, sparse = run(pages_back)
+    assert dense == sparse
+
+    # a page derives the missed days of its window only
+    def whole_history(*args, **kwargs):
+        raise AssertionError("a page loaded the whole history")
+    monkeypatch.setattr(service, "get_logical_events", whole_history)
+    assert run(pages_back)[1] == sparse
+    assert sessions["sparse"].query(models.HabitEvent).count() < \
+        sessions["dense"].query(models.HabitEvent).count()
+
+
+def test_ask_impossible_date(monkeypatch, capsys):
+    """ Test that an impossible date is asked again """
+    answers = iter(["2022-02-30", "2022-02-28", "a", "1"])
+    monkeypatch.setattr(app, "ask", lambda *args: next(answers))
+    assert app.ask_event_filters() == {
+        "start": datetime.date(2022, 2, 28), "end": None, "status": 1}
+    assert "2022-02-30 is not a valid date" in capsys.readouterr().out
+
+
+def test_resolve_impossible_date(monkeypatch, tmp_path, capsys):
+    """ Test that impossible dates neither end the resolve dialog nor
+    the commands with a traceback """
+    app.session = fresh_session()
+    today = datetime.date.today()
+    hab = models.Habit(name="Reading", enabled=True, weekday=127)
+    hab.created = hab.updated = today - datetime.timedelta(days=5)
+    app.session.add(hab)
+    app.session.commit()
+    list(service.iter_persistence(app.session, today))
+    app.session.commit()
+
+    start = today - datetime.timedelta(days=2)
+    answers = iter(["2022-02-30", start.isoformat(), today.isoformat(), "y",
+                    "y"])
+    monkeypatch.setattr(app, "ask", lambda *args: next(answers))
+    app.resolve_habit_events(hab, with_range=True)
+    assert [event.status for event in service.get_habit_events(
+        app.session, hab)] == [0, 0, 0, 1, 1]
+
+    path = str(tmp_path / "habits.sqlite3")
+    assert app.main(["--database", path, "resolve", "1",
+                     "--start", "2022-02-30"]) == 1
+    assert app.main(["--database", path, "trend",
+                     "--start", "2022-13-01"]) == 1
+    assert "invalid day value" in capsys.readouterr().err
+
+
+def test_command_imports(tmp_path):
+    """ Test that a command loads neither the server, the transfer nor
+    NumPy for the python backend, nor the migrations of a current
+    database """
+    import os
+    import subprocess
+    import sys
+    code = ("import sys, app; app.main(['--database', sys.argv[1], "
+            "'today']); print(sorted({'server', 'transfer', 'worker', "
+            "'http.server', 'numpy', 'migrations'} & set(sys.modules)))")
+    # the first run creates the database
+    for modules in ("['migrations']", "[]"):
+        result = subprocess.run(
+            [sys.executable, "-c", code, str(tmp_path / "habits.sqlite3")],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        assert result.stdout.splitlines()[-1] == modules
@@ -0,0 +1,423 @@
+""" Export and import of categories, habits and events.
+
+Two formats are supported: a directory with one CSV file per table, or
+a single JSON Lines file, where every line holds the table name and one
+row. Both are written and read in chunks, so the memory use stays flat
+for long histories. Tables are always written in the order of TABLES,
+an import expects the same order.
+"""
+import csv
+import datetime
+import json
+import os
+
+from sqlalchemy import Boolean, Integer, delete, func, select
+
+import migrations
+import models
+import rollups
+
+# Exported tables in the order of their references
+TABLES = (models.HabitCategory.__table__, models.Habit.__table__,
+          models.HabitEvent.__table__, models.HabitPause.__table__)
+
+# Rows fetched or inserted at once
+CHUNK_SIZE = 5000
+
+# Allowed values for the validation of the imported rows
+CONDITIONS = ("", "eq", "lt", "gt")
+STATUSES = (0, 1, 2)
+
+
+class TransferError(ValueError):
+    """ Raised for an invalid row of an imported file """
+
+    def __init__(self, table, line, message):
+        super().__init__(f"{table}, line {line}: {message}")
+
+
+def get_format(path, fmt=None):
+    """ Returns the format for a path: a directory or a path without
+    suffix is csv, a file with the suffix .jsonl is jsonl """
+    if fmt:
+        return fmt
+    if os.path.splitext(path)[1] in (".jsonl", ".json"):
+        return "jsonl"
+    return "csv"
+
+
+def to_text(value):
+    """ Returns a value of a row, as it is written to a file """
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    if isinstance(value, bool):
+        return int(value)
+    return value
+
+
+def parse_date(value):
+    """ Returns the date of a file value, ISO dates are read directly """
+    try:
+        return datetime.date.fromisoformat(value)
+    except (TypeError, ValueError):
+        return models.to_date(value)
+
+
+def parse_bool(value):
+    """ Returns the boolean of a file value like 1, 0, true or false """
+    text = str(value).lower()
+    if text not in ("0", "1", "true", "false"):
+        raise ValueError(f"no boolean: {value}")
+    return text in ("1", "true")
+
+
+def get_converter(column):
+    """ Returns the function, that converts a file value for a column,
+    it raises ValueError for a wrong value. Empty values are None,
+    except for the text columns with an empty default """
+    if isinstance(column.type, models.DayNumber):
+        convert = parse_date
+    elif isinstance(column.type, Boolean):
+        convert = parse_bool
+    elif isinstance(column.type, Integer):
+        convert = int
+    else:
+        convert = str
+    keep_empty = convert is str and column.default is not None
+
+    def converter(value):
+        if value is None or (value == "" and not keep_empty):
+            return None
+        return convert(value)
+    return converter
+
+
+def iter_rows(connection, table, chunk_size=CHUNK_SIZE):
+    """ Yields the rows of a table as dictionaries, the rows are
+    streamed from the database chunk by chunk """
+    result = connection.execution_options(stream_results=True).execute(
+        select(table).order_by(*table.primary_key.columns))
+    for chunk in result.mappings().partitions(chunk_size):
+        for row in chunk:
+            yield {key: to_text(value) for key, value in row.items()}
+
+
+def export_csv(connection, path, chunk_size=CHUNK_SIZE):
+    """ Writes every table into an own CSV file inside the directory path.
+    Returns the number of rows per table """
+    os.makedirs(path, exist_ok=True)
+    counts = {}
+    for table in TABLES:
+        with open(os.path.join(path, f"{table.name}.csv"), "w",
+                  encoding="utf-8", newline="") as file:
+            writer = csv.DictWriter(file, [col.name for col in table.columns])
+            writer.writeheader()
+            counts[table.name] = 0
+            for row in iter_rows(connection, table, chunk_size):
+                writer.writerow(row)
+                counts[table.name] += 1
+    return counts
+
+
+def export_jsonl(connection, path, chunk_size=CHUNK_SIZE):
+    """ Writes all tables into the JSON Lines file path.
+    Returns the number of rows per table """
+    counts = {}
+    with open(path, "w", encoding="utf-8") as file:
+        for table in TABLES:
+            counts[table.name] = 0
+            for row in iter_rows(connection, table, chunk_size):
+                file.write(json.dumps({"table": table.name, "row": row}))
+                file.write("\n")
+                counts[table.name] += 1
+    return counts
+
+
+def read_csv(path):
+    """ Yields table name, line number and row of the CSV files """
+    for table in TABLES:
+        name = os.path.join(path, f"{table.name}.csv")
+        if not os.path.exists(name):
+            continue
+        with open(name, encoding="utf-8", newline="") as file:
+            # the header is line 1
+            for line, row in enumerate(csv.DictReader(file), start=2):
+                yield table.name, line, row
+
+
+def read_jsonl(path):
+    """ Yields table name, line number and row of a JSON Lines file """
+    with open(path, encoding="utf-8") as file:
+        for line, text in enumerate(file, start=1):
+            if not text.strip():
+                continue
+            try:
+                record = json.loads(text)
+                yield record["table"], line, record["row"]
+            except (ValueError, KeyError, TypeError) as error:
+                raise TransferError("file", line,
+                                    f"no valid record: {error}") from error
+
+
+class Importer:
+    """ Validates imported rows and inserts them in batches.
+
+    The ids of the file are replaced with new ids of the database.
+    Categories with an existing name and habits with an existing name
+    and creation date of the same user are merged into the existing
+    ones, events of a merged habit are skipped, when they are already
+    stored for the same day, its pauses are always skipped. Rows without a user belong to the default
+    user, events always take the user of their habit. The caller owns
+    the transaction.
+    """
+
+    def __init__(self, connection, batch_size=CHUNK_SIZE):
+        self.connection = connection
+        self.batch_size = batch_size
+        self.tables = {table.name: table for table in TABLES}
+        self.converters = {table.name: [(column.name, get_converter(column))
+                                        for column in table.columns]
+                           for table in TABLES}
+        self.batches = {table.name: [] for table in TABLES}
+        self.counts = {table.name: {"inserted": 0, "skipped": 0}
+                       for table in TABLES}
+
+        # ids of the file => ids of the database
+        self.cat_ids = {}
+        self.habit_ids = {}
+        # ids of the database => user
+        self.habit_users = {}
+        # habits with new events, their streaks are evaluated at the end
+        self.touched = set()
+        # users with new habits, the next persistence run catches them up
+        self.users = set()
+
+        self.categories = {(row.user_id, row.cat_name): row.cat_id
+                           for row in connection.execute(select(
+                               models.HabitCategory.user_id,
+                               models.HabitCategory.cat_name,
+                               models.HabitCategory.cat_id))}
+        self.habits = {}
+        for row in connection.execute(select(
+                models.Habit.user_id, models.Habit.name, models.Habit.created,
+                models.Habit.habit_id)):
+            self.habits[(row.user_id, row.name, row.created)] = row.habit_id
+            self.habit_users[row.habit_id] = row.user_id
+        # merged habits, their events are checked against the events,
+        # that were stored before the import, one batch at a time
+        self.merged = set()
+        self.merging = []
+        self.last_event_id = self.next_id(models.HabitEvent.event_id) - 1
+
+        self.next_cat_id = self.next_id(models.HabitCategory.cat_id)
+        self.next_habit_id = self.next_id(models.Habit.habit_id)
+
+    def next_id(self, column):
+        """ Returns the next free id of a column """
+        return (self.connection.execute(select(
+            func.max(column))).scalar() or 0) + 1
+
+    def parse(self, table_name, line, row):
+        """ Converts the text values of a row, unknown columns are
+        ignored and missing ones are left to the defaults """
+        values = {}
+        for name, converter in self.converters[table_name]:
+            if name not in row:
+                continue
+            try:
+                values[name] = converter(row[name])
+            except (ValueError, TypeError) as error:
+                raise TransferError(table_name, line,
+                                    f"{name}: {error}") from error
+        return values
+
+    def add(self, table_name, line, row):
+        """ Validates, maps and queues one row of a table """
+        if table_name not in self.tables:
+            raise TransferError(table_name, line, "unknown table")
+        values = self.parse(table_name, line, row)
+        {
+            "HabitCategory": self.add_category,
+            "Habit": self.add_habit,
+            "HabitEvent": self.add_event,
+            "HabitPause": self.add_pause,
+        }[table_name](line, values)
+
+    def add_category(self, line, values):
+        """ Maps a category to an existing or a new id """
+        if not values.get("cat_name"):
+            raise TransferError("HabitCategory", line, "cat_name is missing")
+
+        old_id = values.get("cat_id")
+        values["user_id"] = values.get("user_id") or models.DEFAULT_USER
+        key = (values["user_id"], values["cat_name"])
+        if key in self.categories:
+            self.cat_ids[old_id] = self.categories[key]
+            self.counts["HabitCategory"]["skipped"] += 1
+            return
+
+        values["cat_id"] = self.next_cat_id
+        self.next_cat_id += 1
+        self.cat_ids[old_id] = values["cat_id"]
+        self.categories[key] = values["cat_id"]
+        self.queue("HabitCategory", values)
+
+    def add_habit(self, line, values):
+        """ Maps a habit to an existing or a new id """
+        if not values.get("name"):
+            raise TransferError("Habit", line, "name is missing")
+        if (values.get("condition") or "") not in CONDITIONS:
+            raise TransferError("Habit", line,
+                                f"unknown condition {values['condition']}")
+        if not 0 <= (values.get("weekday") or 0) <= 255:
+            raise TransferError("Habit", line,
+                                f"weekday out of range {values['weekday']}")
+
+        # 0 is used as no category
+        cat_id = values.get("cat_id") or 0
+        if cat_id:
+            if cat_id not in self.cat_ids:
+                raise TransferError("Habit", line,
+                                    f"unknown category {cat_id}")
+            values["cat_id"] = self.cat_ids[cat_id]
+
+        old_id = values.get("habit_id")
+        values["user_id"] = values.get("user_id") or models.DEFAULT_USER
+        key = (values["user_id"], values["name"], values.get("created"))
+        if key in self.habits:
+            self.habit_ids[old_id] = self.habits[key]
+            self.merged.add(self.habits[key])
+            self.counts["Habit"]["skipped"] += 1
+            return
+
+        values["habit_id"] = self.next_habit_id
+        self.next_habit_id += 1
+        self.habit_ids[old_id] = values["habit_id"]
+        self.habit_users[values["habit_id"]] = values["user_id"]
+        self.habits[key] = values["habit_id"]
+        self.users.add(values["user_id"])
+        self.queue("Habit", values)
+
+    def add_event(self, line, values):
+        """ Maps an event to its habit, duplicates are skipped """
+        if values.get("habit_id") not in self.habit_ids:
+            raise TransferError("HabitEvent", line,
+                                f"unknown habit {values.get('habit_id')}")
+        if values.get("status", 0) not in STATUSES:
+            raise TransferError("HabitEvent", line,
+                                f"unknown status {values['status']}")
+        if values.get("datetime_solved") is None:
+            raise TransferError("HabitEvent", line,
+                                "datetime_solved is missing")
+
+        values["habit_id"] = self.habit_ids[values["habit_id"]]
+        values["user_id"] = self.habit_users[values["habit_id"]]
+        # the database gives a new event id
+        values.pop("event_id", None)
+
+        if values["habit_id"] in self.merged:
+            self.merging.append(values)
+            if len(self.merging) >= self.batch_size:
+                self.merge_events()
+            return
+
+        self.touched.add(values["habit_id"])
+        self.queue("HabitEvent", values)
+
+    def add_pause(self, line, values):
+        """ Maps a pause to its habit, the pauses of merged habits
+        are kept as they are stored """
+        if values.get("habit_id") not in self.habit_ids:
+            raise TransferError("HabitPause", line,
+                                f"unknown habit {values.get('habit_id')}")
+        if values.get("start") is None or values.get("end") is None:
+            raise TransferError("HabitPause", line, "start or end is missing")
+
+        values["habit_id"] = self.habit_ids[values["habit_id"]]
+        values["user_id"] = self.habit_users[values["habit_id"]]
+        values.pop("pause_id", None)
+        if values["habit_id"] in self.merged:
+            self.counts["HabitPause"]["skipped"] += 1
+            return
+        self.queue("HabitPause", values)
+
+    def merge_events(self):
+        """ Queues the events of merged habits, that are not stored yet
+        for the same day. The days are searched by the index on the
+        habit and the solved date, one query per habit of the batch """
+        days = {}
+        for values in self.merging:
+            days.setdefault(values["habit_id"], set()).add(
+                values["datetime_solved"])
+        stored = set()
+        for habit_id, solved in days.items():
+            stored.update(
+                (habit_id, row.datetime, row.datetime_solved)
+                for row in self.connection.execute(select(
+                    models.HabitEvent.datetime,
+                    models.HabitEvent.datetime_solved).where(
+                    models.HabitEvent.user_id == self.habit_users[habit_id],
+                    models.HabitEvent.habit_id == habit_id,
+                    models.HabitEvent.datetime_solved.in_(solved),
+                    models.HabitEvent.event_id <= self.last_event_id)))
+
+        for values in self.merging:
+            if (values["habit_id"], values.get("datetime"),
+                    values["datetime_solved"]) in stored:
+                self.counts["HabitEvent"]["skipped"] += 1
+            else:
+                self.touched.add(values["habit_id"])
+                self.queue("HabitEvent", values)
+        self.merging.clear()
+
+    def queue(self, table_name, values):
+        """ Adds a row to the batch of its table """
+        self.batches[table_name].append(values)
+        if len(self.batches[table_name]) >= self.batch_size:
+            self.flush(table_name)
+
+    def flush(self, table_name):
+        """ Inserts the batch of a table, the batches of the referenced
+        tables are inserted before """
+        for table in TABLES:
+            batch = self.batches[table.name]
+            if batch:
+                self.connection.execute(table.insert(), batch)
+                self.counts[table.name]["inserted"] += len(batch)
+                batch.clear()
+            if table.name == table_name:
+                break
+
+    def finish(self):
+        """ Inserts the remaining rows and evaluates the streaks and the
+        rollups of the habits with new events. The watermarks of the users
+        with new habits are removed. Returns the counts per table """
+        self.merge_events()
+        self.flush(TABLES[-1].name)
+        if self.touched:
+            migrations.evaluate_streaks(self.connection, self.touched)
+            rollups.rebuild(self.connection, self.touched)
+        if self.users:
+            self.connection.execute(delete(models.PersistenceRun).where(
+                models.PersistenceRun.user_id.in_(self.users)))
+        return self.counts
+
+
+def export_path(engine, path, fmt=None, chunk_size=CHUNK_SIZE):
+    """ Exports the database into path, as CSV directory
+    or JSON Lines file. Returns the number of rows per table """
+    export = {"csv": export_csv, "jsonl": export_jsonl}[get_format(path, fmt)]
+    with engine.connect() as connection:
+        return export(connection, path, chunk_size)
+
+
+def import_path(engine, path, fmt=None, batch_size=CHUNK_SIZE):
+    """ Imports a CSV directory or JSON Lines file inside a single
+    transaction, nothing is stored if a row is invalid.
+    Returns the inserted and skipped rows per table """
+    read = {"csv": read_csv, "jsonl": read_jsonl}[get_format(path, fmt)]
+    with engine.begin() as connection:
+        importer = Importer(connection, batch_size)
+        for table_name, line, row in read(path):
+            importer.add(table_name, line, row)
+        return importer.finish()
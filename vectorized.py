@@ -0,0 +1,152 @@
+""" Vectorised analytics backend, built on NumPy.
+
+The status, quota and solved day of the events are read from a raw
+cursor into arrays, no ORM object is created. The figures of all habits
+are then evaluated at once with array operations: the streaks by a run
+length encoding of the successes, the averages, completion rates and
+weekday histograms with bincount. The results are the same as those of
+the pure Python functions in analytics.py.
+
+NumPy is optional, AVAILABLE tells if it is installed. Without it the
+service falls back to the pure Python functions. It is imported, when
+events are loaded for the first time, so the other backends do not pay
+for its import.
+"""
+import importlib.util
+import itertools
+
+import analytics
+import eventstore
+import models
+
+AVAILABLE = importlib.util.find_spec("numpy") is not None
+
+# the numpy module, after it was imported by load_numpy()
+numpy = None
+
+# Columns of the loaded events
+COLUMNS = ("habit_id", "status", "quota", "day")
+
+
+class EventArrays:
+    """ The events of many habits as columns of integer arrays, ordered
+    by habit id and solved date. day is the ordinal of the solved date """
+
+    def __init__(self, habit_id, status, quota, day):
+        self.habit_id = habit_id
+        self.status = status
+        self.quota = quota
+        self.day = day
+
+        # the first event of every habit, every event knows the index
+        # of its habit in self.habits
+        first = numpy.ones(len(habit_id), dtype=bool)
+        first[1:] = habit_id[1:] != habit_id[:-1]
+        self.first = first
+        self.starts = numpy.flatnonzero(first)
+        self.habits = habit_id[self.starts]
+        self.group = numpy.cumsum(first) - 1
+        self.counts = numpy.diff(numpy.append(self.starts, len(habit_id)))
+
+    def __len__(self):
+        return len(self.habit_id)
+
+
+def load_numpy():
+    """ Imports NumPy on the first call """
+    global numpy
+    if numpy is None:
+        import numpy as module
+        numpy = module
+
+
+def load_events(connection, habit_ids=None, user_id=models.DEFAULT_USER):
+    """ Loads the events of a user, or of the given habit ids, from a
+    raw cursor of the connection into EventArrays """
+    load_numpy()
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute(*eventstore.events_query(habit_ids, user_id))
+        # the rows are flattened straight into the array
+        values = numpy.fromiter(itertools.chain.from_iterable(cursor),
+                                dtype=numpy.int64)
+    finally:
+        cursor.close()
+
+    return EventArrays(*values.reshape(-1, len(COLUMNS)).T.copy())
+
+
+def get_streaks(events):
+    """ get longest streak, current streak and number of streaks for all
+    habits of the EventArrays at once.
+
+    Returns a dictionary with the habit id as key and Streaks as value
+    """
+    if not len(events):
+        return {}
+
+    success = events.status == 1
+    # the last event of every habit
+    last = numpy.append(events.first[1:], True)
+
+    # a streak begins with a success after a break or at a new habit,
+    # it ends before a break or at the end of a habit
+    begins = success.copy()
+    begins[1:] &= ~success[:-1] | events.first[1:]
+    ends = success.copy()
+    ends[:-1] &= ~success[1:] | last[:-1]
+
+    run_begins = numpy.flatnonzero(begins)
+    run_ends = numpy.flatnonzero(ends)
+    lengths = run_ends - run_begins + 1
+    run_group = events.group[run_begins]
+
+    longest = numpy.zeros(len(events.habits), dtype=numpy.int64)
+    numpy.maximum.at(longest, run_group, lengths)
+    count = numpy.bincount(run_group, minlength=len(events.habits))
+    # a streak, that ends with the last event, is the current one
+    current = numpy.zeros(len(events.habits), dtype=numpy.int64)
+    is_current = last[run_ends]
+    current[run_group[is_current]] = lengths[is_current]
+
+    return {int(habit_id): analytics.Streaks(int(lon), int(cur), int(cnt))
+            for habit_id, lon, cur, cnt in zip(events.habits, longest,
+                                               current, count)}
+
+
+def get_averages(events):
+    """ get the average quota of all habits of the EventArrays """
+    sums = numpy.bincount(events.group, weights=events.quota,
+                          minlength=len(events.habits))
+    return dict(zip(events.habits.tolist(), (sums / events.counts).tolist()))
+
+
+def get_completion_rates(events):
+    """ get the share of done events of all habits of the EventArrays """
+    done = numpy.bincount(events.group, weights=events.status == 1,
+                          minlength=len(events.habits))
+    return dict(zip(events.habits.tolist(), (done / events.counts).tolist()))
+
+
+def get_weekday_histograms(events):
+    """ get the done events per weekday, Monday first, of all habits
+    of the EventArrays """
+    success = events.status == 1
+    # the ordinal 1 is a Monday
+    weekday = (events.day[success] - 1) % 7
+    histogram = numpy.bincount(events.group[success] * 7 + weekday,
+                               minlength=len(events.habits) * 7)
+    return dict(zip(events.habits.tolist(),
+                    histogram.reshape(-1, 7).tolist()))
+
+
+def get_statistics(events):
+    """ get Statistics of all habits of the EventArrays, the vectorised
+    analytics.get_statistics """
+    streaks = get_streaks(events)
+    averages = get_averages(events)
+    rates = get_completion_rates(events)
+    weekdays = get_weekday_histograms(events)
+    return {habit_id: analytics.Statistics(
+        streaks[habit_id], averages[habit_id], rates[habit_id],
+        weekdays[habit_id]) for habit_id in streaks}
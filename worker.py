@@ -0,0 +1,103 @@
+""" Background worker, that catches missed habit events while the menu
+is already running """
+import datetime
+import threading
+
+
+def seconds_till_tomorrow(now=None):
+    """ Returns the seconds from now till the next midnight """
+    now = now or datetime.datetime.now()
+    tomorrow = datetime.datetime.combine(
+        now.date() + datetime.timedelta(days=1), datetime.time())
+    return (tomorrow - now).total_seconds()
+
+
+class PersistenceWorker(threading.Thread):
+    """ Runs a persistence job with an own session in the background.
+
+    The job is called with the session and today's date, commits the
+    habits in chunks and yields the list of (habit id, startup messages)
+    of every committed chunk, so callers can wait for a single habit.
+
+    The optional pending function is called the same way and returns
+    the ids of the habits, that the job catches up, the other habits
+    need no waiting.
+
+    With repeat, the job is run again after every midnight, until the
+    worker is stopped, so a long-running process catches the missed
+    events of every new day.
+    """
+
+    def __init__(self, session_factory, job, repeat=False, pending=None):
+        super().__init__(name="persistence", daemon=True)
+        self.session_factory = session_factory
+        self.job = job
+        self.repeat = repeat
+        self.pending = pending
+
+        # startup messages of the current run, can be handed to the menu
+        # as startup buffer
+        self.messages = []
+        # ids of the habits, that the current run catches up, None
+        # until they are known
+        self.catching = None
+        # ids of the habits, that are finished by the current run
+        self.ready = set()
+        self.finished = False
+        self.error = None
+        self.condition = threading.Condition()
+        self.stopped = threading.Event()
+
+    def run(self):
+        """ Runs the job, again after every midnight with repeat """
+        while True:
+            self.run_job(datetime.date.today())
+            if not self.repeat or self.stopped.wait(seconds_till_tomorrow()):
+                break
+
+    def run_job(self, today):
+        """ Runs the job once and marks the habits ready one by one """
+        with self.condition:
+            self.ready.clear()
+            self.catching = None
+            self.finished = False
+            # the list stays the startup buffer of the menu
+            del self.messages[:]
+
+        sqlsession = self.session_factory()
+        try:
+            if self.pending is not None:
+                catching = set(self.pending(sqlsession, today))
+                with self.condition:
+                    self.catching = catching
+                    self.condition.notify_all()
+            for chunk in self.job(sqlsession, today):
+                with self.condition:
+                    for habit_id, messages in chunk:
+                        self.messages.extend(messages)
+                        self.ready.add(habit_id)
+                    self.condition.notify_all()
+        except Exception as error:  # pylint: disable=broad-except
+            sqlsession.rollback()
+            self.error = error
+            self.messages.append(f"Catching missed events failed: {error}")
+        finally:
+            sqlsession.close()
+            with self.condition:
+                self.finished = True
+                self.condition.notify_all()
+
+    def stop(self):
+        """ Ends the repetition, a running job is finished """
+        self.stopped.set()
+
+    def wait_for(self, habit_id=None, timeout=None):
+        """ Waits until a habit, or all habits without a habit id,
+        are finished. Returns False on a timeout """
+        def caught_up():
+            return self.finished or habit_id in self.ready or (
+                habit_id is not None and self.catching is not None and
+                habit_id not in self.catching)
+
+        with self.condition:
+            return self.condition.wait_for(caught_up, timeout)